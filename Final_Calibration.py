@@ -1,28 +1,72 @@
-from bluepy.btle import Scanner, DefaultDelegate
+import argparse
+import os
+from location import BackgroundScanner, ReplayScanSource, load_recording
+from calibration import CalibrationSession, MODELS, fit_model, save_model
 
-class ScanDelegate(DefaultDelegate):
-    def __init__(self, R1List, R2List):
-        DefaultDelegate.__init__(self)
-        self.R1List = R1List
-        self.R2List = R2List
+# MAC addresses of the room beacons
+BEACON_ADDRS = [u'fb:13:5e:5d:d1:d5', u'ec:b6:d0:1e:0c:5e']
+
+# seconds to record each location for. Walk around the location meanwhile so the whole of it is covered
+CALIBRATION_SECONDS = 60
+
+
+def record(args):
+    """Records a take of one location and adds it to the session file"""
+    session = CalibrationSession.load(args.session) if os.path.exists(args.session) \
+        else CalibrationSession(BEACON_ADDRS)
+    if args.replay is None:
+        # only needed with real hardware
+        from ble_scanner import BluepyScanSource
+        source = BluepyScanSource()
+    else:
+        source = ReplayScanSource(load_recording(args.replay))
+    scanner = BackgroundScanner(source)
+    scanner.start()
+    print(f"Recording {args.location} (room {args.room}) for {args.seconds} s")
+    filters = session.record(scanner, args.location, args.room, args.seconds)
+    scanner.stop()
+    session.save(args.session)
+    for addr, rssi_filter in filters.items():
+        print(f"{addr}: {rssi_filter.num_samples} readings, mean {rssi_filter.mean:.1f} dBm, "
+              f"std {rssi_filter.variance ** .5:.1f} dB")
+    print(f"{args.session}: {len(session.takes)} takes of {len(session.locations)} locations, "
+          f"{len(session.samples)} readings")
+
+
+def fit(args):
+    """Fits a model to session files and writes the model file the server loads"""
+    sessions = [CalibrationSession.load(path) for path in args.sessions]
+    classifier, vectors, rooms = fit_model(sessions, args.method, args.filter)
+    save_model(classifier, args.model)
+    # how often the classifier agrees with the rooms the fingerprints were recorded in
+    predicted = classifier.classify(vectors)[0]
+    print(f"{args.model}: {args.method} model of {len(classifier.beacons)} beacons fitted to {len(vectors)} "
+          f"fingerprints in {len(classifier.centroids)} cells, each reading classified by its {classifier.k} "
+          f"nearest")
+    for room in sorted(set(rooms.tolist())):
+        selected = rooms == room
+        print(f"room {room}: {selected.sum()} fingerprints, {(predicted[selected] == room).mean():.1%} "
+              f"classified correctly")
 
-    def handleDiscovery(self, dev, isNewDev, isNewData):
-        if isNewDev or isNewData:
-            if dev.addr == u'fb:13:5e:5d:d1:d5':
-                self.R1List.append(dev.rssi)
-            elif dev.addr == u'ec:b6:d0:1e:0c:5e':
-                self.R2List.append(dev.rssi)
 
 if __name__ == "__main__":
-    Room1_values = []
-    Room2_values = []
-    scanner = Scanner().withDelegate(ScanDelegate(Room1_values, Room2_values))
-    for i in range(15):
-        devices = scanner.scan(10)
-    print(len(Room1_values))
-    print(len(Room2_values))
-    # assert(len(Room1_values) == 15)
-    # assert(len(Room2_values) == 15)
-
-    print("The Average Room 1 Beacon RSSI At This Location is %i" % (sum(Room1_values) / len(Room1_values)))
-    print("The Average Room 2 Beacon RSSI At This Location is %i" % (sum(Room2_values) / len(Room2_values)))
+    parser = argparse.ArgumentParser(description="Records labeled RSSI readings and fits the room model "
+                                                 "Final_Server.py loads")
+    commands = parser.add_subparsers(dest='command', required=True)
+    record_parser = commands.add_parser('record', help="record a location and add it to a session file")
+    record_parser.add_argument('session', help="session file (.npz), created if it doesn't exist")
+    record_parser.add_argument('room', type=int, help="room number of the location, 0 outside every room")
+    record_parser.add_argument('location', help="name of the location")
+    record_parser.add_argument('--seconds', type=float, default=CALIBRATION_SECONDS)
+    record_parser.add_argument('--replay', help="replay a CSV recording (see location.load_recording) "
+                                                "instead of scanning")
+    record_parser.set_defaults(run=record)
+    fit_parser = commands.add_parser('fit', help="fit a model file to session files")
+    fit_parser.add_argument('model', help="model file (.npz) to write")
+    fit_parser.add_argument('sessions', nargs='+', help="session files")
+    fit_parser.add_argument('--method', choices=sorted(MODELS), default='gaussian')
+    fit_parser.add_argument('--filter', choices=('ewma', 'kalman'), default='ewma',
+                            help="RSSI filter mode of the server")
+    fit_parser.set_defaults(run=fit)
+    args = parser.parse_args()
+    args.run(args)
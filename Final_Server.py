@@ -1,208 +1,1097 @@
-from bluepy.btle import Scanner, DefaultDelegate
-import socket
-import wave
+import asyncio
+import functools
+import itertools
+import os
 import pyaudio
+import socket
 import time
 import multiprocessing
-from struct import *
-from aenum import IntEnum, auto
+from protocol import ClientServerMsg, ProtocolError, CAP_DATAGRAMS, CAP_STANDBY, CAPABILITIES, \
+    MSG_HEADER_LEN, HEADER, DURATION, CREDIT, TIMESTAMP, RSP_HEADER, TIME_RSP, START_FRAME, NEW_STREAM, \
+    STREAM_STANDBY, encode_header, encode_message, decode_hello, encode_hello_rsp
+from track_cache import TrackCache, ConvertedTrack, TRACK_CACHE_BYTES
+from audio_codecs import Codec, ALL_CODECS, make_codec, choose_codec
+from location import LocationTracker, BackgroundScanner, FingerprintClassifier, RoomSwitchScheduler
+from datagram_transport import encode_datagram, frames_per_datagram, open_multicast_sender
 
 host = '128.113.194.238'
 
-port_room_one = 8888
-port_room_two = 8000
+# port the clients of each room connect to. Any number of clients may connect to a room's port
+ROOM_PORTS = {1: 8888, 2: 8000}
+
+# wave files played one after the other. Each room continues the playlist where the listener left it
+PLAYLIST = ['wave_files/a_boogie.wav']
+# start the playlist over once its last track ends
+PLAYLIST_REPEAT = True
 
-CURRENT_CONNECTION = 0
+# how the audio reaches clients that can receive datagrams: 'tcp' sends STREAM_RSPs to every client,
+# 'udp' sends each room's datagrams to each of its clients and 'multicast' sends them once to the room's
+# group. NEW_STREAM, HALT and the rest always go over each client's TCP connection
+TRANSPORT = 'tcp'
+# multicast group of each room, and the UDP port its datagrams are sent to
+ROOM_GROUPS = {1: '239.255.42.1', 2: '239.255.42.2'}
+GROUP_PORT = 5004
+# address of the interface multicast datagrams are sent from
+MULTICAST_INTERFACE = '0.0.0.0'
+# seconds ahead of their presentation time datagrams are sent, what the clients buffer
+DATAGRAM_LEAD = .3
+# seconds from a NEW_STREAM to the first datagram, for the clients to join the group and get ready
+DATAGRAM_JOIN_DELAY = .05
 
 NUM_BYTES_TO_RECV = 65536
 
-MSG_HEADER_LEN = 6
-MSG_LEN_PACKING_FORMAT = 'I'
-MSG_CODE_PACKING_FORMAT = 'H'
+# buffer sizes of a session until its client's HELLO arrived
+FRAMES_PER_BUFFER = 16384
+# number of FRAMES_PER_BUFFER sized frames sent in each STREAM_RSP
+FRAMES_PER_RSP = 10
+# bounds of the frames per buffer the server agrees to
+MIN_FRAMES_PER_BUFFER = 256
+MAX_FRAMES_PER_BUFFER = 1 << 16
+# seconds of audio the server aims to send in each STREAM_RSP. Fewer, larger messages cost less per
+# byte while smaller ones fill the client's buffer sooner
+RSP_SECONDS = .25
+# seconds a new client is given to send its HELLO before it is refused
+HELLO_TIMEOUT = 1.
+# seconds from sending NEW_STREAM to the time the stream is scheduled to be heard, enough for the clients
+# to preload their queues. Every client of a room starts at the same time, and clients joining later
+# start where the others are by then
+START_DELAY = .2
 
-DURATION_FORMAT = 'f'
+# seconds a room likely to be walked into next stays prepared: its clients get the stream muted, in step
+# with the listener's room, so the switch only needs a START. Each hint of the location process renews it
+STANDBY_SECONDS = 10.
+# seconds from sending START to the frame it unmutes at, for the message to reach the clients
+START_MARGIN = .05
 
-AUDIO_FORMAT = 'I'
-CHANNEL_FORMAT = 'H'
-FPB_FORMAT = 'H'
-FRAMERATE_FORMAT = 'H'
-FRAME_LEN_FORMAT = 'I'
-
-FRAMES_PER_BUFFER = 16384
+# codecs STREAM_RSPs are compressed with, most preferred first. The first one the client decodes is
+# used. DELTA is lossless and cuts CD audio to roughly half its bitrate. Put Codec.MULAW first to trade
+# quality for a fixed half bitrate with less CPU, or Codec.PCM to send straight from the file
+CODEC_PREFERENCE = (Codec.DELTA, Codec.PCM)
 
 SLEEP_INTERVAL = 0.05
 SLEEP_INT_LARGE = 0.1
 
-rooms_dict = {1: [[[-15, -83], [-83, -88]], [[-74, -90], [-78, -89]]], 2: [[[-71, -82], [-73, -79]], [[-80, -96], [-28, -83]]]}
+# MAC addresses of the room beacons, in the order their RSSI ranges appear in each rooms_dict region
+BEACON_ADDRS = [u'fb:13:5e:5d:d1:d5', u'ec:b6:d0:1e:0c:5e']
 
+# how the RSSI readings of each beacon are smoothed, 'ewma' or 'kalman'
+RSSI_FILTER_MODE = 'ewma'
 
-wf = wave.open('wave_files/a_boogie.wav', 'rb')
-py_audio = pyaudio.PyAudio()
+rooms_dict = {1: [[[-15, -83], [-83, -88]], [[-74, -90], [-78, -89]]], 2: [[[-71, -82], [-73, -79]], [[-80, -96], [-28, -83]]]}
 
+# model file written by `python Final_Calibration.py fit`. While it exists it decides the rooms instead of
+# BEACON_ADDRS and rooms_dict
+LOCATION_MODEL = 'location_model.npz'
 
-class ScanDelegate(DefaultDelegate):
-    def __init__(self, R1_RSSI, R2_RSSI):
-        DefaultDelegate.__init__(self)
-        self.R1_RSSI = R1_RSSI
-        self.R2_RSSI = R2_RSSI
 
-    def handleDiscovery(self, dev, isNewDev, isNewData):
-        if isNewDev or isNewData:
-            if dev.addr == u'fb:13:5e:5d:d1:d5':
-                self.R1_RSSI = dev.rssi
-            elif dev.addr == u'ec:b6:d0:1e:0c:5e':
-                self.R2_RSSI = dev.rssi
+py_audio = pyaudio.PyAudio()
+
 
+def get_stream_params(sample_width, num_channels, stream_rate):
+    """Stream parameters for current stream"""
+    stream_format = py_audio.get_format_from_width(sample_width)
+    return stream_format, num_channels, stream_rate
 
-class ClientServerMsg(IntEnum):
-    # Server sends
-    HALT = auto()
-    NEW_STREAM = auto()
-    STREAM_RSP = auto()
 
-    # Client sends
-    HALT_RSP = auto()
-    STREAM_REQ = auto()
+def choose_sample_format(track, rate, channels, sample_width):
+    """
+    Picks the format a client is streamed in from the playback format it declared in its HELLO. Each
+    value of 0 leaves that part of the track's format as it is, and tracks are mixed down to the
+    client's channels but never up.
+    :param track: track_cache.Track of the first track of the playlist
+    :param rate: sample rate the client plays, 0 for any
+    :param channels: most channels the client plays, 0 for any
+    :param sample_width: bytes per sample the client plays, 0 for any
+    :return: (sample_width, channels, framerate) every track is converted to for the client
+    """
+    return (sample_width or track.sample_width,
+            min(channels or track.channels, track.channels),
+            rate or track.framerate)
 
 
-def get_data():
-    data = wf.readframes(FRAMES_PER_BUFFER)
-    return data
+def track_seconds(track):
+    """:return float: length in seconds of a track_cache.Track"""
+    return track.pcm_len // track.frame_size / track.framerate
 
 
-def get_stream_params():
-    """Stream parameters for current stream"""
-    stream_format = py_audio.get_format_from_width(wf.getsampwidth())
-    num_channels = wf.getnchannels()
-    stream_rate = wf.getframerate()
-    stream_frame_len = len(wf.readframes(FRAMES_PER_BUFFER))
-    wf.rewind()
-    return stream_format, num_channels, stream_rate, stream_frame_len
+def choose_buffer_sizes(preferred_fpb, max_fpb, max_rsp_len, framerate, frame_size):
+    """
+    Picks the buffer sizes of a stream from those a client asked for in its HELLO.
+    :param preferred_fpb: frames per buffer the client would like
+    :param max_fpb: most frames per buffer the client supports
+    :param max_rsp_len: most bytes the client accepts in a STREAM_RSP
+    :param framerate: frames per second of the track
+    :param frame_size: bytes per frame of the track
+    :return: (frames_per_buffer, buffers_per_rsp). Each STREAM_RSP carries buffers_per_rsp buffers of
+        audio, as many as fit in RSP_SECONDS and max_rsp_len but at least one
+    """
+    frames_per_buffer = max(MIN_FRAMES_PER_BUFFER, min(preferred_fpb, max_fpb, MAX_FRAMES_PER_BUFFER))
+    buffer_len = frames_per_buffer * frame_size
+    buffers_per_rsp = max(1, min(round(RSP_SECONDS * framerate / frames_per_buffer),
+                                 max_rsp_len // buffer_len))
+    return frames_per_buffer, buffers_per_rsp
 
 
-def seconds_to_frame(seconds):
+def seconds_to_frame(seconds, framerate):
     """return the number of frames a duration in seconds represents"""
     # https://stackoverflow.com/questions/18721780/play-a-part-of-a-wav-file-in-python
-    n_frames = int(seconds * wf.getframerate())
+    n_frames = int(seconds * framerate)
+    return n_frames
 
 
-def encode_message(msg_code, msg_bytes=b''):
-    len_msg = 0 if msg_bytes is None else len(msg_bytes)
-    len_msg += MSG_HEADER_LEN
-    encoded_message = pack(MSG_LEN_PACKING_FORMAT, len_msg) \
-                      + pack(MSG_CODE_PACKING_FORMAT, msg_code) + msg_bytes
-    return encoded_message
+async def send_pcm_message(writer, msg_code, track, pos, count, codec=None, pts=None):
+    """
+    Sends a message whose body is count bytes of a track's samples starting at pos. The header is
+    written from its own buffer and the body is passed to the kernel with os.sendfile, so it is never
+    copied into a Python object. Where sendfile isn't available the body is written from the track's
+    memory map instead, as are tracks held in memory. Samples sent with a codec other than PCM are encoded
+    from the memory map.
+    :param writer: asyncio.StreamWriter of the client connection
+    :param msg_code: ClientServerMsg of the message
+    :param track: track_cache.Track to send samples of
+    :param pos: position in bytes of the first sample to send, relative to the start of the samples
+    :param count: number of bytes of samples to send
+    :param codec: optional audio_codecs codec the samples are encoded with
+    :param pts: optional server time the first sample is to be heard at, sent ahead of the samples
+    """
+    def header(len_body):
+        if pts is None:
+            return encode_header(msg_code, len_body)
+        return RSP_HEADER.pack(MSG_HEADER_LEN + TIMESTAMP.size + len_body, msg_code, pts)
 
+    if codec is not None and codec.codec_id != Codec.PCM:
+        body = codec.encode(track.pcm[pos:pos + count])
+        writer.write(header(len(body)))
+        writer.write(body)
+        await writer.drain()
+        return
+    writer.write(header(count))
+    await writer.drain()
+    if count > 0 and track.file is None:
+        writer.write(track.pcm[pos:pos + count])
+        await writer.drain()
+    elif count > 0:
+        try:
+            await asyncio.get_event_loop().sendfile(writer.transport, track.file, track.pcm_offset + pos,
+                                                    count, fallback=False)
+        except asyncio.SendfileNotAvailableError:
+            writer.write(track.pcm[pos:pos + count])
+            await writer.drain()
 
-sock_one = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-sock_two = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-sock_one.bind((host, port_room_one))
-sock_two.bind((host, port_room_two))
+def encode_new_stream(track, frames_per_buffer, rsp_len, codec_id=Codec.PCM, start_time=0., stream_id=0,
+                      group=None, group_port=0, standby=False):
+    """
+    Builds the NEW_STREAM message carrying the PyAudio parameters of the given track
+    :param track: track_cache.Track about to be streamed
+    :param frames_per_buffer: frames per PyAudio buffer
+    :param rsp_len: number of bytes of samples in each STREAM_RSP, once decoded
+    :param codec_id: Codec the STREAM_RSPs are encoded with
+    :param start_time: server time the stream is scheduled to be heard from
+    :param stream_id: id of the datagrams the audio is sent in, 0 if it is sent in STREAM_RSPs
+    :param group: multicast group the datagrams are sent to, None if they are sent to the client's port
+    :param group_port: UDP port of the group
+    :param standby: whether the client keeps the stream muted until a START
+    """
+    form, channels, rate = track.stream_params
+    frame_len = frames_per_buffer * track.frame_size
+    msg_bytes = NEW_STREAM.pack(form, channels, rate, frames_per_buffer, frame_len, rsp_len, codec_id, start_time,
+                                stream_id, socket.inet_aton(group or '0.0.0.0'), group_port,
+                                STREAM_STANDBY if standby else 0)
+    return encode_message(ClientServerMsg.NEW_STREAM, msg_bytes)
 
-print("server listening on port one")
-print("server listening on port two")
 
-sock_one.listen(1)
+def encode_start(frame):
+    """:param frame: frame of the stream, counted from its start_time, the client unmutes at"""
+    return encode_message(ClientServerMsg.START, START_FRAME.pack(frame))
 
-sock_two.listen(1)
 
-conn_one, addr_one = sock_one.accept()
-conn_two, addr_two = sock_two.accept()
+async def read_message(reader):
+    """
+    Reads one complete message from a client connection. Waits until the entire message identified
+    by the length in its header has arrived.
+    :param reader: asyncio.StreamReader of the client connection
+    :return: (msg_code, msg_body) where msg_body is the message without its header
+    """
+    len_msg, msg_code = HEADER.unpack(await reader.readexactly(MSG_HEADER_LEN))
+    msg_body = await reader.readexactly(len_msg - MSG_HEADER_LEN)
+    return msg_code, msg_body
 
-# get params of new stream
-form, channels, rate, frame_len = get_stream_params()
-msg_bytes = pack(AUDIO_FORMAT, form) + pack(CHANNEL_FORMAT, channels) + pack(FRAMERATE_FORMAT, rate) \
-            + pack(FPB_FORMAT, FRAMES_PER_BUFFER) + pack(FRAME_LEN_FORMAT, frame_len)
-msg_code = ClientServerMsg.NEW_STREAM
-msg = encode_message(msg_code, msg_bytes)
 
-conn_one.sendall(msg)
-conn_two.sendall(msg)
+def get_location(room_conn, scan_source=None, tracker=None):
+    """
+    Entry point for the process that scans beacon RSSI and decides which room the listener is in.
+    Advertisements are scanned continuously on a background thread and every one of them updates the
+    classification, which a RoomSwitchScheduler debounces into room switches. Every switch is sent to the
+    StreamServer through room_conn as ('switch', room, decided_at), so the server can measure how long the
+    handoff took. A room the listener seems to be walking into is sent as ('prepare', room, decided_at)
+    as soon as it becomes the scheduler's candidate, well before the dwell time is up.
+    :param room_conn: sending end of a multiprocessing.Pipe shared with the StreamServer
+    :param scan_source: source of advertisements, defaults to scanning with bluepy. A
+        location.ReplayScanSource replays recorded advertisements instead
+    :param tracker: LocationTracker classifying the advertisements, defaults to one using LOCATION_MODEL if
+        it exists and BEACON_ADDRS and rooms_dict otherwise
+    """
+    def send_room(room, confidence, decided_at):
+        print(f"Location: switching to room {room} (confidence {confidence:.2f}), {scheduler.report()}")
+        room_conn.send(('switch', room, decided_at))
 
-data_one = conn_one.recv(1024)
-data_two = conn_two.recv(1024)
+    def prepare_room(room, confidence, decided_at):
+        room_conn.send(('prepare', room, decided_at))
 
-code_one = unpack(MSG_CODE_PACKING_FORMAT, data_one[4:6])[0]
-code_two = unpack(MSG_CODE_PACKING_FORMAT, data_two[4:6])[0]
+    def classified(room, confidence, received_at):
+        print(f"Location: classified as room {room} (confidence {confidence:.2f})")
+
+    # the candidate is announced again well before its standby runs out, for as long as it lasts
+    scheduler = RoomSwitchScheduler(send_room, on_candidate=prepare_room,
+                                    candidate_interval=STANDBY_SECONDS / 3)
+
+    if tracker is None and os.path.exists(LOCATION_MODEL):
+        classifier = FingerprintClassifier.load(LOCATION_MODEL)
+        print(f"Location: using {LOCATION_MODEL} of beacons {', '.join(classifier.beacons)}")
+        tracker = LocationTracker(classifier.beacons, None, classifier.filter_mode, on_room_change=classified,
+                                  classifier=classifier)
+    elif tracker is None:
+        tracker = LocationTracker(BEACON_ADDRS, rooms_dict, RSSI_FILTER_MODE, on_room_change=classified)
+    if scan_source is None:
+        # only needed with real hardware
+        from ble_scanner import BluepyScanSource
+        scan_source = BluepyScanSource()
+    scanner = BackgroundScanner(scan_source)
+    scanner.start()
+
+    while scanner.thread.is_alive() or not scanner.readings.empty():
+        reading = scanner.get(timeout=SLEEP_INT_LARGE)
+        if reading is not None:
+            scheduler.update(tracker.update(*reading), tracker.confidence, reading[2])
+        else:
+            scheduler.poll()
+    print(f"Location: {scheduler.report()}")
 
-assert code_one == ClientServerMsg.STREAM_REQ
-print("got req code_one")
-time.sleep(.2)
 
-assert code_two == ClientServerMsg.STREAM_REQ
-print("got req code_two")
-time.sleep(.2)
+class RoomSession:
+    def __init__(self, reader, writer, room, track):
+        """
+        RoomSession: state of one client connection. The client grants credit for STREAM_RSP chunks
+        with STREAM_REQs and the session pushes chunks until the credit runs out, so several chunks can
+        be in flight at once.
+        :param reader: asyncio.StreamReader of the client connection
+        :param writer: asyncio.StreamWriter of the client connection
+        :param room: room number the client connected to
+        :param track: track_cache.Track of the first track of the playlist
+        """
+        self.reader = reader
+        self.writer = writer
+        self.room = room
+        self.addr = writer.get_extra_info('peername') if writer is not None else None
+        # the track is shared with other sessions, each session keeps its own position into it
+        self.track = track
+        # index in the playlist of self.track
+        self.track_index = 0
+        # (sample_width, channels, framerate) every track is streamed to the client in, so track changes
+        # don't need a new PyAudio stream. Picked once the HELLO arrived
+        self.sample_format = track.sample_format
+        # (playlist index, asyncio.Task acquiring that track) of the track prefetched to play next
+        self.next_track = None
+        # (preferred frames per buffer, max frames per buffer, max STREAM_RSP length) from the client's
+        # HELLO, None to use the default buffer sizes
+        self.buffer_prefs = None
+        # buffer sizes of the stream, negotiated by the client's HELLO
+        self.frames_per_buffer = FRAMES_PER_BUFFER
+        self.buffers_per_rsp = FRAMES_PER_RSP
+        # bitmask of the codecs the client decodes, from its HELLO
+        self.client_codecs = 1 << Codec.PCM
+        # (rate, channels, sample_width) the client plays, 0 for any. From its HELLO
+        self.playback_format = (0, 0, 0)
+        # UDP port the client receives audio datagrams on, 0 if it only takes STREAM_RSPs. From its HELLO
+        self.datagram_port = 0
+        # protocol.CAPABILITIES the client and the server both have, from its HELLO
+        self.capabilities = 0
+        # audio_codecs codec the current stream is encoded with
+        self.codec = None
+        # set once the client's HELLO arrived
+        self.hello = asyncio.Event()
+        # bytes of the track's samples in each STREAM_RSP
+        self.chunk_len = self.buffers_per_rsp * self.frames_per_buffer * track.frame_size
+        # position in bytes of the next samples to send, relative to the start of the samples
+        self.pcm_pos = 0
+        # tracks of the current stream as (playlist index, seconds into the track the stream started it
+        # at, seconds into the stream it started at, length of the track in seconds)
+        self.segments = []
+        # seconds the client reported playing in its last HALT_RSP, None if unknown
+        self.played_seconds = None
+        # server time the current stream is heard from
+        self.start_time = 0.
+        # held while a message is written in several parts, so a TIME_RSP can't end up in the middle
+        self.send_lock = asyncio.Lock()
+        # True from sending NEW_STREAM until the client acknowledged the HALT ending the stream
+        self.streaming = False
+        # True while the stream is sent ahead to a room on standby, muted until a START
+        self.standby = False
+        # number of STREAM_RSP chunks the client is still willing to receive
+        self.credit = 0
+        # set whenever the session may have something new to do (credit granted, room switched)
+        self.wakeup = asyncio.Event()
+        # set once the client acknowledged a HALT
+        self.halted = asyncio.Event()
 
-def get_location():
-    Room1_Read = 0
-    Room2_Read = 0
-    Current_Read = 0
-    in_room = 0
+    async def read_messages(self):
+        """Coroutine handling every message the client sends until it disconnects"""
+        while True:
+            msg_code, msg_body = await read_message(self.reader)
+            if msg_code != ClientServerMsg.HELLO and not self.hello.is_set():
+                raise ProtocolError(f"message {msg_code} arrived before the HELLO")
+            if msg_code == ClientServerMsg.STREAM_REQ:
+                # a STREAM_REQ without a body grants a single chunk
+                self.credit += CREDIT.unpack_from(msg_body, 0)[0] if msg_body else 1
+                self.wakeup.set()
+            elif msg_code == ClientServerMsg.HALT_RSP:
+                duration = DURATION.unpack_from(msg_body, 0)[0]
+                print(f"Server: room {self.room} client {self.addr} played for {duration} s")
+                self.played_seconds = duration
+                # credit granted before the HALT arrived at the client is void
+                self.credit = 0
+                self.halted.set()
+            elif msg_code == ClientServerMsg.HELLO:
+                try:
+                    capabilities, *buffer_prefs, codecs, rate, channels, sample_width, datagram_port = \
+                        decode_hello(msg_body)
+                except ProtocolError:
+                    # tell the client which version the server speaks before hanging up
+                    await self.send_message(encode_hello_rsp(0))
+                    raise
+                # takes effect with the next NEW_STREAM
+                self.capabilities = capabilities & CAPABILITIES
+                self.buffer_prefs = tuple(buffer_prefs)
+                self.client_codecs = codecs
+                self.playback_format = (rate, channels, sample_width)
+                self.datagram_port = datagram_port if self.capabilities & CAP_DATAGRAMS else 0
+                await self.send_message(encode_hello_rsp(self.capabilities))
+                self.hello.set()
+            elif msg_code == ClientServerMsg.TIME_REQ:
+                # echo the client's send time with the times it was received and answered
+                received_at = time.time()
+                async with self.send_lock:
+                    self.writer.write(encode_message(ClientServerMsg.TIME_RSP, TIME_RSP.pack(
+                        TIMESTAMP.unpack_from(msg_body, 0)[0], received_at, time.time())))
 
-    scanner = Scanner().withDelegate(ScanDelegate(Room1_Read, Room2_Read))
+    def start_stream(self):
+        """Sets up the buffer sizes and codec of a new stream of self.track from the client's HELLO"""
+        track = self.track
+        if self.buffer_prefs is not None:
+            self.frames_per_buffer, self.buffers_per_rsp = choose_buffer_sizes(
+                *self.buffer_prefs, track.framerate, track.frame_size)
+        self.chunk_len = self.buffers_per_rsp * self.frames_per_buffer * track.frame_size
+        codec_id = choose_codec(CODEC_PREFERENCE, self.client_codecs, track.sample_width)
+        self.codec = make_codec(codec_id, track.channels, track.sample_width)
+        print(f"Server: room {self.room} client {self.addr} gets {track.framerate} Hz, {track.channels} "
+              f"channels, {8 * track.sample_width} bit, {self.frames_per_buffer} frames per buffer, "
+              f"{self.buffers_per_rsp} buffers per STREAM_RSP, codec {codec_id.name}")
 
-    while True:
-        scanner.scan()
+    def new_stream_message(self):
+        """:return bytes: the NEW_STREAM announcing the current track with the session's parameters"""
+        return encode_new_stream(self.track, self.frames_per_buffer, self.chunk_len, self.codec.codec_id,
+                                 self.start_time, standby=self.standby)
 
-        for room in rooms_dict:
-            for sub in rooms_dict[room]:
-                if ((Room1_Read <= sub[0][0]) and (Room1_Read >= sub[0][1])) and ((Room2_Read <= sub[1][0]) and (Room2_Read >= sub[1][1])):
-                    Current_Read = room
-                    in_room = 1
-                    break
-            if in_room:
+    def frame_at(self, server_time):
+        """:return int: frame of the current stream heard at server_time, counted from its start"""
+        return max(0, round((server_time - self.start_time) * self.track.framerate))
+
+    async def send_message(self, message):
+        """Sends a message to the client, keeping it apart from the TIME_RSPs"""
+        async with self.send_lock:
+            self.writer.write(message)
+            await self.writer.drain()
+
+    def add_segment(self, track_index, start_frame):
+        """
+        Records that the stream continues with self.track from start_frame on.
+        :param track_index: playlist index of self.track
+        :param start_frame: frame of the track the stream continues at
+        """
+        stream_time = 0.
+        if self.segments:
+            index, start_time, prev_stream_time, length = self.segments[-1]
+            stream_time = prev_stream_time + length - start_time
+        self.segments.append((track_index, start_frame / self.track.framerate, stream_time,
+                              track_seconds(self.track)))
+
+    def presentation_time(self):
+        """:return float: server time the samples at self.pcm_pos are scheduled to be heard at"""
+        track_index, start_time, stream_time, length = self.segments[-1]
+        return self.start_time + stream_time + self.pcm_pos / self.track.frame_size / self.track.framerate \
+            - start_time
+
+    def position_after(self, seconds):
+        """
+        :param seconds: seconds the client played the current stream for
+        :return: (playlist index, seconds into that track) the client played up to
+        """
+        for track_index, start_time, stream_time, length in reversed(self.segments):
+            if stream_time <= seconds:
                 break
-        if in_room:
-            if (Current_Read == 1) and (CURRENT_CONNECTION != conn_one):
-                CURRENT_CONNECTION = conn_one
-            elif (Current_Read == 2) and (CURRENT_CONNECTION != conn_one):
-                CURRENT_CONNECTION = conn_two
-            in_room = 0
-            Current_Read = 0
+        return track_index, min(start_time + seconds - stream_time, length)
+
+    def close(self):
+        self.writer.close()
+
+
+class RoomBroadcast(RoomSession):
+    def __init__(self, room, track, sock, stream_id, group=None, group_port=0):
+        """
+        RoomBroadcast: streams a room to all its clients that receive datagrams at once. The audio is
+        read and encoded once per room and sent in sequence numbered datagrams paced by their
+        presentation times, DATAGRAM_LEAD seconds ahead, without credit. With a multicast group each
+        datagram is sent once however many clients listen, otherwise once to each client's port. Control
+        messages still go over each subscribed client's own connection, and each subscriber shares the
+        broadcast's timeline so it reports its position like any other session.
+        :param room: room number streamed
+        :param track: track_cache.Track of the first track of the playlist
+        :param sock: UDP socket the datagrams are sent from
+        :param stream_id: id of the datagrams of this broadcast
+        :param group: multicast group of the room, None to send to each client
+        :param group_port: UDP port of the group
+        """
+        super().__init__(None, None, room, track)
+        self.addr = group or 'datagrams'
+        self.sock = sock
+        self.stream_id = stream_id
+        self.group = group
+        self.group_port = group_port
+        # RoomSessions receiving the broadcast
+        self.subscribers = set()
+        # sequence number of the next datagram
+        self.seq = 0
+        # datagrams the socket's buffer had no room for
+        self.dropped = 0
+        # set once the first NEW_STREAM went out, and once the playlist ended
+        self.started = False
+        self.ended = False
+        # set once the broadcast stopped, its subscribers go back to waiting for their room
+        self.done = False
+
+    def accepts(self, session):
+        """:return bool: whether a client can play the broadcast as it is"""
+        return session.sample_format == self.sample_format and not self.done \
+            and (self.codec is None or session.client_codecs & (1 << self.codec.codec_id))
+
+    def subscribe(self, session):
+        """Adds a client to the broadcast, ahead of its NEW_STREAM"""
+        self.subscribers.add(session)
+        if not self.started:
+            # the codec is picked once the track is, every client subscribed by then must decode it
+            self.client_codecs &= session.client_codecs
+        if self.started:
+            self.attach(session)
+
+    def attach(self, session):
+        """Puts a subscriber on the broadcast's timeline as its NEW_STREAM is sent"""
+        session.segments = self.segments
+        session.start_time = self.start_time
+        session.played_seconds = None
+        session.halted.clear()
+        session.streaming = True
+
+    def new_stream_message(self):
+        return encode_new_stream(self.track, self.frames_per_buffer, self.chunk_len, self.codec.codec_id,
+                                 self.start_time, self.stream_id, self.group, self.group_port, self.standby)
+
+    async def send_message(self, message):
+        """Sends a message to every subscriber. Ones that disconnected are dropped by their own session"""
+        await asyncio.gather(*(session.send_message(message) for session in list(self.subscribers)),
+                             return_exceptions=True)
+
+    def send_datagram(self, count, pts):
+        """
+        Sends count bytes of samples from self.pcm_pos in a datagram.
+        :param count: number of bytes of samples
+        :param pts: server time the first sample is to be heard at
+        """
+        datagram = encode_datagram(self.stream_id, self.seq, pts,
+                                   self.codec.encode(self.track.pcm[self.pcm_pos:self.pcm_pos + count]))
+        self.seq += 1
+        if self.group is not None:
+            addresses = [(self.group, self.group_port)]
         else:
-            if CURRENT_CONNECTION != 0:
-                CURRENT_CONNECTION = 0
-
-        time.sleep(1)
-
-
-def stream_music():
-    while True:
-        while CURRENT_CONNECTION != 0:
-            if CURRENT_CONNECTION == conn_one:
-                print("waiting...")
-
-                print('Server: got rsp')
-                code_one = unpack(MSG_CODE_PACKING_FORMAT, data_one[4:6])[0]
-                print(code_one)
-                assert code_one == ClientServerMsg.STREAM_REQ
-                frames = b''
-                for i in range(10):
-                    frames += get_data()
-                code_one = ClientServerMsg.STREAM_RSP
-                print("Server: sending data")
-                conn_one.sendall(encode_message(code_one, frames))
-                data_one = conn_one.recv(1024)
-            elif CURRENT_CONNECTION == conn_two:
-                print("waiting...")
-
-                print('Server: got rsp')
-                code_two = unpack(MSG_CODE_PACKING_FORMAT, data_two[4:6])[0]
-                print(code_two)
-                assert code_two == ClientServerMsg.STREAM_REQ
-                frames = b''
-                for i in range(10):
-                    frames += get_data()
-                code_two = ClientServerMsg.STREAM_RSP
-                print("Server: sending data")
-                conn_two.sendall(encode_message(code_two, frames))
-                data_two = conn_two.recv(1024)
+            addresses = [(session.addr[0], session.datagram_port) for session in self.subscribers]
+        for address in addresses:
+            try:
+                self.sock.sendto(datagram, address)
+            except BlockingIOError:
+                # the clients conceal it like a datagram lost on the way
+                self.dropped += 1
 
+    def close(self):
+        pass
 
-if __name__ == "__main__":
-    location_process = multiprocessing.Process(name='location_process', target=get_location)
-    stream_process = multiprocessing.Process(name='stream_process', target=stream_music)
 
+class StreamServer:
+    def __init__(self, room_ports, playlist, repeat=PLAYLIST_REPEAT, transport=TRANSPORT):
+        """
+        StreamServer: accepts any number of room clients concurrently and serves each one from its
+        own coroutine, so a slow client only stalls itself. Plays the tracks of a playlist back to back:
+        the next track is prefetched while the current one streams and announced with a NEW_STREAM
+        right after the current track's last chunk, so clients queue it behind the current track.
+        :param room_ports: dict of room number -> port the clients of that room connect to
+        :param playlist: paths of the wave files streamed to the clients, in order
+        :param repeat: start the playlist over after its last track
+        :param transport: 'tcp', 'udp' or 'multicast', see TRANSPORT
+        """
+        self.room_ports = room_ports
+        self.playlist = playlist
+        self.repeat = repeat
+        # tracks are loaded once and shared by every session playing them
+        self.track_cache = TrackCache(TRACK_CACHE_BYTES, get_stream_params)
+        # room number -> set of RoomSessions of the clients currently connected
+        self.sessions = {room: set() for room in room_ports}
+        # room the listener is in, 0 if they aren't in any room
+        self.active_room = 0
+        # room the listener is likely to walk into next, streamed muted until it becomes the active room.
+        # 0 if there is none, and the asyncio.TimerHandle that ends the standby
+        self.standby_room = 0
+        self.standby_timer = None
+        # room number -> asyncio.Event set while that room is the active or the standby room. Created in
+        # serve() so they belong to the running event loop
+        self.room_events = {}
+        # time the location process decided on the last room switch, used to measure switch latency
+        self.switch_decided_at = 0.
+        # playlist index of the track the listener is at, and seconds into it they have heard up to.
+        # Kept in seconds since clients may play the track at different sample rates
+        self.listener_track = 0
+        self.listener_time = 0.
+        # server time the active room's stream is heard from, listener_time into the listener's track.
+        # None until the first session of the room starts
+        self.stream_start = None
+        # sessions of the room the listener left that haven't reported how far they played yet
+        self.halting_sessions = set()
+        # asyncio.Event set while listener_time is up to date, i.e. halting_sessions is empty.
+        # Created in serve()
+        self.position_known = None
+        # (path, sample_format) -> future of the ConvertedTrack being converted on a worker thread
+        self.conversions = {}
+        self.transport = transport
+        # room number -> RoomBroadcast streaming it in datagrams
+        self.broadcasts = {}
+        # UDP socket datagrams are sent from, opened in serve() unless the transport is 'tcp'
+        self.datagram_sock = None
+        self.stream_ids = itertools.count(1)
+
+    async def handle_client(self, reader, writer, room):
+        """
+        Coroutine serving one client connection: announces the stream with NEW_STREAM while the
+        client's room is active and then pushes a STREAM_RSP for every chunk of credit the client
+        grants. Once the listener leaves the room the client is sent a HALT.
+        :param reader: asyncio.StreamReader of the client connection
+        :param writer: asyncio.StreamWriter of the client connection
+        :param room: room number the client connected to
+        """
+        session = RoomSession(reader, writer, room, self.track_cache.acquire(self.playlist[0]))
+        self.sessions[room].add(session)
+        print(f"Server: room {room} client {session.addr} connected")
+        read_task = asyncio.ensure_future(session.read_messages())
+        try:
+            stream_task = asyncio.ensure_future(self.stream_to_session(session))
+            # whichever ends first (client disconnected or stream failed) ends the session
+            done, pending = await asyncio.wait([read_task, stream_task],
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                task.result()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print(f"Server: room {room} client {session.addr} disconnected")
+        except ProtocolError as error:
+            # mixed client and server builds would garble the audio, hang up instead
+            print(f"Server: room {room} client {session.addr} refused, {error}")
+        finally:
+            self.sessions[room].discard(session)
+            self.finish_halt(session)
+            session.close()
+            self.drop_next_track(session)
+            self.track_cache.release(session.track)
+
+    async def acquire_track(self, path, sample_format=None):
+        """
+        Acquires a track from the cache like TrackCache.acquire(). Conversions that aren't cached run on
+        a worker thread so the other sessions keep streaming, and sessions asking for a conversion
+        already running share it.
+        :param path: path of the wave file
+        :param sample_format: optional (sample_width, channels, framerate) to convert the track to
+        :return: Track or ConvertedTrack, to be released with self.track_cache.release()
+        """
+        track = self.track_cache.lookup(path, sample_format)
+        if track is not None or sample_format is None:
+            return track or self.track_cache.acquire(path)
+        key = (path, sample_format)
+        conversion = self.conversions.get(key)
+        if conversion is None:
+            source = self.track_cache.acquire(path)
+            if source.sample_format == sample_format:
+                return source
+            conversion = asyncio.ensure_future(self.convert_track(source, sample_format))
+            self.conversions[key] = conversion
+        # shielded, so a session cancelled while it waits, e.g. because its client left, doesn't cancel the
+        # conversion for the other sessions waiting for it
+        await asyncio.shield(conversion)
+        return self.track_cache.acquire(path, sample_format)
+
+    async def convert_track(self, source, sample_format):
+        """
+        Converts a track on a worker thread and caches the result, see acquire_track().
+        :param source: Track to convert, released once it is converted
+        :param sample_format: (sample_width, channels, framerate) to convert to
+        """
+        key = (source.path, sample_format)
+        try:
+            track = await asyncio.get_event_loop().run_in_executor(None, ConvertedTrack, source, sample_format,
+                                                                   get_stream_params)
+        finally:
+            del self.conversions[key]
+            self.track_cache.release(source)
+        self.track_cache.add(source.path, sample_format, track)
+        # cached without a user, each session waiting for it acquires it
+        self.track_cache.release(track)
+
+    def next_track_index(self, track_index):
+        """:return: playlist index of the track after track_index, None at the end of the playlist"""
+        if track_index + 1 < len(self.playlist):
+            return track_index + 1
+        return 0 if self.repeat else None
+
+    def prefetch_next_track(self, session):
+        """
+        Starts acquiring the track after the session's current one, converting it if needed, so the
+        track change doesn't wait for it. Its pages are read ahead too.
+        :param session: RoomSession to prefetch for
+        """
+        track_index = self.next_track_index(session.track_index)
+        if track_index is None or (session.next_track is not None and session.next_track[0] == track_index):
+            return
+        self.drop_next_track(session)
+        task = asyncio.ensure_future(self.acquire_track(self.playlist[track_index], session.sample_format))
+        task.add_done_callback(lambda done: done.cancelled() or done.exception() or done.result().prefetch())
+        session.next_track = (track_index, task)
+
+    def drop_next_track(self, session):
+        """Releases the track prefetched for a session once it has been acquired"""
+        if session.next_track is None:
+            return
+        task = session.next_track[1]
+        session.next_track = None
+        task.add_done_callback(lambda done: done.cancelled() or done.exception()
+                               or self.track_cache.release(done.result()))
+
+    async def take_track(self, session, track_index):
+        """
+        Makes a playlist track the session's current track, using the prefetched track if it is the one.
+        :param session: RoomSession
+        :param track_index: playlist index of the track
+        """
+        if session.next_track is not None and session.next_track[0] == track_index:
+            task = session.next_track[1]
+            session.next_track = None
+            track = await task
+        else:
+            self.drop_next_track(session)
+            track = await self.acquire_track(self.playlist[track_index], session.sample_format)
+        self.track_cache.release(session.track)
+        session.track = track
+        session.track_index = track_index
+
+    async def change_track(self, session):
+        """
+        Continues a session's stream with the next track of the playlist once every chunk of the current
+        one has been sent. The NEW_STREAM announcing it is sent right away, ahead of the chunks the client
+        still has queued, and credit carries over so the client keeps its queue full across the change.
+        :param session: RoomSession whose track ran out
+        :return bool: False if the playlist ended
+        """
+        track_index = self.next_track_index(session.track_index)
+        if track_index is None:
+            return False
+        await self.take_track(session, track_index)
+        session.pcm_pos = 0
+        session.add_segment(track_index, 0)
+        session.start_stream()
+        await session.send_message(session.new_stream_message())
+        print(f"Server: room {session.room} moved on to track {track_index}, {session.track.path}")
+        self.prefetch_next_track(session)
+        return True
+
+    async def stream_to_session(self, session):
+        """
+        Streams to a session for as long as it is connected.
+        :param session: RoomSession to stream to
+        """
+        room_event = self.room_events[session.room]
+        writer = session.writer
+        try:
+            await asyncio.wait_for(session.hello.wait(), HELLO_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ProtocolError("it sent no HELLO")
+        session.sample_format = choose_sample_format(session.track, *session.playback_format)
+        while True:
+            # stay silent until the listener walks into this client's room, or is about to
+            await room_event.wait()
+            # then wait for the room they came from to report how far it played
+            await self.position_known.wait()
+            if not room_event.is_set():
+                continue
+            if not self.can_stream(session):
+                session.wakeup.clear()
+                await session.wakeup.wait()
+                continue
+            if session.datagram_port and self.transport != 'tcp' and await self.receive_broadcast(session):
+                continue
+            # continue from where the listener is. Converting the track if needed can take a while, the
+            # listener may have left again meanwhile
+            session.standby = session.room != self.active_room
+            await self.schedule_stream(session)
+            if not room_event.is_set():
+                continue
+            session.credit = 0
+            session.halted.clear()
+            session.streaming = True
+            session.start_stream()
+            await session.send_message(session.new_stream_message())
+            self.print_started(session)
+            self.prefetch_next_track(session)
+            playlist_ended = False
+            while self.keeps_streaming(session):
+                if session.standby and session.room == self.active_room:
+                    await self.start_standby(session)
+                if session.pcm_pos >= session.track.pcm_len and not await self.change_track(session):
+                    # the playlist ended. An empty STREAM_RSP tells the client no more chunks are coming,
+                    # then stay idle until the listener leaves the room
+                    if not playlist_ended:
+                        writer.write(encode_message(ClientServerMsg.STREAM_RSP))
+                        await writer.drain()
+                        playlist_ended = True
+                    session.wakeup.clear()
+                    await session.wakeup.wait()
+                    continue
+                if session.credit == 0:
+                    session.wakeup.clear()
+                    await session.wakeup.wait()
+                    continue
+                count = min(session.chunk_len, session.track.pcm_len - session.pcm_pos)
+                session.credit -= 1
+                # only waits on this client's socket, other rooms keep streaming
+                async with session.send_lock:
+                    await send_pcm_message(writer, ClientServerMsg.STREAM_RSP, session.track, session.pcm_pos,
+                                           count, session.codec, session.presentation_time())
+                session.pcm_pos += count
+            # listener left this room, or didn't come after all
+            await self.halt_session(session)
+
+    def can_stream(self, session):
+        """
+        :return bool: whether a session can be streamed to. In a standby room it follows the listener's
+            stream, so it waits until the active room's has been scheduled, and its client has to be able
+            to play it muted
+        """
+        if session.room == self.active_room:
+            return True
+        return self.stream_start is not None and bool(session.capabilities & CAP_STANDBY)
+
+    def keeps_streaming(self, session):
+        """
+        :return bool: whether a session's stream goes on. It ends once the listener left its room, and a
+            stream on standby once the room isn't the likely next one anymore
+        """
+        return self.room_events[session.room].is_set() \
+            and (session.standby or session.room == self.active_room)
+
+    def print_started(self, session):
+        if session.standby:
+            print(f"Server: room {session.room} prepared on standby")
+        else:
+            print(f"Server: room {session.room} started "
+                  f"{(time.time() - self.switch_decided_at) * 1000:.1f} ms after the switch was decided")
+
+    async def start_standby(self, session):
+        """
+        Unmutes a stream sent ahead on standby once the listener walked into its room. The clients have it
+        queued already, so a START naming the frame to be heard from is all they need.
+        :param session: RoomSession or RoomBroadcast of the room
+        """
+        session.standby = False
+        await session.send_message(encode_start(session.frame_at(time.time() + START_MARGIN)))
+        print(f"Server: room {session.room} started from standby "
+              f"{(time.time() - self.switch_decided_at) * 1000:.1f} ms after the switch was decided")
+
+    async def halt_session(self, session):
+        """Sends a session HALT and waits for the client to report how far it played"""
+        await session.send_message(encode_message(ClientServerMsg.HALT))
+        await session.halted.wait()
+        self.finish_halt(session)
+
+    async def schedule_stream(self, session):
+        """
+        Schedules a session's stream to start where the listener is and takes the track playing there.
+        Every client of the room is heard in step, one that joins late starts where the others are by
+        then, and so does a room on standby.
+        :param session: RoomSession to schedule
+        """
+        now = time.time()
+        if self.stream_start is None:
+            self.stream_start = now + START_DELAY
+            # a room on standby has a stream to follow now
+            for standby in self.sessions.get(self.standby_room, ()):
+                standby.wakeup.set()
+        session.start_time = max(self.stream_start, now + START_DELAY)
+        start_seconds = self.listener_time + session.start_time - self.stream_start
+        track_index = self.listener_track
+        await self.take_track(session, track_index)
+        # the listener's room may have moved on to later tracks by then
+        while start_seconds >= track_seconds(session.track) > 0:
+            next_index = self.next_track_index(track_index)
+            if next_index is None:
+                break
+            start_seconds -= track_seconds(session.track)
+            track_index = next_index
+            await self.take_track(session, track_index)
+        start_frame = min(seconds_to_frame(start_seconds, session.track.framerate),
+                          session.track.pcm_len // session.track.frame_size)
+        session.pcm_pos = start_frame * session.track.frame_size
+        session.segments = []
+        session.add_segment(session.track_index, start_frame)
+        session.played_seconds = None
+
+    async def receive_broadcast(self, session):
+        """
+        Has a session receive its room's datagrams until the listener leaves the room, starting the
+        room's RoomBroadcast if there is none yet.
+        :param session: RoomSession whose client receives datagrams
+        :return bool: False if the client can't play the running broadcast and needs STREAM_RSPs instead
+        """
+        room = session.room
+        broadcast = self.broadcasts.get(room)
+        if broadcast is None:
+            group = ROOM_GROUPS.get(room) if self.transport == 'multicast' else None
+            broadcast = RoomBroadcast(room, self.track_cache.acquire(self.playlist[0]), self.datagram_sock,
+                                      next(self.stream_ids), group, GROUP_PORT if group else 0)
+            # the first client picks the format and buffer sizes of the whole room
+            broadcast.sample_format = session.sample_format
+            broadcast.buffer_prefs = session.buffer_prefs
+            broadcast.client_codecs = ALL_CODECS
+            broadcast.standby = room != self.active_room
+            self.broadcasts[room] = broadcast
+            broadcast.subscribe(session)
+            asyncio.ensure_future(self.stream_broadcast(broadcast))
+        elif broadcast.accepts(session):
+            broadcast.subscribe(session)
+            if broadcast.started:
+                await session.send_message(broadcast.new_stream_message())
+                if broadcast.ended:
+                    await session.send_message(encode_message(ClientServerMsg.STREAM_RSP))
+        else:
+            print(f"Server: room {room} client {session.addr} can't play the room's datagrams")
+            return False
+        try:
+            while self.keeps_streaming(broadcast) and not broadcast.done:
+                session.wakeup.clear()
+                await session.wakeup.wait()
+        finally:
+            broadcast.subscribers.discard(session)
+            broadcast.wakeup.set()
+        if session.streaming:
+            await self.halt_session(session)
+        return True
+
+    async def stream_broadcast(self, broadcast):
+        """
+        Streams a room's RoomBroadcast while the listener is in the room and clients subscribe to it.
+        :param broadcast: RoomBroadcast to stream
+        """
+        room_event = self.room_events[broadcast.room]
+        try:
+            await self.schedule_stream(broadcast)
+            if not room_event.is_set() or not broadcast.subscribers:
+                return
+            broadcast.start_stream()
+            broadcast.started = True
+            for session in broadcast.subscribers:
+                broadcast.attach(session)
+            await broadcast.send_message(broadcast.new_stream_message())
+            self.print_started(broadcast)
+            print(f"Server: room {broadcast.room} sends datagrams to {broadcast.addr}")
+            self.prefetch_next_track(broadcast)
+            send_from = time.time() + DATAGRAM_JOIN_DELAY
+            while self.keeps_streaming(broadcast) and broadcast.subscribers:
+                if broadcast.standby and broadcast.room == self.active_room:
+                    await self.start_standby(broadcast)
+                if broadcast.pcm_pos >= broadcast.track.pcm_len and not await self.change_track(broadcast):
+                    if not broadcast.ended:
+                        await broadcast.send_message(encode_message(ClientServerMsg.STREAM_RSP))
+                        broadcast.ended = True
+                    broadcast.wakeup.clear()
+                    await broadcast.wakeup.wait()
+                    continue
+                pts = broadcast.presentation_time()
+                delay = max(pts - DATAGRAM_LEAD, send_from) - time.time()
+                if delay > 0:
+                    broadcast.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(broadcast.wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                count = min(frames_per_datagram(broadcast.track.frame_size) * broadcast.track.frame_size,
+                            broadcast.track.pcm_len - broadcast.pcm_pos)
+                broadcast.send_datagram(count, pts)
+                broadcast.pcm_pos += count
+        finally:
+            print(f"Server: room {broadcast.room} sent {broadcast.seq} datagrams, {broadcast.dropped} dropped")
+            broadcast.done = True
+            if self.broadcasts.get(broadcast.room) is broadcast:
+                del self.broadcasts[broadcast.room]
+            for session in broadcast.subscribers:
+                session.wakeup.set()
+            self.drop_next_track(broadcast)
+            self.track_cache.release(broadcast.track)
+
+    def finish_halt(self, session):
+        """
+        Called once a session stopped streaming, because its client acknowledged a HALT or disconnected.
+        If the listener left the session's room, the position the client played up to becomes where the
+        next room starts.
+        :param session: RoomSession that stopped streaming
+        """
+        session.streaming = False
+        if session not in self.halting_sessions:
+            return
+        self.halting_sessions.discard(session)
+        if session.played_seconds is not None and session.segments:
+            self.listener_track, self.listener_time = session.position_after(session.played_seconds)
+        if not self.halting_sessions:
+            print(f"Server: listener is at {self.listener_time:.3f} s of track {self.listener_track}")
+            self.position_known.set()
+
+    def set_active_room(self, room, decided_at=None):
+        """
+        Makes the given room the one being heard. Clients of the previous room are halted right away and
+        clients of the new room are sent NEW_STREAM once the previous room reported the frame playback
+        stopped at, so the new room picks up where the listener left off. If the new room was on standby
+        its clients have the stream queued already and are only sent a START.
+        :param room: room number the listener is in, 0 if they aren't in any room
+        :param decided_at: time.time() at which the room switch was decided, defaults to now
+        """
+        self.switch_decided_at = time.time() if decided_at is None else decided_at
+        if room != self.active_room and not self.keeps_timeline(room):
+            for session in self.sessions.get(self.active_room, ()):
+                if session.streaming:
+                    self.halting_sessions.add(session)
+            if self.halting_sessions:
+                self.position_known.clear()
+            self.stream_start = None
+        self.active_room = room
+        if room == self.standby_room:
+            # its clients keep the stream they have queued
+            self.end_standby()
+        else:
+            self.update_room_events()
+
+    def keeps_timeline(self, room):
+        """
+        :return bool: whether a switch to room carries on the listener's timeline instead of halting the
+            active room and scheduling a new one. The standby room follows it already, and has to carry it
+            on, or the rooms prepared after it would have no stream to follow and wait until the next full
+            NEW_STREAM start. Room 0, no room at all, is never on standby
+        """
+        return room != 0 and room == self.standby_room and self.stream_start is not None
+
+    def set_standby_room(self, room):
+        """
+        Prepares the room the listener is likely to walk into next for STANDBY_SECONDS. Its clients are
+        sent the listener's stream muted, in step with the room being heard, so a switch to it only takes
+        a START instead of a NEW_STREAM and a preload round trip.
+        :param room: room number, ignored if it is the active room
+        """
+        if room == self.active_room or room not in self.room_events:
+            return
+        if self.standby_timer is not None:
+            self.standby_timer.cancel()
+        self.standby_timer = asyncio.get_event_loop().call_later(STANDBY_SECONDS, self.end_standby)
+        if room != self.standby_room:
+            print(f"Server: preparing room {room}")
+            self.standby_room = room
+            self.update_room_events()
+
+    def end_standby(self):
+        """Stops preparing the standby room, its clients are halted unless it became the active room"""
+        if self.standby_timer is not None:
+            self.standby_timer.cancel()
+            self.standby_timer = None
+        self.standby_room = 0
+        self.update_room_events()
+
+    def update_room_events(self):
+        """Sets the events of the active and the standby room, clears the others and wakes every session"""
+        for event_room, event in self.room_events.items():
+            if event_room in (self.active_room, self.standby_room):
+                event.set()
+            else:
+                event.clear()
+        # wake sessions waiting on credit so the ones of the previous room send their HALT
+        for sessions in self.sessions.values():
+            for session in sessions:
+                session.wakeup.set()
+        for broadcast in self.broadcasts.values():
+            broadcast.wakeup.set()
+
+    def receive_location(self, room_conn):
+        """
+        Called by the event loop as soon as the location process sends a room decision through
+        room_conn. Applies every pending decision in order, see get_location().
+        :param room_conn: receiving end of the pipe shared with the location process
+        """
+        try:
+            while room_conn.poll():
+                kind, room, decided_at = room_conn.recv()
+                if kind == 'prepare':
+                    self.set_standby_room(room)
+                    continue
+                print(f"Server: room {room} decision arrived after "
+                      f"{(time.time() - decided_at) * 1000:.1f} ms")
+                self.set_active_room(room, decided_at)
+        except EOFError:
+            print("Server: location process exited")
+            asyncio.get_event_loop().remove_reader(room_conn.fileno())
+
+    async def serve(self, hostname, room_conn=None):
+        """
+        Listens on every room port and serves clients until cancelled. Clients may disconnect and
+        reconnect at any time without restarting the server.
+        :param hostname: host for the listening sockets to bind to
+        :param room_conn: optional receiving end of the pipe the location process sends its room
+            decisions through. Without it rooms are switched with set_active_room()
+        """
+        self.room_events = {room: asyncio.Event() for room in self.room_ports}
+        self.position_known = asyncio.Event()
+        self.position_known.set()
+        self.set_active_room(self.active_room)
+        if room_conn is not None:
+            # wake up on room decisions instead of polling for them
+            asyncio.get_event_loop().add_reader(room_conn.fileno(), self.receive_location, room_conn)
+        if self.transport != 'tcp':
+            self.datagram_sock = open_multicast_sender(MULTICAST_INTERFACE)
+
+        servers = []
+        for room, room_port in self.room_ports.items():
+            server = await asyncio.start_server(functools.partial(self.handle_client, room=room),
+                                                hostname, room_port)
+            servers.append(server)
+            print(f"server listening for room {room} on port {room_port}")
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+if __name__ == "__main__":
+    # one way pipe the location process hands its room decisions to the streaming server through
+    room_recv_conn, room_send_conn = multiprocessing.Pipe(duplex=False)
+    location_process = multiprocessing.Process(name='location_process', target=get_location,
+                                               args=(room_send_conn,))
     location_process.start()
-    stream_process.start()
\ No newline at end of file
+
+    stream_server = StreamServer(ROOM_PORTS, PLAYLIST)
+    asyncio.run(stream_server.serve(host, room_recv_conn))
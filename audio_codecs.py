@@ -0,0 +1,214 @@
+import struct
+import sys
+import time
+import wave
+from enum import IntEnum
+import numpy as np
+
+# number of samples of one channel bit-packed with the same width by the DeltaCodec. A multiple of 8 so
+# every block packs into whole bytes
+BLOCK_LEN = 256
+# number of frames at the start of a DeltaCodec payload (uint32)
+NUM_FRAMES = struct.Struct('<I')
+NUM_FRAMES_LEN = NUM_FRAMES.size
+# mu of the mu-law companding curve
+MULAW_MU = 255
+
+
+class Codec(IntEnum):
+    """Codec ids sent in NEW_STREAM. HELLO advertises the codecs a client decodes as a bitmask of 1 << id"""
+    PCM = 0
+    DELTA = 1
+    MULAW = 2
+
+
+class PcmCodec:
+    codec_id = Codec.PCM
+    lossless = True
+
+    def __init__(self, channels, sample_width):
+        """
+        PcmCodec: sends samples as they are. Lets the server send straight from the file.
+        :param channels: number of interleaved channels
+        :param sample_width: bytes per sample
+        """
+        self.channels = channels
+        self.sample_width = sample_width
+
+    def encode(self, pcm):
+        """
+        :param pcm: bytes-like interleaved samples of whole frames
+        :return: bytes-like payload
+        """
+        return pcm
+
+    def decode(self, data):
+        """
+        :param data: bytes-like payload returned by encode()
+        :return: bytes-like samples, indexed by byte
+        """
+        return data
+
+
+class DeltaCodec(PcmCodec):
+    codec_id = Codec.DELTA
+    lossless = True
+
+    def __init__(self, channels, sample_width=2):
+        """
+        DeltaCodec: lossless codec for 16 bit PCM in the style of FLAC's fixed predictors. Each channel is
+        predicted from its previous two samples, the residuals are zigzag encoded to unsigned ints and each
+        block of BLOCK_LEN residuals is bit-packed with the fewest bits its largest residual needs. Blocks
+        of the same width are packed together so everything is vectorized.
+        Payload: number of frames (NUM_FRAMES), the width of every block (uint8 each), then the
+        packed blocks in order.
+        :param channels: number of interleaved channels
+        :param sample_width: bytes per sample, must be 2
+        """
+        if sample_width != 2:
+            raise ValueError(f"DeltaCodec only supports 16 bit samples, not {8 * sample_width} bit")
+        super().__init__(channels, sample_width)
+
+    def encode(self, pcm):
+        samples = np.frombuffer(pcm, dtype='<i2').reshape(-1, self.channels).astype(np.int32)
+        num_frames = len(samples)
+        # second order residuals x[i] - 2x[i-1] + x[i-2], undone by two cumulative sums
+        residuals = np.diff(np.diff(samples, axis=0, prepend=0), axis=0, prepend=0)
+        # zigzag so small negative residuals become small unsigned ints, one channel after the other
+        unsigned = ((residuals << 1) ^ (residuals >> 31)).astype(np.uint32).T.ravel()
+        num_blocks = -(-len(unsigned) // BLOCK_LEN)
+        blocks = np.zeros(num_blocks * BLOCK_LEN, dtype=np.uint32)
+        blocks[:len(unsigned)] = unsigned
+        blocks = blocks.reshape(num_blocks, BLOCK_LEN)
+        widths = np.ceil(np.log2(blocks.max(axis=1).astype(np.float64) + 1)).astype(np.uint8)
+        # each block packs into BLOCK_LEN * width bits
+        block_lens = widths.astype(np.int64) * (BLOCK_LEN // 8)
+        header_len = NUM_FRAMES_LEN + num_blocks
+        offsets = header_len + np.cumsum(block_lens) - block_lens
+        out = np.empty(header_len + int(block_lens.sum()), dtype=np.uint8)
+        NUM_FRAMES.pack_into(out, 0, num_frames)
+        out[NUM_FRAMES_LEN:header_len] = widths
+        for width in np.unique(widths):
+            if width == 0:
+                continue
+            selected = widths == width
+            bits = (blocks[selected][:, :, None] >> np.arange(width, dtype=np.uint32)) & 1
+            packed = np.packbits(bits.astype(np.uint8).reshape(len(bits), -1), axis=1, bitorder='little')
+            out[offsets[selected][:, None] + np.arange(packed.shape[1])] = packed
+        return out.data
+
+    def decode(self, data):
+        data = np.frombuffer(data, dtype=np.uint8)
+        num_frames = NUM_FRAMES.unpack_from(data, 0)[0]
+        num_blocks = -(-num_frames * self.channels // BLOCK_LEN)
+        header_len = NUM_FRAMES_LEN + num_blocks
+        widths = data[NUM_FRAMES_LEN:header_len]
+        block_lens = widths.astype(np.int64) * (BLOCK_LEN // 8)
+        offsets = header_len + np.cumsum(block_lens) - block_lens
+        blocks = np.zeros((num_blocks, BLOCK_LEN), dtype=np.int64)
+        for width in np.unique(widths):
+            if width == 0:
+                continue
+            selected = widths == width
+            packed = data[offsets[selected][:, None] + np.arange(BLOCK_LEN // 8 * int(width))]
+            bits = np.unpackbits(packed, axis=1, bitorder='little').reshape(len(packed), BLOCK_LEN, width)
+            blocks[selected] = (bits.astype(np.int64) << np.arange(width, dtype=np.int64)).sum(axis=2)
+        unsigned = blocks.ravel()[:num_frames * self.channels]
+        residuals = (unsigned >> 1) ^ -(unsigned & 1)
+        samples = np.cumsum(np.cumsum(residuals.reshape(self.channels, num_frames).T, axis=0), axis=0)
+        return samples.astype('<i2', order='C').view(np.uint8).reshape(-1).data
+
+
+class MulawCodec(PcmCodec):
+    codec_id = Codec.MULAW
+    lossless = False
+
+    def __init__(self, channels, sample_width=2):
+        """
+        MulawCodec: lossy codec companding 16 bit PCM to 8 bit mu-law like G.711, halving the bitrate for
+        barely any CPU.
+        :param channels: number of interleaved channels
+        :param sample_width: bytes per sample, must be 2
+        """
+        if sample_width != 2:
+            raise ValueError(f"MulawCodec only supports 16 bit samples, not {8 * sample_width} bit")
+        super().__init__(channels, sample_width)
+
+    def encode(self, pcm):
+        samples = np.frombuffer(pcm, dtype='<i2') / 32768.
+        companded = np.sign(samples) * np.log1p(MULAW_MU * np.abs(samples)) / np.log1p(MULAW_MU)
+        return np.rint(companded * 127).astype(np.int8).view(np.uint8).data
+
+    def decode(self, data):
+        companded = np.frombuffer(data, dtype=np.int8) / 127.
+        samples = np.sign(companded) * np.expm1(np.abs(companded) * np.log1p(MULAW_MU)) / MULAW_MU
+        return np.clip(np.rint(samples * 32768), -32768, 32767).astype('<i2').view(np.uint8).data
+
+
+CODECS = {codec.codec_id: codec for codec in (PcmCodec, DeltaCodec, MulawCodec)}
+# bitmask of every codec in CODECS
+ALL_CODECS = sum(1 << codec_id for codec_id in CODECS)
+
+
+def make_codec(codec_id, channels, sample_width):
+    """
+    :param codec_id: Codec of the stream
+    :param channels: number of interleaved channels
+    :param sample_width: bytes per sample
+    :return: codec object with encode(pcm) and decode(data) methods
+    """
+    return CODECS[codec_id](channels, sample_width)
+
+
+def choose_codec(preference, client_codecs, sample_width):
+    """
+    Picks the codec of a stream.
+    :param preference: Codecs in the order the server would rather use them
+    :param client_codecs: bitmask of the Codecs the client decodes
+    :param sample_width: bytes per sample of the track
+    :return Codec: the first preferred codec the client decodes that supports the track, PCM if none
+    """
+    for codec_id in preference:
+        if client_codecs & (1 << codec_id) and (codec_id == Codec.PCM or sample_width == 2):
+            return Codec(codec_id)
+    return Codec.PCM
+
+
+def benchmark(path, frames_per_chunk=16384):
+    """
+    Encodes and decodes a wave file chunk by chunk with every codec and prints the bitrate each one
+    streams at and how many seconds of audio it encodes and decodes per second of CPU time. Run on the
+    Raspberry Pi to see whether the bandwidth saved is worth its CPU.
+    :param path: path of a 16 bit wave file
+    :param frames_per_chunk: frames encoded at a time, like the frames in a STREAM_RSP
+    """
+    with wave.open(path, 'rb') as wf:
+        channels = wf.getnchannels()
+        sample_width = wf.getsampwidth()
+        framerate = wf.getframerate()
+        pcm = wf.readframes(wf.getnframes())
+    chunk_len = frames_per_chunk * channels * sample_width
+    chunks = [memoryview(pcm)[pos:pos + chunk_len] for pos in range(0, len(pcm), chunk_len)]
+    audio_seconds = len(pcm) / (channels * sample_width * framerate)
+    print(f"{path}: {audio_seconds:.1f} s, {channels} channels, {8 * sample_width} bit, {framerate} Hz")
+    print(f"{'codec':8} {'kbit/s':>8} {'ratio':>6} {'encode x':>9} {'decode x':>9} {'SNR dB':>7}")
+    reference = np.frombuffer(pcm, dtype='<i2').astype(np.float64)
+    for codec_class in CODECS.values():
+        codec = codec_class(channels, sample_width)
+        start = time.perf_counter()
+        encoded = [codec.encode(chunk) for chunk in chunks]
+        encode_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = b''.join(bytes(codec.decode(data)) for data in encoded)
+        decode_seconds = time.perf_counter() - start
+        num_bytes = sum(len(data) for data in encoded)
+        error = np.frombuffer(decoded, dtype='<i2') - reference
+        error_energy = np.sum(error ** 2)
+        snr = 10 * np.log10(np.sum(reference ** 2) / error_energy) if error_energy else float('inf')
+        print(f"{codec.codec_id.name:8} {8 * num_bytes / audio_seconds / 1000:8.0f} "
+              f"{len(pcm) / num_bytes:6.2f} {audio_seconds / max(encode_seconds, 1e-9):9.0f} "
+              f"{audio_seconds / max(decode_seconds, 1e-9):9.0f} {snr:7.1f}")
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else 'wave_files/a_boogie.wav')
@@ -0,0 +1,137 @@
+import numpy as np
+
+# number of taps of the low-pass filter applied before lowering the sample rate
+RESAMPLE_TAPS = 63
+# cutoff of that filter as a fraction of the new Nyquist frequency, leaving room for its transition band
+RESAMPLE_CUTOFF = .9
+
+
+def pcm_to_float(pcm, sample_width, channels):
+    """
+    Converts interleaved PCM samples as stored in wave files to floats.
+    :param pcm: bytes-like samples of whole frames
+    :param sample_width: bytes per sample, 1 (unsigned) or 2, 3 or 4 (signed little endian)
+    :param channels: number of interleaved channels
+    :return np.ndarray: float32 samples in [-1, 1) of shape (frames, channels)
+    """
+    data = np.frombuffer(pcm, dtype=np.uint8)
+    if sample_width == 1:
+        samples = (data.astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        samples = data.view('<i2') / np.float32(1 << 15)
+    elif sample_width == 3:
+        # place the 3 bytes in the top of an int32 so the sign comes along
+        padded = np.zeros((len(data) // 3, 4), dtype=np.uint8)
+        padded[:, 1:] = data.reshape(-1, 3)
+        samples = padded.view('<i4').ravel() / np.float32(1 << 31)
+    elif sample_width == 4:
+        samples = data.view('<i4') / np.float32(1 << 31)
+    else:
+        raise ValueError(f"unsupported sample width {sample_width}")
+    return samples.astype(np.float32).reshape(-1, channels)
+
+
+def float_to_pcm(samples, sample_width):
+    """
+    Converts float samples to interleaved PCM as stored in wave files, clipping anything out of range.
+    :param samples: np.ndarray of shape (frames, channels)
+    :param sample_width: bytes per sample, 1, 2, 3 or 4
+    :return bytes: the PCM samples
+    """
+    samples = np.clip(samples.ravel().astype(np.float64), -1., 1.)
+    if sample_width == 1:
+        return np.clip(np.rint(samples * 128 + 128), 0, 255).astype(np.uint8).tobytes()
+    if sample_width == 2:
+        return np.clip(np.rint(samples * (1 << 15)), -(1 << 15), (1 << 15) - 1).astype('<i2').tobytes()
+    if sample_width in (3, 4):
+        ints = np.clip(np.rint(samples * (1 << 31)), -(1 << 31), (1 << 31) - 1).astype('<i4')
+        if sample_width == 4:
+            return ints.tobytes()
+        # keep the top 3 bytes of each little endian int32
+        return ints.view(np.uint8).reshape(-1, 4)[:, 1:].tobytes()
+    raise ValueError(f"unsupported sample width {sample_width}")
+
+
+def downmix(samples, channels):
+    """
+    Mixes samples down to fewer channels. Output channel i averages input channels i, i + channels, ...
+    so stereo becomes mono by averaging left and right.
+    :param samples: np.ndarray of shape (frames, input channels)
+    :param channels: number of output channels, at most the number of input channels
+    :return np.ndarray: samples of shape (frames, channels)
+    """
+    if channels == samples.shape[1]:
+        return samples
+    return np.stack([samples[:, i::channels].mean(axis=1) for i in range(channels)], axis=1)
+
+
+def lowpass(samples, cutoff, num_taps=RESAMPLE_TAPS):
+    """
+    Filters every channel with a Hamming windowed-sinc FIR filter.
+    :param samples: np.ndarray of shape (frames, channels)
+    :param cutoff: cutoff frequency in cycles per sample, below .5
+    :param num_taps: odd number of filter taps
+    :return np.ndarray: filtered samples of the same shape
+    """
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(num_taps)
+    taps = (taps / taps.sum()).astype(np.float32)
+    return np.stack([np.convolve(samples[:, i], taps, mode='same') for i in range(samples.shape[1])],
+                    axis=1)
+
+
+def resample(samples, rate, new_rate):
+    """
+    Changes the sample rate by linear interpolation, low-pass filtering first when lowering the rate so
+    frequencies above the new Nyquist frequency don't alias.
+    :param samples: np.ndarray of shape (frames, channels)
+    :param rate: sample rate of samples
+    :param new_rate: sample rate to convert to
+    :return np.ndarray: samples at new_rate, of shape (frames * new_rate / rate, channels)
+    """
+    if rate == new_rate or len(samples) == 0:
+        return samples
+    if new_rate < rate:
+        samples = lowpass(samples, RESAMPLE_CUTOFF * new_rate / (2 * rate))
+    num_frames = len(samples) * new_rate // rate
+    positions = np.arange(num_frames) * (rate / new_rate)
+    frames = np.arange(len(samples))
+    return np.stack([np.interp(positions, frames, samples[:, i]) for i in range(samples.shape[1])],
+                    axis=1).astype(np.float32)
+
+
+def convert_pcm(pcm, sample_width, channels, rate, new_sample_width, new_channels, new_rate):
+    """
+    Converts PCM samples to another sample width, channel count and sample rate.
+    :param pcm: bytes-like interleaved samples of whole frames
+    :param sample_width: bytes per sample of pcm
+    :param channels: number of channels of pcm
+    :param rate: sample rate of pcm
+    :param new_sample_width: bytes per sample to convert to
+    :param new_channels: number of channels to convert to, at most channels
+    :param new_rate: sample rate to convert to
+    :return bytes: the converted PCM samples
+    """
+    samples = pcm_to_float(pcm, sample_width, channels)
+    samples = downmix(samples, new_channels)
+    samples = resample(samples, rate, new_rate)
+    return float_to_pcm(samples, new_sample_width)
+
+
+def conceal_loss(previous, num_frames, sample_width, channels, fade_frames):
+    """
+    Makes up audio for frames that were lost by repeating the audio received before the loss while
+    fading it out, which sounds like a short dip instead of the click of a sudden silence.
+    :param previous: bytes-like PCM received before the loss, whole frames. Silence if empty
+    :param num_frames: number of frames lost
+    :param sample_width: bytes per sample
+    :param channels: number of interleaved channels
+    :param fade_frames: frames over which the repeated audio fades to silence
+    :return bytes: num_frames frames of PCM
+    """
+    samples = pcm_to_float(previous, sample_width, channels)
+    if len(samples) == 0:
+        samples = np.zeros((1, channels), dtype=np.float32)
+    repeated = np.resize(samples, (num_frames, channels))
+    gain = np.clip(1 - np.arange(num_frames, dtype=np.float32) / fade_frames, 0, 1)
+    return float_to_pcm(repeated * gain[:, None], sample_width)
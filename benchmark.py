@@ -0,0 +1,369 @@
+import argparse
+import asyncio
+import contextlib
+import functools
+import json
+import multiprocessing as mp
+import os
+import queue
+import sys
+import threading
+import time
+import numpy as np
+import null_audio
+
+# Streams over localhost with the real StreamServer and client.Client, without a Pi, beacons or speakers.
+# Clients play into null_audio sinks consuming audio at the real-time rate, and the location process
+# classifies scripted RSSI readings of a listener walking from room to room. Must be in place before
+# client and Final_Server import pyaudio
+sys.modules['pyaudio'] = null_audio
+
+import client
+import Final_Server
+from location import LocationTracker, ReplayScanSource
+from ring_buffer import AudioRingBuffer, RING_CAPACITY
+
+# tracks streamed, the one wave file in the repository
+PLAYLIST = ['wave_files/Ensoniq-ZR-76-Uprite-Bass-C2.wav']
+# room r is served on BASE_PORT + r
+BASE_PORT = 9100
+# seconds the listener stays in each room. Long enough for the location process's switch rate limits
+ROOM_SECONDS = 12.
+# seconds the clients get to connect before the listener starts walking
+CONNECT_SECONDS = 1.
+# seconds between the reports of the client and sink processes
+REPORT_INTERVAL = .5
+
+# scripted RSSI (dBm) of the beacon of the room the listener is in and of the other beacons, the noise
+# added to every reading and the seconds between the advertisements of each beacon
+NEAR_RSSI = -45.
+FAR_RSSI = -85.
+RSSI_NOISE = 3.
+ADVERTISING_INTERVAL = .1
+# half the width of the RSSI ranges of the scripted rooms, see location.RoomClassifier
+RSSI_RANGE = 15.
+
+# results compared against a baseline: key, heading, format and whether bigger is better
+METRICS = (
+    ('kbytes_per_second', 'kB/s', '{:.0f}', True),
+    ('realtime_ratio', 'x realtime', '{:.2f}', True),
+    ('req_rsp_p50_ms', 'req p50 ms', '{:.1f}', False),
+    ('req_rsp_p90_ms', 'req p90 ms', '{:.1f}', False),
+    ('req_rsp_p99_ms', 'req p99 ms', '{:.1f}', False),
+    ('underruns', 'underruns', '{:.0f}', False),
+    ('switch_p50_ms', 'switch p50 ms', '{:.0f}', False),
+    ('switch_max_ms', 'switch max ms', '{:.0f}', False),
+    ('walk_p50_ms', 'walk p50 ms', '{:.0f}', False),
+    ('server_cpu', 'server CPU %', '{:.1f}', False),
+    ('speaker_cpu', 'speaker CPU %', '{:.1f}', False),
+)
+
+
+def scripted_walk(num_rooms, room_seconds, noise=RSSI_NOISE, seed=0):
+    """
+    Scripts the advertisements of a listener walking through rooms 1 to num_rooms, staying room_seconds
+    in each. Every room has a beacon of its own that reads NEAR_RSSI in it and FAR_RSSI elsewhere.
+    :return: (recording for location.ReplayScanSource, beacon addresses, rooms_dict classifying it)
+    """
+    rng = np.random.default_rng(seed)
+    beacons = [f'00:00:00:00:00:{room:02x}' for room in range(1, num_rooms + 1)]
+    recording = []
+    for seconds in np.arange(0., num_rooms * room_seconds, ADVERTISING_INTERVAL):
+        room = int(seconds // room_seconds) + 1
+        for beacon_room, addr in enumerate(beacons, 1):
+            rssi = NEAR_RSSI if beacon_room == room else FAR_RSSI
+            recording.append((float(seconds), addr, float(rssi + rng.normal(0., noise))))
+    rooms_dict = {room: [[[rssi + RSSI_RANGE, rssi - RSSI_RANGE]
+                          for rssi in (NEAR_RSSI if beacon_room == room else FAR_RSSI
+                                       for beacon_room in range(1, num_rooms + 1))]]
+                  for room in range(1, num_rooms + 1)}
+    return recording, beacons, rooms_dict
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) else float('nan')
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    """Silences the prints of the server, clients and location process unless verbose"""
+    if verbose:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+class BenchClient(client.Client):
+    def __init__(self, hostname, portname, comm_ring, comm_arr, comm_val, speaker=None, stats=None):
+        """
+        BenchClient: a Client reporting its stream to the benchmark every REPORT_INTERVAL seconds.
+        :param speaker: (room, index) of the speaker it plays on
+        :param stats: multiprocessing.Queue the reports are put on
+        """
+        super().__init__(hostname, portname, comm_ring, comm_arr, comm_val)
+        self.speaker = speaker
+        self.stats = stats
+        # seconds from the STREAM_REQ granting each chunk received since the last report to its arrival
+        self.delays = []
+        self.next_report = time.time() + REPORT_INTERVAL
+
+    def queue_stream_frames(self):
+        # the jitter buffer times every granted chunk, oldest first
+        if len(self.msg_body) and self.jitter.requested_at:
+            self.delays.append(time.time() - self.jitter.requested_at[0])
+        super().queue_stream_frames()
+
+    def sync_clock(self):
+        # called on every pass of the Client process's loop
+        super().sync_clock()
+        now = time.time()
+        if now >= self.next_report:
+            self.report(now)
+
+    def report(self, now):
+        """Reports the bytes queued so far, the underruns and CPU time so far and the new delays"""
+        params = self.cur_stream_info['params']
+        # bytes of decoded audio played per second
+        realtime = self.cur_stream_info['frame_len'] / params[3] * params[2] if params else 0.
+        self.stats.put(('client', self.speaker, now, self.comm_ring.written(), self.comm_ring.underruns(),
+                        realtime, self.delays, time.process_time()))
+        self.delays = []
+        self.next_report = now + REPORT_INTERVAL
+
+
+def client_process(comm_ring, comm_arr, comm_val, port, speaker, stats, verbose):
+    """Entry point of the process communicating with the Server for a speaker"""
+    with quiet(verbose):
+        client.client_process(comm_ring, comm_arr, comm_val, '127.0.0.1', port,
+                              functools.partial(BenchClient, speaker=speaker, stats=stats))
+
+
+def sink_process(comm_ring, comm_arr, comm_val, speaker, stats, verbose):
+    """
+    Entry point of the AudioStream process of a speaker, playing into a null sink. Reports the time every
+    stretch of silence (a halted, muted or not yet started stream) becomes audible.
+    """
+    audible = False
+
+    def on_play(stream, data, played_at):
+        nonlocal audible
+        nonzero = np.flatnonzero(np.frombuffer(data, dtype=np.uint8))
+        if len(nonzero) and not audible:
+            stats.put(('audible', speaker, played_at + nonzero[0] // stream.frame_size / stream.rate))
+        audible = len(nonzero) > 0
+
+    def report_cpu():
+        while True:
+            time.sleep(REPORT_INTERVAL)
+            stats.put(('sink', speaker, time.process_time()))
+
+    threading.Thread(target=report_cpu, daemon=True).start()
+    client.py_audio = null_audio.PyAudio(on_play)
+    with quiet(verbose):
+        client.audio_stream_process(comm_ring, comm_arr, comm_val)
+
+
+def location_process(room_conn, num_rooms, room_seconds, verbose):
+    """Entry point of the location process, classifying the scripted walk instead of scanning"""
+    recording, beacons, rooms_dict = scripted_walk(num_rooms, room_seconds)
+    with quiet(verbose):
+        Final_Server.get_location(room_conn, ReplayScanSource(recording), LocationTracker(beacons, rooms_dict))
+
+
+class BenchServer(Final_Server.StreamServer):
+    def __init__(self, *args, **kwargs):
+        """BenchServer: a StreamServer recording when each room switch was decided"""
+        super().__init__(*args, **kwargs)
+        # (room, decided_at) of every switch
+        self.switches = []
+
+    def set_active_room(self, room, decided_at=None):
+        if room != self.active_room:
+            self.switches.append((room, time.time() if decided_at is None else decided_at))
+        super().set_active_room(room, decided_at)
+
+
+def summarize(num_rooms, room_seconds, reports, switches, walk_start, wall_seconds, server_cpu):
+    """
+    :param reports: every report of the client and sink processes, in the order they arrived
+    :param switches: (room, decided_at) of every room switch
+    :return dict: the results of a run, keyed like METRICS, plus the throughput of each room
+    """
+    # throughput of each speaker over the intervals it streamed in, taking the median so the preload
+    # bursts after a switch don't count
+    last = {}
+    rates = {}
+    realtimes = {}
+    delays = []
+    underruns = {}
+    cpu = {}
+    audible = {}
+    for kind, speaker, *fields in reports:
+        if kind == 'client':
+            now, written, speaker_underruns, realtime, speaker_delays, client_cpu = fields
+            if speaker in last:
+                then, then_written = last[speaker]
+                num_bytes = (written - then_written) % (1 << 32)
+                if num_bytes and now > then:
+                    rates.setdefault(speaker, []).append(num_bytes / (now - then))
+                    realtimes.setdefault(speaker, []).append(realtime)
+            last[speaker] = now, written
+            delays += speaker_delays
+            underruns[speaker] = speaker_underruns
+            cpu[speaker, 'client'] = client_cpu
+        elif kind == 'sink':
+            cpu[speaker, 'sink'] = fields[0]
+        else:
+            audible.setdefault(speaker[0], []).append((speaker, fields[0]))
+
+    room_rates = {room: float(np.median([rate for speaker, speaker_rates in rates.items() if speaker[0] == room
+                                         for rate in speaker_rates] or [0.]))
+                  for room in range(1, num_rooms + 1)}
+    ratios = [np.median(speaker_rates) / np.median(realtimes[speaker])
+              for speaker, speaker_rates in rates.items() if np.median(realtimes[speaker])]
+    # each switch takes until every speaker of the new room is audible
+    switch_ms = []
+    walk_ms = []
+    for room, decided_at in switches:
+        first = {}
+        for speaker, audible_at in audible.get(room, ()):
+            if audible_at >= decided_at and speaker not in first:
+                first[speaker] = audible_at
+        if not first:
+            continue
+        heard_at = max(first.values())
+        switch_ms.append((heard_at - decided_at) * 1000)
+        walk_ms.append((heard_at - walk_start - (room - 1) * room_seconds) * 1000)
+    num_speakers = len(last) or 1
+    return {
+        'rooms': num_rooms,
+        'room_kbytes_per_second': {str(room): rate / 1000 for room, rate in room_rates.items()},
+        'kbytes_per_second': min(room_rates.values()) / 1000,
+        'realtime_ratio': float(min(ratios)) if ratios else float('nan'),
+        'req_rsp_p50_ms': percentile(delays, 50) * 1000,
+        'req_rsp_p90_ms': percentile(delays, 90) * 1000,
+        'req_rsp_p99_ms': percentile(delays, 99) * 1000,
+        'underruns': sum(underruns.values()),
+        'switch_p50_ms': percentile(switch_ms, 50),
+        'switch_max_ms': max(switch_ms, default=float('nan')),
+        'walk_p50_ms': percentile(walk_ms, 50),
+        'server_cpu': server_cpu / wall_seconds * 100,
+        'speaker_cpu': sum(cpu.values()) / num_speakers / wall_seconds * 100,
+    }
+
+
+async def run_rooms(num_rooms, args):
+    """
+    Serves num_rooms rooms of args.speakers speakers each while the listener walks through all of them.
+    :return dict: the results, see summarize()
+    """
+    stats = mp.Queue()
+    room_ports = {room: args.port + room for room in range(1, num_rooms + 1)}
+    server = BenchServer(room_ports, args.playlist, repeat=True, transport=args.transport)
+    room_recv_conn, room_send_conn = mp.Pipe(duplex=False)
+    serve_task = asyncio.ensure_future(server.serve('127.0.0.1', room_recv_conn))
+    await asyncio.sleep(.1)
+
+    rings = []
+    processes = []
+    for room, room_port in room_ports.items():
+        for index in range(args.speakers):
+            comm_ring = AudioRingBuffer(RING_CAPACITY)
+            comm_arr = mp.Array('d', 7)
+            comm_val = client.SharedMsg()
+            speaker = room, index
+            rings.append(comm_ring)
+            processes.append(mp.Process(target=client_process, args=(comm_ring, comm_arr, comm_val, room_port,
+                                                                     speaker, stats, args.verbose)))
+            processes.append(mp.Process(target=sink_process, args=(comm_ring, comm_arr, comm_val, speaker,
+                                                                   stats, args.verbose)))
+    for process in processes:
+        process.start()
+    await asyncio.sleep(CONNECT_SECONDS)
+
+    location = mp.Process(target=location_process, args=(room_send_conn, num_rooms, args.room_seconds,
+                                                          args.verbose))
+    reports = []
+    walk_start = time.time()
+    server_start = time.process_time()
+    location.start()
+    while time.time() < walk_start + num_rooms * args.room_seconds:
+        await asyncio.sleep(REPORT_INTERVAL)
+        with contextlib.suppress(queue.Empty):
+            while True:
+                reports.append(stats.get_nowait())
+    wall_seconds = time.time() - walk_start
+    server_cpu = time.process_time() - server_start
+
+    for process in processes + [location]:
+        process.terminate()
+        process.join()
+    serve_task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await serve_task
+    for comm_ring in rings:
+        comm_ring.close()
+        comm_ring.unlink()
+    return summarize(num_rooms, args.room_seconds, reports, server.switches, walk_start, wall_seconds,
+                     server_cpu)
+
+
+def print_results(results, baseline=None):
+    """Prints a line per number of rooms, with the change from the baseline run of as many rooms"""
+    baseline = {result['rooms']: result for result in baseline or ()}
+    print(f"{'rooms':>5} " + ' '.join(f'{heading:>14}' for key, heading, form, bigger in METRICS))
+    for result in results:
+        print(f"{result['rooms']:>5} " + ' '.join(f'{form.format(result[key]):>14}'
+                                                 for key, heading, form, bigger in METRICS))
+        base = baseline.get(result['rooms'])
+        if base is None:
+            continue
+        changes = []
+        for key, heading, form, bigger in METRICS:
+            if base[key] and np.isfinite(base[key]) and np.isfinite(result[key]):
+                change = (result[key] - base[key]) / abs(base[key]) * 100
+                # marks changes for the worse
+                worse = '!' if (change < 0) == bigger and abs(change) >= 1 else ' '
+                changes.append(f'{change:+13.0f}%{worse}'[-14:])
+            else:
+                changes.append(f'{"-":>14}')
+        print(f"{'vs':>5} " + ' '.join(changes))
+    for result in results:
+        print(f"{result['rooms']} rooms, kB/s per room: " + ', '.join(
+            f'{room}: {rate:.0f}' for room, rate in result['room_kbytes_per_second'].items()))
+
+
+def benchmark(args):
+    results = []
+    for num_rooms in range(1, args.rooms + 1):
+        print(f"{num_rooms} rooms of {args.speakers} speakers over {args.transport}, "
+              f"{num_rooms * args.room_seconds:.0f} s")
+        with quiet(args.verbose):
+            results.append(asyncio.run(run_rooms(num_rooms, args)))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'transport': args.transport, 'speakers': args.speakers, 'room_seconds': args.room_seconds,
+                       'results': results}, f, indent=1)
+        print(f"saved to {args.save}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures streaming throughput and latency end to end over "
+                                                 "localhost, from 1 room up to --rooms rooms")
+    parser.add_argument('--rooms', type=int, default=3, help="most rooms served at once")
+    parser.add_argument('--speakers', type=int, default=1, help="speakers (clients) in each room")
+    parser.add_argument('--room-seconds', type=float, default=ROOM_SECONDS,
+                        help="seconds the listener stays in each room")
+    parser.add_argument('--transport', choices=('tcp', 'udp', 'multicast'), default=Final_Server.TRANSPORT)
+    parser.add_argument('--playlist', nargs='+', default=PLAYLIST)
+    parser.add_argument('--port', type=int, default=BASE_PORT, help="room r is served on port + r")
+    parser.add_argument('--save', help="write the results to this JSON file, e.g. as the baseline")
+    parser.add_argument('--baseline', help="JSON file of an earlier run to compare against")
+    parser.add_argument('--verbose', action='store_true', help="show the prints of the system under test")
+    benchmark(parser.parse_args())
@@ -0,0 +1,44 @@
+from bluepy.btle import Scanner, DefaultDelegate
+
+# seconds each Scanner.process() call listens for before checking whether to stop
+SCAN_PROCESS_INTERVAL = .2
+
+
+class ScanDelegate(DefaultDelegate):
+    def __init__(self, push):
+        """
+        ScanDelegate: hands every advertisement bluepy receives to push, including repeated ones whose
+        only change is their RSSI.
+        :param push: function taking (addr, rssi)
+        """
+        DefaultDelegate.__init__(self)
+        self.push = push
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        self.push(dev.addr, dev.rssi)
+
+
+class BluepyScanSource:
+    def __init__(self, passive=False):
+        """
+        BluepyScanSource: scans continuously with bluepy's Scanner.start()/process()/stop() instead of
+        blocking in fixed Scanner.scan() windows. Must be run with sudo.
+        :param passive: scan passively (don't send scan requests to the beacons)
+        """
+        self.passive = passive
+
+    def run(self, push, stop_event):
+        """
+        Scans until stop_event is set, passing each advertisement to push as soon as it arrives.
+        :param push: function taking (addr, rssi)
+        :param stop_event: threading.Event
+        """
+        scanner = Scanner().withDelegate(ScanDelegate(push))
+        scanner.start(passive=self.passive)
+        try:
+            while not stop_event.is_set():
+                scanner.process(SCAN_PROCESS_INTERVAL)
+                # forget the devices seen so far so the scanner doesn't grow with every device around
+                scanner.clear()
+        finally:
+            scanner.stop()
@@ -0,0 +1,237 @@
+import time
+import numpy as np
+from location import RssiFilter, FingerprintClassifier
+
+# RSSI (dBm) of beacons that weren't heard at all, weaker readings count as it too
+RSSI_FLOOR = -100.
+# readings at the start of every take that aren't used, while the filters settle
+WARMUP_SECONDS = 2.
+# seconds between the fingerprints taken from a take. The smoothed readings barely change in between
+FINGERPRINT_INTERVAL = .25
+# variance (dB^2) each beacon of a room's Gaussian gets at least, so rooms recorded with steady readings
+# don't end up with needle thin distributions
+GAUSSIAN_VAR_FLOOR = 4.
+# readings more than this many standard deviations (root mean square over the beacons) from every room
+# are outside all rooms
+GAUSSIAN_OUTSIDE_Z = 3.
+# neighbours voting in the k-NN model
+KNN_K = 7
+# fingerprints labeled at a time while fitting, bounding the memory used
+FIT_BATCH = 1024
+
+
+class CalibrationSession:
+    def __init__(self, beacons):
+        """
+        CalibrationSession: labeled RSSI recordings of a floor. Each take records the advertisements of
+        the beacons for a while at one location, ideally walking around it, and the location is labeled
+        with the room it belongs to (0 for places outside every room like hallways). Every advertisement
+        is kept as a sample of (take, seconds into the take, beacon, RSSI), so sessions can be refitted
+        with other filters or models later. Saved as a compressed .npz of a few bytes per sample.
+        :param beacons: MAC addresses of the beacons recorded, others are ignored
+        """
+        self.beacons = list(beacons)
+        self.beacon_index = {addr: i for i, addr in enumerate(self.beacons)}
+        # name and room number of every location
+        self.locations = []
+        self.rooms = []
+        # location index of every take
+        self.takes = []
+        # (take, seconds, beacon index, rssi) of every advertisement
+        self.samples = []
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a session saved with save().
+        :param path: path of the .npz file
+        :return CalibrationSession: the session
+        """
+        with np.load(path) as data:
+            session = cls([str(addr) for addr in data['beacons']])
+            session.locations = [str(name) for name in data['locations']]
+            session.rooms = data['rooms'].tolist()
+            session.takes = data['takes'].tolist()
+            session.samples = list(zip(data['take'].tolist(), data['seconds'].tolist(),
+                                       data['beacon'].tolist(), data['rssi'].tolist()))
+        return session
+
+    def save(self, path):
+        """:param path: path of the .npz file to write"""
+        take, seconds, beacon, rssi = zip(*self.samples) if self.samples else ((), (), (), ())
+        np.savez_compressed(path, beacons=np.array(self.beacons), locations=np.array(self.locations),
+                            rooms=np.array(self.rooms, dtype=np.int16),
+                            takes=np.array(self.takes, dtype=np.uint16),
+                            take=np.array(take, dtype=np.uint16), seconds=np.array(seconds, dtype=np.float32),
+                            beacon=np.array(beacon, dtype=np.uint8), rssi=np.array(rssi, dtype=np.int8))
+
+    def location(self, name, room):
+        """
+        :param name: name of a location, e.g. 'kitchen by the window'
+        :param room: room number the location belongs to, 0 if it isn't in any room
+        :return int: index of the location, added if it is new
+        """
+        if name in self.locations:
+            index = self.locations.index(name)
+            if self.rooms[index] != room:
+                raise ValueError(f"location {name} was recorded as room {self.rooms[index]}, not {room}")
+            return index
+        self.locations.append(name)
+        self.rooms.append(room)
+        return len(self.locations) - 1
+
+    def record(self, scanner, name, room, seconds):
+        """
+        Records a take of a location from a running scanner.
+        :param scanner: started location.BackgroundScanner
+        :param name: name of the location
+        :param room: room number of the location
+        :param seconds: seconds to record for
+        :return dict: MAC address -> RssiFilter with the statistics of that beacon's readings in the take
+        """
+        location = self.location(name, room)
+        take = len(self.takes)
+        self.takes.append(location)
+        filters = {addr: RssiFilter() for addr in self.beacons}
+        start = time.time()
+        end_time = start + seconds
+        while time.time() < end_time:
+            reading = scanner.get(timeout=max(0., end_time - time.time()))
+            if reading is None or reading[0] not in self.beacon_index:
+                continue
+            addr, rssi, received_at = reading
+            filters[addr].update(rssi)
+            self.samples.append((take, received_at - start, self.beacon_index[addr], int(round(rssi))))
+        return filters
+
+    def fingerprints(self, beacons, filter_mode='ewma'):
+        """
+        Replays every take through the RssiFilters a LocationTracker smooths readings with, taking the
+        smoothed RSSI vector every FINGERPRINT_INTERVAL, so the model is fitted to what the tracker sees.
+        :param beacons: MAC addresses in the order of the vectors' columns
+        :param filter_mode: RssiFilter mode of the LocationTracker
+        :return: (vectors, rooms). vectors is an np.ndarray of shape (n, len(beacons)), RSSI_FLOOR for
+            beacons not heard yet, and rooms the room number of each vector
+        """
+        columns = [beacons.index(addr) if addr in beacons else -1 for addr in self.beacons]
+        vectors, rooms = [], []
+        current_take = None
+        for take, seconds, beacon, rssi in sorted(self.samples):
+            if take != current_take:
+                # every take starts from scratch, like the tracker does when the server starts
+                current_take = take
+                filters = [RssiFilter(filter_mode) for addr in beacons]
+                rssi_vector = np.full(len(beacons), RSSI_FLOOR)
+                next_time = WARMUP_SECONDS
+            column = columns[beacon]
+            if column < 0:
+                continue
+            rssi_vector[column] = filters[column].update(rssi)
+            if seconds >= next_time:
+                vectors.append(rssi_vector.copy())
+                rooms.append(self.rooms[self.takes[take]])
+                next_time = seconds + FINGERPRINT_INTERVAL
+        return np.array(vectors).reshape(-1, len(beacons)), np.array(rooms, dtype=int)
+
+
+class GaussianModel:
+    def __init__(self, vectors, rooms):
+        """
+        GaussianModel: models the fingerprints of each room as a Gaussian with independent beacons. A
+        reading belongs to the most likely room, with its posterior probability as confidence, unless it
+        is far from every room.
+        :param vectors: fingerprints of shape (n, num_beacons)
+        :param rooms: room number of each fingerprint
+        """
+        self.rooms = np.unique(rooms)
+        self.mean = np.array([vectors[rooms == room].mean(axis=0) for room in self.rooms])
+        self.var = np.array([np.maximum(vectors[rooms == room].var(axis=0), GAUSSIAN_VAR_FLOOR)
+                             for room in self.rooms])
+
+    def classify(self, points):
+        """
+        :param points: RSSI vectors of shape (n, num_beacons)
+        :return: (rooms, confidence) arrays of shape (n,)
+        """
+        z2 = (points[:, None, :] - self.mean) ** 2 / self.var
+        log_likelihood = -.5 * (z2 + np.log(2 * np.pi * self.var)).sum(axis=2)
+        posterior = np.exp(log_likelihood - log_likelihood.max(axis=1, keepdims=True))
+        posterior /= posterior.sum(axis=1, keepdims=True)
+        best = posterior.argmax(axis=1)
+        rooms = self.rooms[best]
+        confidence = posterior[np.arange(len(points)), best]
+        outside = np.sqrt(z2.mean(axis=2)).min(axis=1) > GAUSSIAN_OUTSIDE_Z
+        return np.where(outside, 0, rooms), np.where(outside, 0., confidence)
+
+
+class KnnModel:
+    def __init__(self, vectors, rooms, k=KNN_K):
+        """
+        KnnModel: a reading belongs to the room most of its k nearest fingerprints were recorded in, with
+        the share of their votes as confidence. Follows rooms of any shape, given enough fingerprints.
+        :param vectors: fingerprints of shape (n, num_beacons)
+        :param rooms: room number of each fingerprint
+        :param k: number of neighbours voting
+        """
+        self.rooms, self.labels = np.unique(rooms, return_inverse=True)
+        self.vectors = vectors
+        self.sq_norms = (vectors ** 2).sum(axis=1)
+        self.k = min(k, len(vectors))
+
+    def classify(self, points):
+        # squared distances without an (n, fingerprints, beacons) intermediate
+        distances = (points ** 2).sum(axis=1)[:, None] + self.sq_norms - 2 * points @ self.vectors.T
+        nearest = np.argpartition(distances, self.k - 1, axis=1)[:, :self.k]
+        votes = np.zeros((len(points), len(self.rooms)))
+        np.add.at(votes, (np.arange(len(points))[:, None], self.labels[nearest]), 1)
+        best = votes.argmax(axis=1)
+        return self.rooms[best], votes[np.arange(len(points)), best] / self.k
+
+
+MODELS = {'gaussian': GaussianModel, 'knn': KnnModel}
+
+
+def label_fingerprints(model, vectors, beacons, filter_mode='ewma'):
+    """
+    Labels every fingerprint with the room and confidence a fitted model gives it.
+    :param model: GaussianModel or KnnModel
+    :param vectors: fingerprints of shape (n, len(beacons))
+    :param beacons: MAC addresses of the beacons, in the order of the model's columns
+    :param filter_mode: RssiFilter mode the fingerprints were smoothed with
+    :return FingerprintClassifier: the classifier searching the labeled fingerprints
+    """
+    rooms = np.zeros(len(vectors), dtype=np.int16)
+    confidence = np.zeros(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), FIT_BATCH):
+        batch = slice(start, start + FIT_BATCH)
+        rooms[batch], confidence[batch] = model.classify(vectors[batch])
+    return FingerprintClassifier(beacons, vectors, rooms, confidence, RSSI_FLOOR, filter_mode)
+
+
+def fit_model(sessions, method='gaussian', filter_mode='ewma'):
+    """
+    Fits a fingerprint model to calibration sessions and labels the fingerprints with it.
+    :param sessions: CalibrationSessions, their beacons are combined
+    :param method: 'gaussian' or 'knn', see MODELS
+    :param filter_mode: RssiFilter mode of the LocationTracker the model is for
+    :return: (FingerprintClassifier, vectors, rooms) with the fingerprints it was fitted to
+    """
+    beacons = sorted({addr for session in sessions for addr in session.beacons})
+    fingerprints = [session.fingerprints(beacons, filter_mode) for session in sessions]
+    vectors = np.concatenate([vectors for vectors, rooms in fingerprints])
+    rooms = np.concatenate([rooms for vectors, rooms in fingerprints])
+    if len(vectors) == 0:
+        raise ValueError("the sessions have no fingerprints, record longer takes")
+    return label_fingerprints(MODELS[method](vectors, rooms), vectors, beacons, filter_mode), vectors, rooms
+
+
+def save_model(classifier, path):
+    """
+    Writes a model file for FingerprintClassifier.load().
+    :param classifier: FingerprintClassifier from fit_model()
+    :param path: path of the .npz file
+    """
+    np.savez_compressed(path, beacons=np.array(classifier.beacons), vectors=classifier.vectors,
+                        rooms=classifier.rooms.astype(np.int16),
+                        confidence=np.rint(classifier.confidence * 255).astype(np.uint8),
+                        rssi_floor=classifier.rssi_floor, filter_mode=classifier.filter_mode)
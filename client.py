@@ -1,52 +1,49 @@
+import asyncio
 import socket
+import sys
 import pyaudio
 import time
 import multiprocessing as mp
-from struct import *
 from enum import IntEnum, auto
+from protocol import ClientServerMsg, ProtocolError, CAP_DATAGRAMS, CAPABILITIES, PROTOCOL_MAGIC, \
+    PROTOCOL_VERSION, MSG_HEADER_LEN, HEADER, DURATION, CREDIT, TIMESTAMP, TIMESTAMP_LEN, TIME_RSP, START_FRAME, \
+    HELLO, NEW_STREAM, STREAM_STANDBY, MessageBuffer, encode_message, decode_hello_rsp
+from ring_buffer import AudioRingBuffer, RING_CAPACITY
+from jitter_buffer import JitterBuffer
+from audio_codecs import ALL_CODECS, Codec, make_codec
+from clock_sync import ClockSync, PlaybackAligner, StreamTimeline
+from datagram_transport import DatagramReceiver
 
 host = '127.0.0.1'
 port = 8000
 NUM_BYTES_TO_RECV = 65536  # max number of bytes to recv from socket
 
-MSG_HEADER_LEN = 6 # 4 bytes (msg length) + 2 bytes (ClientServer.Msg)
-MSG_LEN_PACKING_FORMAT = 'I' # uint32
-MSG_CODE_PACKING_FORMAT = 'H' # uint16, packing format of ClientServerMsg
-
-# TODO: Add format for frame size and check header still works
-# Packing format of duration (seconds) song has been played for
-DURATION_FORMAT = 'f' # float32
-
-# Packing format of PyAudio stream initialization parameters
-AUDIO_FORMAT = 'I' #uint32
-CHANNEL_FORMAT = 'H' # uint16
-FPB_FORMAT = 'H' #uint16
-FRAMERATE_FORMAT = 'H' #uint16
-FRAME_LEN_FORMAT = 'I' #uint32
-
-# frames per buffer for PyAudio
-FRAMES_PER_BUFFER = 16384
-
-MIN_QUEUE_LEN = 15
+# frames per buffer for PyAudio the Client asks for in its HELLO. Small buffers switch rooms sooner,
+# large ones are cheaper to stream
+PREFERRED_FRAMES_PER_BUFFER = 4096
+MAX_FRAMES_PER_BUFFER = 16384
+# format the Client's speaker plays, declared in its HELLO. The Server resamples, mixes down and converts
+# the bit depth of songs to match. 0 accepts whatever the song has, e.g. a small mono speaker would use
+# 22050, 1 and 2
+PLAYBACK_RATE = 0
+PLAYBACK_CHANNELS = 0
+PLAYBACK_SAMPLE_WIDTH = 0
+# whether the Client offers to receive audio in datagrams, see datagram_transport. Control messages
+# always go over TCP
+USE_DATAGRAMS = True
+# seconds the Server is given to answer the HELLO before the Client gives up on it
+HANDSHAKE_TIMEOUT = 2.
+# number of the largest STREAM_RSPs accepted that fit in the ring buffer, more than a full jitter buffer
+RSPS_PER_RING = 32
+# most bytes the Client accepts in one STREAM_RSP
+MAX_RSP_LEN = RING_CAPACITY // RSPS_PER_RING
 
 # sleep time in seconds
 SLEEP_INTERVAL = .05
 SLEEP_INT_LARGE = .1
 
-# Message subject sent between the Client and server through sockets
-class ClientServerMsg(IntEnum):
-    # TODO: Add termination command from Server to terminate processes
-    # Server sends
-    HALT = auto()
-    NEW_STREAM = auto()
-    STREAM_RSP = auto()
-
-    # Client sends
-    HALT_RSP = auto()
-    STREAM_REQ = auto()
-
 # Messages sent between the Client and AudioStream process by setting shared
-# comm_val
+# comm_val (a SharedMsg)
 class ClientAudioMsg(IntEnum):
     # Client sends
     HALT = auto()
@@ -73,6 +70,257 @@ class AudioStreamState(IntEnum):
 
 py_audio = pyaudio.PyAudio()
 
+class SharedMsg:
+    def __init__(self):
+        """
+        SharedMsg: the last ClientAudioMsg sent between the Client and AudioStream processes. Setting
+        self.value wakes up a process blocked in wait_for() right away instead of it polling for the
+        change. Reading self.value never blocks, so it is safe to read in PyAudio's callback.
+        """
+        self._value = mp.RawValue('i', 0)
+        self._changed = mp.Condition()
+
+    @property
+    def value(self):
+        return self._value.value
+
+    @value.setter
+    def value(self, msg):
+        with self._changed:
+            self._value.value = msg
+            self._changed.notify_all()
+
+    def wait_for(self, *msgs, timeout=None):
+        """
+        Blocks until the value is one of msgs.
+        :param msgs: ClientAudioMsgs to wait for
+        :param timeout: optional number of seconds to wait at most
+        :return: the value when the wait ended, only outside msgs if timeout expired
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self._value.value in msgs, timeout)
+            return self._value.value
+
+
+def decode_new_stream(msg_body):
+    """
+    Decodes the body of a NEW_STREAM msg.
+    :param msg_body: bytes-like body of the message, without its header
+    :return: PyAudio format, channels, rate, frames_per_buffer, the frame_len of the stream, the
+        rsp_len of its STREAM_RSPs once decoded, the audio_codecs.Codec they are encoded with and the
+        Server time the stream is scheduled to be heard from (None if the Server doesn't schedule it)
+    """
+    form, channels, rate, frames_per_buffer, frame_len, rsp_len, codec_id, start_time = \
+        NEW_STREAM.unpack_from(msg_body, 0)[:8]
+    return form, channels, rate, frames_per_buffer, frame_len, rsp_len, Codec(codec_id), start_time or None
+
+
+def decode_datagram_fields(msg_body):
+    """
+    Decodes how the audio of a NEW_STREAM's stream is sent.
+    :param msg_body: bytes-like body of the NEW_STREAM, without its header
+    :return: (stream_id, group, port). stream_id is 0 when the audio comes in STREAM_RSPs, otherwise the id
+        of its datagrams. group is the multicast group they are sent to and port its UDP port, or None and 0
+        when they are sent to the Client's own port
+    """
+    stream_id, group, port = NEW_STREAM.unpack_from(msg_body, 0)[8:11]
+    group = socket.inet_ntoa(group)
+    return stream_id, None if group == '0.0.0.0' else group, port
+
+
+def decode_standby(msg_body):
+    """
+    :param msg_body: bytes-like body of a NEW_STREAM, without its header
+    :return bool: whether the stream is sent ahead to a room the listener is likely to walk into, to be
+        played muted until a START
+    """
+    return bool(NEW_STREAM.unpack_from(msg_body, 0)[11] & STREAM_STANDBY)
+
+
+def join_position(timeline, start_time, rate):
+    """
+    :param timeline: StreamTimeline of the stream
+    :param start_time: Server time the stream is heard from, None if not scheduled
+    :param rate: frames per second of the stream
+    :return int: frame of the stream the first frame queued is, after the start when joining late
+    """
+    if timeline.start_pts is None or start_time is None:
+        return 0
+    return max(0, round((timeline.start_pts - start_time) * rate))
+
+
+def queue_chunk(ring, codec, timeline, msg_body):
+    """
+    Decodes the audio data of a STREAM_RSP and writes it to a ring buffer at its place on the stream's
+    timeline.
+    :param ring: AudioRingBuffer to write to
+    :param codec: audio_codecs codec of the stream
+    :param timeline: StreamTimeline of the stream
+    :param msg_body: body of the STREAM_RSP: its presentation timestamp, then the encoded audio data
+    """
+    pts = TIMESTAMP.unpack_from(msg_body, 0)[0]
+    pcm = codec.decode(msg_body[TIMESTAMP_LEN:])
+    gap, overlap = timeline.place(pts, len(pcm))
+    if gap:
+        # audio the Server never sent, keep what follows in time
+        ring.write(bytes(max(0, min(gap, ring.free() - len(pcm)))))
+    ring.write(pcm[overlap:])
+
+
+def encode_time_req(clock):
+    """
+    Builds a TIME_REQ msg carrying the time it is sent at.
+    :param clock: ClockSync of the connection
+    :return bytes: the encoded message
+    """
+    return encode_message(ClientServerMsg.TIME_REQ, TIMESTAMP.pack(clock.on_request()))
+
+
+def on_time_rsp(clock, msg_body):
+    """
+    Updates the clock offset with a TIME_RSP.
+    :param clock: ClockSync of the connection
+    :param msg_body: body of the TIME_RSP: the Client's send time, then the Server's receive and send times
+    """
+    clock.on_response(*TIME_RSP.unpack_from(msg_body, 0))
+
+
+def output_time(audio_stream, time_info):
+    """
+    :param audio_stream: AudioStream whose callback is running
+    :param time_info: time_info PyAudio passed the callback
+    :return float: time.time() at which the first frame the callback returns will be heard
+    """
+    now = time.time()
+    if time_info and time_info.get('output_buffer_dac_time') and time_info.get('current_time'):
+        return now + max(0., time_info['output_buffer_dac_time'] - time_info['current_time'])
+    return now + audio_stream.latency
+
+
+def encode_hello(preferred_fpb=PREFERRED_FRAMES_PER_BUFFER, max_fpb=MAX_FRAMES_PER_BUFFER,
+                 max_rsp_len=MAX_RSP_LEN, codecs=ALL_CODECS, rate=PLAYBACK_RATE, channels=PLAYBACK_CHANNELS,
+                 sample_width=PLAYBACK_SAMPLE_WIDTH, datagram_port=0):
+    """
+    Builds the HELLO msg the Client opens the connection with, advertising the protocol version and
+    capabilities and the buffer sizes, codecs and playback format it supports. The Server picks the
+    buffer sizes, codec and format of every stream from them.
+    :param preferred_fpb: frames per buffer the Client would like
+    :param max_fpb: most frames per buffer the Client supports
+    :param max_rsp_len: most bytes the Client accepts in one STREAM_RSP
+    :param codecs: bitmask of the audio_codecs.Codecs the Client decodes
+    :param rate: sample rate the Client plays, 0 for any
+    :param channels: most channels the Client plays, 0 for any
+    :param sample_width: bytes per sample the Client plays, 0 for any
+    :param datagram_port: UDP port the Client receives audio datagrams on, 0 to receive STREAM_RSPs only
+    :return bytes: the encoded message
+    """
+    capabilities = CAPABILITIES if datagram_port else CAPABILITIES & ~CAP_DATAGRAMS
+    msg_bytes = HELLO.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, capabilities, preferred_fpb, max_fpb, max_rsp_len,
+                           codecs, rate, channels, sample_width, datagram_port)
+    return encode_message(ClientServerMsg.HELLO, msg_bytes)
+
+
+def check_hello_rsp(msg_code, msg_body):
+    """
+    Checks the Server's answer to the HELLO, the first message it sends.
+    :param msg_code: ClientServerMsg of the message
+    :param msg_body: bytes-like body of the message
+    :return int: protocol capabilities the Server uses
+    """
+    if msg_code != ClientServerMsg.HELLO_RSP:
+        raise ProtocolError("the Server didn't answer the HELLO, it speaks an older protocol")
+    return decode_hello_rsp(msg_body)
+
+
+class MessageDecoder:
+    def __init__(self, capacity=2 * NUM_BYTES_TO_RECV):
+        """
+        MessageDecoder: splits the raw bytes received from a socket into complete messages. Bytes are
+        received straight into a preallocated buffer and consumed by moving a read cursor, so any
+        number of messages can arrive in one recv and bytes of the next message are kept for later.
+        Message bodies are returned as memoryviews into the buffer and are only valid until the next
+        call to recv_from() or feed().
+        :param capacity: initial size of the buffer in bytes. Grows to fit larger messages
+        """
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.read_pos = 0  # start of the first byte not yet returned as part of a message
+        self.write_pos = 0  # end of the received bytes
+
+    def _make_room(self, num_bytes):
+        """
+        Ensures num_bytes can be written after self.write_pos. Unconsumed bytes are moved to the front
+        of the buffer, and the buffer is replaced by a larger one if they still wouldn't fit. Only the
+        bytes of a partially received message are ever copied.
+        :param num_bytes: number of bytes about to be written
+        """
+        leftover = self.write_pos - self.read_pos
+        if self.read_pos == self.write_pos:
+            self.read_pos = self.write_pos = 0
+        if self.write_pos + num_bytes <= len(self.buffer):
+            return
+        needed = max(leftover + num_bytes, self.pending_msg_len())
+        if needed <= len(self.buffer):
+            self.view[:leftover] = self.view[self.read_pos:self.write_pos]
+        else:
+            # a new buffer is allocated instead of resizing so outstanding memoryviews stay valid
+            new_buffer = bytearray(max(needed, 2 * len(self.buffer)))
+            new_buffer[:leftover] = self.view[self.read_pos:self.write_pos]
+            self.buffer = new_buffer
+            self.view = memoryview(self.buffer)
+        self.read_pos = 0
+        self.write_pos = leftover
+
+    def pending_msg_len(self):
+        """
+        :return int: length of the partially received message at the read cursor, 0 if not even its
+            header has been received yet
+        """
+        if self.write_pos - self.read_pos < MSG_HEADER_LEN:
+            return 0
+        return HEADER.unpack_from(self.buffer, self.read_pos)[0]
+
+    def has_pending_bytes(self):
+        """:return bool: True if bytes not yet returned as part of a message are buffered"""
+        return self.write_pos > self.read_pos
+
+    def recv_from(self, sock):
+        """
+        Receives once from sock directly into the buffer.
+        :param sock: socket to receive from. socket.timeout is passed on to the caller
+        :return int: number of bytes received
+        """
+        self._make_room(NUM_BYTES_TO_RECV)
+        num_bytes = sock.recv_into(self.view[self.write_pos:], NUM_BYTES_TO_RECV)
+        if num_bytes == 0:
+            raise ConnectionError("Server closed the connection")
+        self.write_pos += num_bytes
+        return num_bytes
+
+    def feed(self, data):
+        """
+        Adds bytes received some other way to the buffer.
+        :param data: bytes-like object
+        """
+        self._make_room(len(data))
+        self.view[self.write_pos:self.write_pos + len(data)] = data
+        self.write_pos += len(data)
+
+    def next_message(self):
+        """
+        Consumes the next complete message from the buffer if it has been entirely received.
+        :return: (msg_code, msg_body) with msg_body a memoryview of the message without its header, or
+            None if no complete message is buffered
+        """
+        msg_len = self.pending_msg_len()
+        if msg_len == 0 or self.write_pos - self.read_pos < msg_len:
+            return None
+        msg_code = HEADER.unpack_from(self.buffer, self.read_pos)[1]
+        msg_body = self.view[self.read_pos + MSG_HEADER_LEN:self.read_pos + msg_len]
+        self.read_pos += msg_len
+        return msg_code, msg_body
+
+
 class AudioStream:
     def __init__(self):
         self.stream = None  # PyAudio stream
@@ -80,8 +328,23 @@ class AudioStream:
         self.start_time = 0.
         self.end_time = 0.
         self.state = AudioStreamState.NOT_PLAYING
+        # bytes per frame of the current stream accounting for # of channels and bytes-per-channel
+        self.frame_size = 0
+        # number of bytes handed to PyAudio in the last read_callback. They stay in the ring buffer
+        # until the next callback so PyAudio can copy them
+        self.read_len = 0
+        # a buffer of silence played when the ring buffer runs dry
+        self.silence = memoryview(b'')
+        # buffer for callbacks that play silence ahead of the ring buffer's data to stay aligned
+        self.scratch = bytearray()
+        # keeps playback on the Server's timeline
+        self.aligner = PlaybackAligner()
+        # seconds from handing PyAudio a buffer until it is heard, when PyAudio doesn't tell
+        self.latency = 0.
+        # frame of the stream it is heard from, -1 while it is muted on standby until a START
+        self.start_frame = 0
 
-    def create_stream(self,form, channels, rate,frames_per_buffer, stream_callback):
+    def create_stream(self,form, channels, rate,frames_per_buffer, stream_callback, local_start=None):
         """
         Create PyAudio stream with given parameters
         :param form: Sampling size and format
@@ -89,12 +352,21 @@ class AudioStream:
         :param rate: Sampling rate
         :param frames_per_buffer: Specifies the number of frames per buffer
         :param stream_callback: Specifies a callback function for non-blocking (callback) operation
+        :param local_start: time.time() the stream is scheduled to be heard from, None to play it as soon
+            as it starts
         """
+        self.frame_size = pyaudio.get_sample_size(form) * channels
+        self.read_len = 0
+        self.silence = memoryview(bytes(frames_per_buffer * self.frame_size))
+        self.scratch = bytearray(frames_per_buffer * self.frame_size)
+        self.start_frame = 0
+        self.aligner.start(local_start, rate)
         self.stream =  py_audio.open(format=form,
                                      channels=channels, rate=rate, output=True,
                                      frames_per_buffer=frames_per_buffer,
                                      stream_callback=stream_callback, start=False
                                      )
+        self.latency = self.stream.get_output_latency()
     def close_active_stream(self):
         """
         Close the current PyAudio stream and reset our tracking of stream time
@@ -106,98 +378,122 @@ class AudioStream:
             self.stream = None
         self.start_time = 0.
         self.end_time = 0.
+        self.aligner.start(None, 0)
 
 
 class Client:
-    def __init__(self,hostname,portname, comm_queue, comm_arr, comm_val):
+    def __init__(self,hostname,portname, comm_ring, comm_arr, comm_val):
         """
         Client: handles communication between AudioStream and Server
         :param hostname: host for socket to bind to
         :param portname: port for socket to bind to
-        :param comm_queue: queue shared with the AudioStream process for inter-process
-            communication (IPC)
+        :param comm_ring: AudioRingBuffer shared with the AudioStream process that audio data is
+            written to for inter-process communication (IPC)
         :param comm_arr: array shared with the AudioStream process for IPC
-        :param comm_val: integer variable shared with the AudioStream process for IPC
+        :param comm_val: SharedMsg shared with the AudioStream process for IPC
         """
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((hostname, portname))
+        # receives the audio when the Server sends it in datagrams
+        self.datagrams = DatagramReceiver(comm_ring)
+        self.sock.sendall(encode_hello(datagram_port=self.datagrams.port if USE_DATAGRAMS else 0))
+        # offset of the Server's clock, to play at the times it schedules
+        self.clock = ClockSync()
+        # places the chunks of the current stream at their presentation timestamps
+        self.timeline = StreamTimeline()
         # set recv calls to raise a socket.timeout exception after the given interval
         self.sock.settimeout(SLEEP_INTERVAL)
-        self.byte_buffer = bytearray() # stores raw bytes received from socket communication
-        self.comm_queue = comm_queue
+        # splits bytes received from the socket into messages
+        self.decoder = MessageDecoder()
+        # body (without header) of the last message received, valid until the next socket read
+        self.msg_body = memoryview(b'')
+        self.comm_ring = comm_ring
         self.comm_arr = comm_arr
         self.comm_val = comm_val
         self.state = ClientState.INACTIVE
+        # number of STREAM_RSP chunks granted to the Server that haven't been received yet
+        self.credit = 0
+        # sizes the queue from the arrival times of the chunks
+        self.jitter = JitterBuffer()
+        # audio_codecs codec decoding the STREAM_RSPs of the current stream
+        self.codec = None
+        # set once the Server sent the last chunk of its playlist
+        self.stream_ended = False
         # holds the size of each frame of stream data that is expected in the AudioStream
-        # read_callback. Accounts for number of channels and bytes-per-channel
+        # read_callback. Accounts for number of channels and bytes-per-channel. Also the size of each
+        # STREAM_RSP chunk
         self.cur_stream_info = {
-            'frame_len': -1
+            'frame_len': -1,
+            'rsp_len': -1,
+            # (form, channels, rate, frames_per_buffer) the AudioStream's PyAudio stream was created with
+            'params': None,
+            # time.time() the stream is scheduled to be heard from, None to play it when it's preloaded
+            'local_start': None,
+            # Server time the stream is scheduled to be heard from, None if not scheduled
+            'start_time': None,
+            # (stream_id, group, port) of the datagrams the stream is sent in, see decode_datagram_fields()
+            'datagrams': (0, None, 0),
+            # whether the stream is muted until a START, see decode_standby()
+            'standby': False
         }
+        # the messages sent most, packed into buffers of their own instead of being built every time
+        self.stream_req = MessageBuffer(ClientServerMsg.STREAM_REQ, CREDIT)
+        self.time_req = MessageBuffer(ClientServerMsg.TIME_REQ, TIMESTAMP)
+        self.halt_rsp = MessageBuffer(ClientServerMsg.HALT_RSP, DURATION)
+        # protocol capabilities the Server uses, from its HELLO_RSP
+        self.capabilities = self.handshake()
 
-    def encode_message(self, msg_code, msg_bytes=b''):
+    def handshake(self):
         """
-        Used for sending messages through sockets.
-        Takes a message code (integer) and an optional message body (bytes) and converts it to bytes
-        and appends a header containing the entire message length and the message code.
-
-        :param msg_code: The message code of the message to be sent. Should be its integer value not
-            instead of bytes
-        :param msg_bytes: The body of the message to be sent in bytes.
-        :return bytes: The full encoded message with header ready to be sent.
+        Waits for the Server's HELLO_RSP. Raises protocol.ProtocolError if it speaks another version of the
+        protocol, sends something else first or doesn't answer within HANDSHAKE_TIMEOUT.
+        :return int: protocol capabilities the Server uses
         """
-        len_msg = len(msg_bytes)
-        len_msg += MSG_HEADER_LEN
-        encoded_message = pack(MSG_LEN_PACKING_FORMAT, len_msg) \
-                          + pack(MSG_CODE_PACKING_FORMAT, msg_code) + msg_bytes
-        return encoded_message
+        deadline = time.time() + HANDSHAKE_TIMEOUT
+        while time.time() < deadline:
+            msg_code = self.quick_read()
+            if msg_code is not None:
+                return check_hello_rsp(msg_code, self.msg_body)
+        raise ProtocolError("the Server didn't answer the HELLO, it speaks an older protocol")
 
-    def receive_complete_message(self, expected_msg_len=float("inf")):
+    def receive_complete_message(self):
         """
-        Continuously tries to receive a message through socket. If no message is received before the
-        socket.timeout exception is raised it will sleep and then try again. This function will not return
-        until it receives a message from the socket and the entire message is received as identified
-        in the message header of the received message.
-        Entire msg (including header) is stored in self.byte_buffer
+        Returns the next message received from the socket. Messages already buffered by an earlier
+        recv are returned first, otherwise it continuously tries to receive through the socket. If no
+        data is received before the socket.timeout exception is raised it will try again.
+        This function will not return until an entire message as identified in its header has been
+        received. The body of the message is stored in self.msg_body
 
-        :param expected_msg_len: Optional length of message to be received. Defaults to infinity but will
-            automatically be set to proper value once message is received and the length of the message
-            is read from the header.
         :return ClientServerMsg: The message code of the message
         """
-        got_msg_header = False
-        msg_code = None
-        while len(self.byte_buffer) < expected_msg_len:
+        msg = self.decoder.next_message()
+        while msg is None:
             try:
-                data = self.sock.recv(NUM_BYTES_TO_RECV)
-                self.byte_buffer += data
-                if not got_msg_header:
-                    if len(self.byte_buffer) >= MSG_HEADER_LEN:
-                        msg_code = unpack(MSG_CODE_PACKING_FORMAT, self.byte_buffer[4:6])[0]
-                        expected_msg_len = unpack(MSG_LEN_PACKING_FORMAT, self.byte_buffer[:4])[0]
-                        got_msg_header = True
+                self.decoder.recv_from(self.sock)
+                msg = self.decoder.next_message()
             except socket.timeout:
-                time.sleep(SLEEP_INTERVAL)
+                pass
+        msg_code, self.msg_body = msg
+        if msg_code == ClientServerMsg.TIME_RSP:
+            on_time_rsp(self.clock, self.msg_body)
         return msg_code
 
 
     def quick_read(self):
         """
-        Attempts to receive a socket message just once. If timeout occurs a msg code of None is
-        returned. If any part of a message is retrieved then self.receive_complete_message() is
-        called to ensure we receive the entire msg and only return once it gets it. That msg_code
-        is then returned. Entire msg (including header) is stored in self.byte_buffer
+        Returns a message if one is already buffered, otherwise attempts to receive through the socket
+        just once. If timeout occurs a msg code of None is returned. If any part of a message is
+        retrieved then self.receive_complete_message() is called to ensure we receive the entire msg
+        and only return once it gets it. That msg_code is then returned. The body of the message is
+        stored in self.msg_body
         :return msg_code: None if socket was empty, else ClientServerMsg
         """
+        if self.decoder.has_pending_bytes():
+            return self.receive_complete_message()
         msg_code = None
         try:
-            data = self.sock.recv(NUM_BYTES_TO_RECV)
-            self.byte_buffer += data
-            if len(self.byte_buffer) >= MSG_HEADER_LEN:
-                msg_code = unpack(MSG_CODE_PACKING_FORMAT, self.byte_buffer[4:6])[0]
-                expected_msg_len = unpack(MSG_LEN_PACKING_FORMAT, self.byte_buffer[:4])[0]
-                self.receive_complete_message(expected_msg_len[0])
-            else:
-                self.receive_complete_message()
+            self.decoder.recv_from(self.sock)
+            msg_code = self.receive_complete_message()
         except socket.timeout:
             pass
         return msg_code
@@ -208,13 +504,49 @@ class Client:
         Decodes and returns the parameters of the incoming audio stream.
         :return: PuAudio stream parameters
         """
-        form = unpack(AUDIO_FORMAT,self.byte_buffer[6:10])[0]
-        channels = unpack(CHANNEL_FORMAT, self.byte_buffer[10:12])[0]
-        rate = unpack(FRAMERATE_FORMAT, self.byte_buffer[12:14])[0]
-        frames_per_buffer = unpack(FPB_FORMAT, self.byte_buffer[14:16])[0]
-        self.cur_stream_info['frame_len'] = unpack(FRAME_LEN_FORMAT, self.byte_buffer[16:20])[0]
+        form, channels, rate, frames_per_buffer, frame_len, rsp_len, codec_id, start_time = \
+            decode_new_stream(self.msg_body)
+        self.codec = make_codec(codec_id, channels, pyaudio.get_sample_size(form))
+        self.cur_stream_info['frame_len'] = frame_len
+        self.cur_stream_info['rsp_len'] = rsp_len
+        self.jitter.start_stream(rsp_len // frame_len * frames_per_buffer, rate)
+        self.timeline.start(rate, frame_len // frames_per_buffer)
+        self.cur_stream_info['params'] = (form, channels, rate, frames_per_buffer)
+        self.cur_stream_info['local_start'] = \
+            self.clock.to_local(start_time) if start_time is not None and self.clock.synced else None
+        self.cur_stream_info['start_time'] = start_time
+        self.cur_stream_info['datagrams'] = decode_datagram_fields(self.msg_body)
+        self.cur_stream_info['standby'] = decode_standby(self.msg_body)
+        # join the multicast group right away, the datagrams are started on once the queue is preloaded
+        stream_id, group, port = self.cur_stream_info['datagrams']
+        if stream_id and group is not None:
+            self.datagrams.join(group, port)
+        self.stream_ended = False
         return form, channels, rate, frames_per_buffer
 
+    def continue_stream(self):
+        """
+        Handles a NEW_STREAM received while streaming whose PyAudio parameters match the stream playing,
+        like the next track of the Server's playlist. Its chunks are queued right behind the chunks of the
+        current track and the AudioStream keeps playing, so there is no gap between the tracks.
+        :return bool: whether the stream continues, False if the AudioStream needs a new PyAudio stream
+        """
+        form, channels, rate, frames_per_buffer, frame_len, rsp_len, codec_id, start_time = \
+            decode_new_stream(self.msg_body)
+        if (form, channels, rate, frames_per_buffer) != self.cur_stream_info['params']:
+            return False
+        self.codec = make_codec(codec_id, channels, pyaudio.get_sample_size(form))
+        self.cur_stream_info['frame_len'] = frame_len
+        self.cur_stream_info['rsp_len'] = rsp_len
+        self.jitter.set_chunk_length(rsp_len // frame_len * frames_per_buffer, rate)
+        self.datagrams.codec = self.codec
+        return True
+
+    @property
+    def datagram_mode(self):
+        """whether the current stream's audio arrives in datagrams instead of STREAM_RSPs"""
+        return self.datagrams.stream_id is not None
+
     def send_new_stream_params(self):
         """
         Sends the parameters of the incoming audio stream to the AudioStream so it can initialize its
@@ -225,116 +557,176 @@ class Client:
         self.comm_arr[1] = channels
         self.comm_arr[2] = rate
         self.comm_arr[3] = frames_per_buffer
+        self.comm_arr[4] = self.cur_stream_info['local_start'] or 0.
+        self.comm_arr[6] = -1 if self.cur_stream_info['standby'] else 0
         self.comm_val.value = ClientAudioMsg.NEW_STREAM_INFO
 
 
     def preload_queue(self):
         """
-        After receiving a ClientServerMsg.NEW_STREAM msg, ask the Server for audio data
-        (ClientServerMsg.STREAM_REQ) to preload the queue that AudioStream will consume from.
+        After receiving a ClientServerMsg.NEW_STREAM msg, grant the Server the jitter buffer's target
+        depth in chunks of credit (ClientServerMsg.STREAM_REQ) to preload the queue that AudioStream will consume from.
         Once done notify the AudioStream that the data is ready so it can start playing.
         If a ClientServerMsg.HALT msg is received during communication it is handled properly in here.
         """
         received_halt_code = False
         print("Client: Preloading queue")
-        for i in range(3):
-            req = ClientServerMsg.STREAM_REQ
-            m = self.encode_message(req)
-            self.sock.sendall(m)
+        self.credit = 0
+        stream_id = self.cur_stream_info['datagrams'][0]
+        if stream_id:
+            form, channels = self.cur_stream_info['params'][:2]
+            self.datagrams.start(stream_id, self.codec, self.timeline, pyaudio.get_sample_size(form), channels)
+            # the Server sends datagrams ahead of time without credit, start once the first one is queued.
+            # The AudioStream holds playback back until the scheduled start
+            while self.timeline.start_pts is None and not self.stream_ended:
+                self.datagrams.poll()
+                msg_code = self.quick_read()
+                if msg_code == ClientServerMsg.HALT:
+                    received_halt_code = True
+                    break
+                elif msg_code == ClientServerMsg.STREAM_RSP:
+                    self.queue_stream_frames()
+                elif msg_code == ClientServerMsg.START:
+                    self.handle_start()
+        else:
+            self.grant_credit(self.jitter.target_chunks)
+        while self.credit > 0:
             msg_code = self.receive_complete_message()
             if msg_code == ClientServerMsg.HALT:
                 received_halt_code = True
                 break
-            frames = self.get_stream_frames()
-            for frame in frames:
-                self.comm_queue.put(frame)
+            elif msg_code == ClientServerMsg.STREAM_RSP:
+                self.queue_stream_frames()
+            elif msg_code == ClientServerMsg.START:
+                self.handle_start()
 
         if received_halt_code:
             print("Client: Received HALT during queue preloading")
             self.handle_halt()
         else:
             print("Client: Queue preloading done")
-            while True:
-                if self.comm_val.value != ClientAudioMsg.WAITING_FOR_STREAM:
-                    time.sleep(.3)
-                else:
-                    break
+            # where on the stream's timeline the queue starts, later than its start when joining late
+            self.comm_arr[5] = join_position(self.timeline, self.cur_stream_info['start_time'],
+                                             self.cur_stream_info['params'][2])
+            self.comm_val.wait_for(ClientAudioMsg.WAITING_FOR_STREAM)
             self.comm_val.value = ClientAudioMsg.STREAM_READY
 
 
-    def get_stream_frames(self):
+    def sync_clock(self):
+        """Sends a TIME_REQ when the clock offset is due for another measurement"""
+        if self.clock.request_due():
+            self.sock.sendall(self.time_req.pack(self.clock.on_request()))
+
+    def grant_credit(self, num_chunks):
+        """
+        Sends a STREAM_REQ allowing the Server to push num_chunks more STREAM_RSPs without waiting for
+        another request.
+        :param num_chunks: number of STREAM_RSP chunks to grant
+        """
+        self.credit += num_chunks
+        self.jitter.on_request(num_chunks)
+        self.sock.sendall(self.stream_req.pack(num_chunks))
+
+    def queue_stream_frames(self):
+        """
+        Decodes the audio data of the STREAM_RSP just received into the ring buffer at its presentation
+        timestamp and uses up one chunk of credit. An empty STREAM_RSP ends the stream, the Server
+        won't use the rest of the credit
+        """
+        if len(self.msg_body) == 0:
+            print("Client: Server reached the end of its playlist")
+            self.stream_ended = True
+            self.credit = 0
+            return
+        self.credit -= 1
+        self.jitter.on_arrival()
+        queue_chunk(self.comm_ring, self.codec, self.timeline, self.msg_body)
+
+    def queued_chunks(self):
+        """:return int: number of STREAM_RSP chunks in the ring buffer the AudioStream hasn't played"""
+        return self.comm_ring.fill() // self.cur_stream_info['rsp_len']
+
+    def top_up(self):
         """
-        Returns the individual frames stored in a list of the next audio stream frames received
-        from the Server.
-        :return list(bytes): list of audio frames
+        Grants the Server enough credit to bring the queue, counting the chunks already granted, up to
+        the jitter buffer's target depth. Reports the queue when the target changes or the AudioStream
+        has underrun.
         """
-        frames = []
-        pos = MSG_HEADER_LEN
-        # actual size of each frame of data accounting for # of channels and bytes-per-channel
-        data_size = self.cur_stream_info['frame_len']
-        while pos < len(self.byte_buffer):
-            frames.append(bytes(self.byte_buffer[pos:pos+data_size]))
-            pos += data_size
-        self.byte_buffer.clear()
-        return frames
+        if self.stream_ended or self.datagram_mode:
+            # the AudioStream runs dry once it played the last chunk, that's no reason to buffer more.
+            # Datagrams come without credit
+            self.jitter.skip_underruns(self.comm_ring.underruns())
+            return
+        target = self.jitter.target_chunks
+        if self.jitter.on_underruns(self.comm_ring.underruns()) or target != self.jitter.target_chunks:
+            print(f'Client: {self.jitter.report(self.queued_chunks())}')
+        missing = self.jitter.target_chunks - self.queued_chunks() - self.credit
+        if missing > 0:
+            self.grant_credit(missing)
+
+    def handle_start(self):
+        """
+        Handles a START msg: the listener walked into this room, so the stream prepared on standby is heard
+        from the frame the START names on. The AudioStream reads it from comm_arr.
+        """
+        self.comm_arr[6] = START_FRAME.unpack_from(self.msg_body, 0)[0]
+        print(f"Client: Starting the stream prepared on standby at frame {int(self.comm_arr[6])}")
 
     def handle_halt(self):
         """
         Handles a HALT msg received from server. Tells the AudioStream to stop playing, send the
-        duration of time it played for (through queue) and then go inactive. Forwards the stream
-        duration to the Server in a HALT_RSP. Then clears any remaining data in queue and goes
-        inactive.
+        duration of time it played for (through comm_arr) and then go inactive. Forwards the stream
+        duration to the Server in a HALT_RSP. Then clears any remaining data in the ring buffer and
+        goes inactive.
         :return:
         """
-        self.byte_buffer.clear()
         self.comm_val.value = ClientAudioMsg.HALT
-        while True:
-            if self.comm_val.value == ClientAudioMsg.HALT_RSP:
-                break
-            time.sleep(SLEEP_INTERVAL)
-        msg_code = ClientServerMsg.HALT_RSP
-        duration_bytes = pack(DURATION_FORMAT,self.comm_arr[0])
-        msg = self.encode_message(msg_code, duration_bytes)
-        self.sock.sendall(msg)
-        while not self.comm_queue.empty():
-            self.comm_queue.get()
+        self.comm_val.wait_for(ClientAudioMsg.HALT_RSP)
+        if self.datagram_mode:
+            print(f'Client: {self.datagrams.report()}')
+            self.datagrams.stop()
+        self.sock.sendall(self.halt_rsp.pack(self.comm_arr[0]))
+        # the AudioStream has stopped reading, so it's safe to drop what's left
+        self.comm_ring.clear()
+        # the Server drops any credit left once it receives the HALT_RSP
+        self.credit = 0
+        self.jitter.reset()
         self.state = ClientState.INACTIVE
 
 
-def client_process(comm_queue, comm_arr, comm_val):
-    """Entry point for process that handles communicating with AudioStream process and Server"""
+def client_process(comm_ring, comm_arr, comm_val, hostname=host, portname=port, client_type=None):
+    """
+    Entry point for process that handles communicating with AudioStream process and Server
+    :param client_type: optional subclass of Client to run instead, e.g. one measuring the stream
+    """
 
     print("Client: Client process entered")
-    client = Client(host, port, comm_queue, comm_arr, comm_val)
-    need_more_data = False; new_stream_soon = False
+    client = (client_type or Client)(hostname, portname, comm_ring, comm_arr, comm_val)
+    new_stream_soon = False
 
     while True: # replace True w/ while not_terminated or something
         while client.state == ClientState.INACTIVE:
-            msg_code = client.receive_complete_message()
+            client.sync_clock()
+            # keeps the sockets drained, datagrams of a stream about to start are held back for it
+            client.datagrams.poll()
+            msg_code = client.quick_read()
             if msg_code == ClientServerMsg.NEW_STREAM:
                 print("Client: Got New Stream from Server")
                 client.send_new_stream_params()
-                client.byte_buffer.clear()
                 client.state = ClientState.ACTIVE
                 client.preload_queue()
 
         while client.state == ClientState.ACTIVE:
-            if client.comm_queue.qsize() < MIN_QUEUE_LEN and not new_stream_soon:
-                print(f'Client: Q size: {client.comm_queue.qsize()}')
-                need_more_data = True
-
-            if need_more_data:
-                # Ask server for more stream data and perform blocking socket read until we
-                # receive a response
-                msg_code = ClientServerMsg.STREAM_REQ
-                client.sock.sendall(client.encode_message(msg_code))
-                need_more_data = False
-                msg_rsp = client.receive_complete_message()
+            client.sync_clock()
+            if not new_stream_soon:
+                # keep the queue and the chunks in flight at the target depth so the Server streams
+                # without waiting a round trip for each request
+                client.top_up()
 
-            else:
-                # Data isn't needed, perform a quick non-blocking read to see if we've received
-                # any important msg (e.g. HALT or TERMINATE)
-                msg_rsp = client.quick_read()
+            # queue the datagrams that arrived meanwhile, then perform a quick read to see if we've
+            # received stream data or any important msg (e.g. HALT or TERMINATE). Waits at most SLEEP_INTERVAL
+            client.datagrams.poll()
+            msg_rsp = client.quick_read()
 
             if msg_rsp == ClientServerMsg.HALT:
                 client.handle_halt()
@@ -342,17 +734,21 @@ def client_process(comm_queue, comm_arr, comm_val):
 
             elif msg_rsp == ClientServerMsg.STREAM_RSP:
                 # add more frames to queue
-                frames = client.get_stream_frames()
-                for frame in frames:
-                    client.comm_queue.put(frame)
+                client.queue_stream_frames()
+
+            # the listener walked into this room, unmute the stream prepared on standby
+            elif msg_rsp == ClientServerMsg.START:
+                client.handle_start()
 
-            # Different audio file will be played after next STREAM_REQ. Notify AudioStream and send
-            # new parameters to use once its done playing last bytes of current stream.
+            # Next track of the same format, keep queueing behind the current one
+            elif msg_rsp == ClientServerMsg.NEW_STREAM and client.continue_stream():
+                print("Client: Stream continues with a new track")
+
+            # Different audio format will be played after the chunks already queued. Notify AudioStream
+            # and send new parameters to use once its done playing last bytes of current stream.
             elif msg_rsp == ClientServerMsg.NEW_STREAM:
                 new_stream_soon = True
                 client.send_new_stream_params()
-                client.comm_val.value = ClientAudioMsg.NEW_STREAM_INFO
-                client.byte_buffer.clear()
 
             # If AudioStream is ready for the new stream then preload the queue and notify it.
             if new_stream_soon:
@@ -360,94 +756,479 @@ def client_process(comm_queue, comm_arr, comm_val):
                     new_stream_soon = False
                     client.preload_queue()
 
-            time.sleep(SLEEP_INTERVAL)
 
+def mute_before(audio_stream, data, lead, start_frame):
+    """
+    Silences the frames of a callback's data that come before the frame the stream is heard from. A
+    stream on standby is played muted like this, so it stays in step and the ring buffer keeps its
+    current audio queued for the moment it is started.
+    :param audio_stream: AudioStream whose callback is running
+    :param data: memoryview of lead frames of silence followed by frames of the stream from
+        audio_stream.aligner.position on
+    :param lead: frames of silence at the start of data
+    :param start_frame: frame of the stream it is heard from, negative while muted until a START
+    :return memoryview: data with those frames silenced
+    """
+    frame_size = audio_stream.frame_size
+    num_frames = len(data) // frame_size
+    muted = num_frames if start_frame < 0 else \
+        min(num_frames, max(0, int(start_frame) - audio_stream.aligner.position + lead))
+    if muted == 0:
+        return data
+    if muted == num_frames:
+        return audio_stream.silence[:len(data)]
+    muted_len = muted * frame_size
+    if not lead:
+        # with a lead the data is in the scratch buffer already
+        audio_stream.scratch[muted_len:len(data)] = data[muted_len:]
+    audio_stream.scratch[:muted_len] = audio_stream.silence[:muted_len]
+    return memoryview(audio_stream.scratch)[:len(data)]
 
-def audio_stream_process(comm_queue, comm_arr, comm_val):
-    """Entry point for process that handles playing music through PyAudio"""
 
-    print("AS: process entry")
-    audio_stream = AudioStream()
+def make_read_callback(audio_stream, comm_ring, comm_val=None, on_read=None, comm_arr=None):
+    """
+    Creates the callback an AudioStream's PyAudio stream plays the contents of a ring buffer with.
+    :param audio_stream: AudioStream the callback is for
+    :param comm_ring: AudioRingBuffer the audio data is read from
+    :param comm_val: optional SharedMsg. The stream completes once it is ClientAudioMsg.HALT, or once it
+        is ClientAudioMsg.NEW_STREAM_INFO and the ring buffer has been played out
+    :param on_read: optional function called from PyAudio's thread after each read
+    :param comm_arr: optional array shared with the Client, the frame the stream is heard from is read from
+        comm_arr[6] instead of audio_stream.start_frame. Pass the raw array so reading never blocks
+    :return: the callback
+    """
     def read_callback(in_data, frame_count, time_info, status):
         """
         Callback called automatically by PyAudio stream in a separate thread when it needs more
-        audio data. Retrieves it from the queue.
-        :return data (bytes): The audio stream data to be played
+        audio data. Hands out a view of the ring buffer without copying or allocating buffers, unless
+        silence has to be played ahead of it to stay on the Server's timeline.
+        :return data (memoryview): The audio stream data to be played
                 return_code (int): code telling PyAudio if there will be more data to be played after
                     this call. If not it terminates after playing the data about to be returned.
         """
         return_code = pyaudio.paContinue
-        data = comm_queue.get() if not comm_queue.empty() else b'0'
-        print("AS: got more data")
-        if comm_val.value == ClientAudioMsg.HALT:
-            audio_stream.end_time = time.time()
-            audio_stream.state = AudioStreamState.NEED_SEND_HALT_RSP
+        frame_size = audio_stream.frame_size
+        aligner = audio_stream.aligner
+        # PyAudio has copied the data returned by the previous call by now
+        comm_ring.advance(audio_stream.read_len)
+        aligner.consumed(audio_stream.read_len // frame_size)
+        correction = aligner.correction(output_time(audio_stream, time_info))
+        lead = 0
+        if correction > 0:
+            # behind the timeline, skip what should have been heard already
+            skip = min(correction, comm_ring.fill() // frame_size)
+            comm_ring.advance(skip * frame_size)
+            aligner.consumed(skip)
+            aligner.unapplied(correction - skip)
+        elif correction < 0:
+            # ahead of the timeline, e.g. before the scheduled start
+            lead = min(-correction, frame_count)
+            aligner.unapplied(correction + lead)
+        data = comm_ring.peek((frame_count - lead) * frame_size)
+        audio_stream.read_len = len(data)
+        if lead:
+            lead_len = lead * frame_size
+            audio_stream.scratch[:lead_len] = audio_stream.silence[:lead_len]
+            audio_stream.scratch[lead_len:lead_len + len(data)] = data
+            data = memoryview(audio_stream.scratch)[:lead_len + len(data)]
+        start_frame = audio_stream.start_frame if comm_arr is None else comm_arr[6]
+        if start_frame:
+            data = mute_before(audio_stream, data, lead, start_frame)
+        if comm_val is not None and comm_val.value == ClientAudioMsg.HALT:
+            # the main thread handles the HALT, just stop asking for more data
             return_code = pyaudio.paComplete
             data = data[:5] # just random bytes PyAudio will play before terminating
 
-        if data == b'0':
-            print("AS: queue empty unexpectedly")
+        if len(data) == 0 and comm_val is not None and comm_val.value == ClientAudioMsg.NEW_STREAM_INFO:
+            # the last bytes of the previous format were played, make way for the new PyAudio stream
+            return_code = pyaudio.paComplete
+
+        if len(data) == 0:
+            if return_code == pyaudio.paContinue:
+                print("AS: queue empty unexpectedly")
+                comm_ring.record_underrun()
+            # play silence until the Client catches up instead of ending the stream
+            data = audio_stream.silence[:frame_count * audio_stream.frame_size]
+        if on_read is not None:
+            on_read()
         return data, return_code
+    return read_callback
+
+
+def audio_stream_process(comm_ring, comm_arr, comm_val):
+    """Entry point for process that handles playing music through PyAudio"""
+
+    print("AS: process entry")
+    audio_stream = AudioStream()
+    read_callback = make_read_callback(audio_stream, comm_ring, comm_val, comm_arr=comm_arr.get_obj())
 
     while True: # replace True w/ while not_terminated or something
         if audio_stream.state == AudioStreamState.NOT_PLAYING:
             # create new stream with parameters received from Client when signaled
-            if comm_val.value == ClientAudioMsg.NEW_STREAM_INFO:
+            msg = comm_val.wait_for(ClientAudioMsg.NEW_STREAM_INFO, ClientAudioMsg.HALT)
+            if msg == ClientAudioMsg.NEW_STREAM_INFO:
                 audio_stream.create_stream(form=int(comm_arr[0]), channels=int(comm_arr[1]),
                                            rate=int(comm_arr[2]), frames_per_buffer=int(comm_arr[3]),
-                                           stream_callback=read_callback)
+                                           stream_callback=read_callback, local_start=comm_arr[4] or None)
                 audio_stream.state = AudioStreamState.WAITING_FOR_STREAM
                 comm_val.value = ClientAudioMsg.WAITING_FOR_STREAM
                 print("AS: waiting for stream bytes in queue")
             else:
-                time.sleep(SLEEP_INT_LARGE)
+                # nothing is playing, acknowledge right away
+                audio_stream.state = AudioStreamState.NEED_SEND_HALT_RSP
 
         elif audio_stream.state == AudioStreamState.WAITING_FOR_STREAM:
             # Start stream once Client has preloaded the queue with stream frames
-            if comm_val.value == ClientAudioMsg.STREAM_READY:
+            msg = comm_val.wait_for(ClientAudioMsg.STREAM_READY, ClientAudioMsg.HALT)
+            if msg == ClientAudioMsg.STREAM_READY:
                 print("AS: STARTING STREAM!")
+                audio_stream.aligner.start(comm_arr[4] or None, int(comm_arr[2]), int(comm_arr[5]))
                 audio_stream.state = AudioStreamState.PLAYING
                 audio_stream.stream.start_stream()
                 audio_stream.start_time = time.time()
-            elif comm_val.value == ClientAudioMsg.HALT:
+            else:
                 audio_stream.state = AudioStreamState.NEED_SEND_HALT_RSP
-            time.sleep(SLEEP_INT_LARGE)
 
         elif audio_stream.state == AudioStreamState.NEED_CLEANUP:
             audio_stream.close_active_stream()
             audio_stream.state = AudioStreamState.NOT_PLAYING
 
         elif audio_stream.state == AudioStreamState.NEED_SEND_HALT_RSP:
-            duration = audio_stream.end_time - audio_stream.start_time
-            comm_arr[0] = duration
+            # how far into the stream playback got, counting frames skipped to keep in step
+            comm_arr[0] = audio_stream.aligner.played_seconds()
             audio_stream.close_active_stream()
             audio_stream.state = AudioStreamState.NOT_PLAYING
             comm_val.value = ClientAudioMsg.HALT_RSP
 
         else:
-            if audio_stream.stream is None or not audio_stream.stream.is_active():
-                audio_stream.state = AudioStreamState.NOT_PLAYING
-            else:
-                # If PLAYING then main thread sleeps while PyAudio periodically calls read_callback in a
-                # separate thread when it needs more data .
-                time.sleep(SLEEP_INT_LARGE)
+            # If PLAYING then main thread waits for a HALT while PyAudio periodically calls read_callback
+            # in a separate thread when it needs more data. Wakes up now and then to notice if the
+            # stream ended by itself.
+            msg = comm_val.wait_for(ClientAudioMsg.HALT, timeout=SLEEP_INT_LARGE)
+            if msg == ClientAudioMsg.HALT:
+                audio_stream.end_time = time.time()
+                audio_stream.state = AudioStreamState.NEED_SEND_HALT_RSP
+            elif audio_stream.stream is None or not audio_stream.stream.is_active():
+                audio_stream.state = AudioStreamState.NEED_CLEANUP
+
+
+async def read_message(reader):
+    """
+    Reads one complete message from the Server.
+    :param reader: asyncio.StreamReader of the connection
+    :return: (msg_code, msg_body) where msg_body is the message without its header
+    """
+    len_msg, msg_code = HEADER.unpack(await reader.readexactly(MSG_HEADER_LEN))
+    msg_body = await reader.readexactly(len_msg - MSG_HEADER_LEN)
+    return msg_code, msg_body
+
+
+class AsyncClient:
+    def __init__(self, hostname, portname, ring_capacity=RING_CAPACITY):
+        """
+        AsyncClient: plays a stream in a single process. An asyncio task reads the socket and writes the
+        audio data to an in-process ring buffer that the PyAudio callback thread drains, replacing the
+        Client and AudioStream processes and everything they share.
+        :param hostname: host of the Server
+        :param portname: port of the Server
+        :param ring_capacity: size in bytes of the ring buffer, a power of 2
+        """
+        self.hostname = hostname
+        self.portname = portname
+        self.ring = AudioRingBuffer(ring_capacity, shared=False)
+        self.audio_stream = AudioStream()
+        self.state = ClientState.INACTIVE
+        self.writer = None
+        self.loop = None
+        # number of STREAM_RSP chunks granted to the Server that haven't been received yet
+        self.credit = 0
+        # sizes the ring buffer's contents from the arrival times of the chunks
+        self.jitter = JitterBuffer()
+        # audio_codecs codec decoding the STREAM_RSPs of the current stream
+        self.codec = None
+        # size of each STREAM_RSP chunk of stream data
+        self.rsp_len = -1
+        # (form, channels, rate, frames_per_buffer) of the PyAudio stream
+        self.stream_params = None
+        # set once the Server sent the last chunk of its playlist
+        self.stream_ended = False
+        # offset of the Server's clock, and the presentation timestamps of the current stream
+        self.clock = ClockSync()
+        self.timeline = StreamTimeline()
+        # receives the audio when the Server sends it in datagrams
+        self.datagrams = DatagramReceiver(self.ring)
+        # (local_start, rate) the PyAudio stream is aligned with once it starts, and the Server time it
+        # is scheduled to be heard from
+        self.alignment = (None, 0)
+        self.stream_start_time = None
+        # task setting up the stream of a NEW_STREAM, and the task it waits on while the previous stream
+        # plays out. Both run beside the message loop, which keeps handling the Server's messages
+        self.stream_setup = None
+        self.play_out = None
+
+    def queued_chunks(self):
+        """:return int: number of STREAM_RSP chunks in the ring buffer that haven't been played"""
+        return self.ring.fill() // self.rsp_len
+
+    async def sync_clock(self):
+        """Sends TIME_REQs whenever the clock offset is due for another measurement"""
+        while True:
+            if self.clock.request_due():
+                self.writer.write(encode_time_req(self.clock))
+            await asyncio.sleep(SLEEP_INTERVAL)
+
+    def grant_credit(self, num_chunks):
+        """
+        Sends a STREAM_REQ allowing the Server to push num_chunks more STREAM_RSPs.
+        :param num_chunks: number of STREAM_RSP chunks to grant
+        """
+        self.credit += num_chunks
+        self.jitter.on_request(num_chunks)
+        self.writer.write(encode_message(ClientServerMsg.STREAM_REQ, CREDIT.pack(num_chunks)))
+
+    def refill(self):
+        """Keeps the ring buffer and the chunks in flight at the jitter buffer's target depth"""
+        if self.state != ClientState.ACTIVE:
+            return
+        if self.stream_ended or self.datagrams.stream_id is not None:
+            self.jitter.skip_underruns(self.ring.underruns())
+            return
+        target = self.jitter.target_chunks
+        if self.jitter.on_underruns(self.ring.underruns()) or target != self.jitter.target_chunks:
+            print(f'Client: {self.jitter.report(self.queued_chunks())}')
+        missing = self.jitter.target_chunks - self.queued_chunks() - self.credit
+        if missing > 0:
+            self.grant_credit(missing)
+
+    def on_read(self):
+        """Called from PyAudio's thread after each read, checks for a refill on the event loop"""
+        self.loop.call_soon_threadsafe(self.refill)
+
+    def start_playing(self):
+        """Starts the PyAudio stream once the ring buffer is preloaded"""
+        if self.audio_stream.state != AudioStreamState.WAITING_FOR_STREAM:
+            return
+        print("AS: STARTING STREAM!")
+        local_start, rate = self.alignment
+        self.audio_stream.aligner.start(local_start, rate,
+                                        join_position(self.timeline, self.stream_start_time, rate))
+        self.audio_stream.state = AudioStreamState.PLAYING
+        self.audio_stream.stream.start_stream()
+        self.audio_stream.start_time = time.time()
+
+    def on_datagrams(self):
+        """Called by the event loop when datagrams arrived, queues them"""
+        self.datagrams.poll()
+        if self.state == ClientState.ACTIVE and self.timeline.start_pts is not None:
+            self.start_playing()
+
+    def watch_datagrams(self, group=None, port=0):
+        """
+        Has the event loop queue datagrams as they arrive, joining a multicast group first if given.
+        :param group: multicast group of the stream, None to receive unicast datagrams only
+        :param port: UDP port of the group
+        """
+        for sock in self.datagrams.sockets():
+            self.loop.remove_reader(sock)
+        if group is not None:
+            self.datagrams.join(group, port)
+        for sock in self.datagrams.sockets():
+            self.loop.add_reader(sock, self.on_datagrams)
+
+    async def stop_stream(self):
+        """Stops and closes the PyAudio stream without blocking the event loop"""
+        await self.loop.run_in_executor(None, self.audio_stream.close_active_stream)
+        self.ring.clear()
+        self.credit = 0
+        self.jitter.reset()
+
+    def continue_stream(self, msg_body):
+        """
+        Handles a NEW_STREAM with the parameters of the stream playing, like the next track of the
+        Server's playlist: its chunks are queued right behind the current ones.
+        :param msg_body: body of the NEW_STREAM msg
+        :return bool: False if the NEW_STREAM needs a new PyAudio stream, see start_new_stream()
+        """
+        form, channels, rate, frames_per_buffer, frame_len, rsp_len, codec_id, start_time = \
+            decode_new_stream(msg_body)
+        if self.state != ClientState.ACTIVE or self.audio_stream.stream is None \
+                or (form, channels, rate, frames_per_buffer) != self.stream_params:
+            return False
+        print("Client: Stream continues with a new track")
+        self.codec = make_codec(codec_id, channels, pyaudio.get_sample_size(form))
+        self.rsp_len = rsp_len
+        self.jitter.set_chunk_length(rsp_len // frame_len * frames_per_buffer, rate)
+        self.datagrams.codec = self.codec
+        return True
+
+    async def drain_stream(self):
+        """Waits until the PyAudio stream played out the ring buffer, or stopped"""
+        while self.ring.fill() > 0 and self.audio_stream.stream.is_active():
+            await asyncio.sleep(SLEEP_INTERVAL)
+
+    async def interrupt_stream_setup(self):
+        """
+        Abandons the stream being set up, if any, because a HALT or another NEW_STREAM arrived. The
+        previous stream stops playing out, and the setup is waited for if it is past that already.
+        """
+        if self.stream_setup is None:
+            return
+        if self.play_out is not None:
+            self.play_out.cancel()
+        await asyncio.gather(self.stream_setup, return_exceptions=True)
+        self.stream_setup = None
+
+    async def start_new_stream(self, msg_body):
+        """
+        Handles a NEW_STREAM that continue_stream() didn't: creates a PyAudio stream with its parameters
+        and preloads the ring buffer by granting the jitter buffer's target depth in chunks. A stream still
+        playing is let finish its data first. Runs as self.stream_setup, beside the message loop, and is
+        only cancelled while the previous stream plays out, see interrupt_stream_setup().
+        :param msg_body: body of the NEW_STREAM msg
+        """
+        form, channels, rate, frames_per_buffer, frame_len, rsp_len, codec_id, start_time = \
+            decode_new_stream(msg_body)
+        if self.audio_stream.stream is not None:
+            # play out the previous stream before switching to the new parameters
+            self.play_out = asyncio.ensure_future(self.drain_stream())
+            try:
+                await self.play_out
+            finally:
+                self.play_out = None
+            await self.stop_stream()
+        self.rsp_len = rsp_len
+        self.stream_params = (form, channels, rate, frames_per_buffer)
+        self.stream_ended = False
+        self.codec = make_codec(codec_id, channels, pyaudio.get_sample_size(form))
+        self.jitter.start_stream(self.rsp_len // frame_len * frames_per_buffer, rate)
+        self.timeline.start(rate, frame_len // frames_per_buffer)
+        local_start = self.clock.to_local(start_time) if start_time is not None and self.clock.synced else None
+        self.alignment = (local_start, rate)
+        self.stream_start_time = start_time
+        stream_id, group, port = decode_datagram_fields(msg_body)
+        if stream_id:
+            self.watch_datagrams(group, port)
+            self.datagrams.start(stream_id, self.codec, self.timeline, pyaudio.get_sample_size(form), channels)
+        else:
+            self.datagrams.stop()
+        self.audio_stream.create_stream(form=form, channels=channels, rate=rate,
+                                        frames_per_buffer=frames_per_buffer,
+                                        stream_callback=make_read_callback(self.audio_stream, self.ring,
+                                                                           on_read=self.on_read),
+                                        local_start=local_start)
+        self.audio_stream.start_frame = -1 if decode_standby(msg_body) else 0
+        self.audio_stream.state = AudioStreamState.WAITING_FOR_STREAM
+        self.state = ClientState.ACTIVE
+        print("Client: Preloading queue")
+        if not stream_id:
+            self.grant_credit(self.jitter.target_chunks)
+        # otherwise the Server sends datagrams ahead of time without credit, playing starts with the first
+
+    def start_standby(self, start_frame):
+        """Unmutes the stream prepared on standby from start_frame on"""
+        self.audio_stream.start_frame = start_frame
+        print(f"Client: Starting the stream prepared on standby at frame {start_frame}")
+
+    async def handle_halt(self):
+        """Stops playing and tells the Server how far into the stream it played in a HALT_RSP"""
+        if self.audio_stream.state == AudioStreamState.PLAYING:
+            self.audio_stream.end_time = time.time()
+        # counts frames skipped to keep in step too
+        duration = self.audio_stream.aligner.played_seconds()
+        if self.datagrams.stream_id is not None:
+            print(f'Client: {self.datagrams.report()}')
+            self.datagrams.stop()
+        await self.stop_stream()
+        self.audio_stream.state = AudioStreamState.NOT_PLAYING
+        self.writer.write(encode_message(ClientServerMsg.HALT_RSP, DURATION.pack(duration)))
+        self.state = ClientState.INACTIVE
+
+    async def run(self):
+        """Connects to the Server and handles its messages until it disconnects"""
+        self.loop = asyncio.get_event_loop()
+        reader, self.writer = await asyncio.open_connection(self.hostname, self.portname)
+        self.writer.write(encode_hello(max_rsp_len=self.ring.capacity // RSPS_PER_RING,
+                                       datagram_port=self.datagrams.port if USE_DATAGRAMS else 0))
+        try:
+            check_hello_rsp(*await asyncio.wait_for(read_message(reader), HANDSHAKE_TIMEOUT))
+        except asyncio.TimeoutError:
+            raise ProtocolError("the Server didn't answer the HELLO, it speaks an older protocol")
+        self.watch_datagrams()
+        clock_task = asyncio.ensure_future(self.sync_clock())
+        try:
+            while True:
+                msg_code, msg_body = await read_message(reader)
+                if msg_code == ClientServerMsg.NEW_STREAM:
+                    print("Client: Got New Stream from Server")
+                    await self.interrupt_stream_setup()
+                    if not self.continue_stream(msg_body):
+                        self.stream_setup = asyncio.ensure_future(self.start_new_stream(msg_body))
+
+                elif msg_code == ClientServerMsg.STREAM_RSP and self.state == ClientState.ACTIVE:
+                    if len(msg_body) == 0:
+                        # end of the Server's playlist, no more chunks are coming
+                        self.stream_ended = True
+                        self.credit = 0
+                    else:
+                        self.credit -= 1
+                        self.jitter.on_arrival()
+                        queue_chunk(self.ring, self.codec, self.timeline, msg_body)
+                    # start playing once the whole preload window arrived
+                    if self.credit == 0:
+                        self.start_playing()
+                    self.refill()
+
+                elif msg_code == ClientServerMsg.START:
+                    # the listener walked into this room, unmute the stream prepared on standby once it is
+                    # set up
+                    start_frame = START_FRAME.unpack_from(msg_body, 0)[0]
+                    if self.stream_setup is not None and not self.stream_setup.done():
+                        self.stream_setup.add_done_callback(
+                            lambda setup: setup.cancelled() or self.start_standby(start_frame))
+                    else:
+                        self.start_standby(start_frame)
+
+                elif msg_code == ClientServerMsg.HALT:
+                    await self.interrupt_stream_setup()
+                    await self.handle_halt()
+
+                elif msg_code == ClientServerMsg.TIME_RSP:
+                    on_time_rsp(self.clock, msg_body)
+        except asyncio.IncompleteReadError:
+            print("Client: Server closed the connection")
+        finally:
+            clock_task.cancel()
+            await self.interrupt_stream_setup()
+            for sock in self.datagrams.sockets():
+                self.loop.remove_reader(sock)
+            await self.stop_stream()
+            self.datagrams.close()
+            self.writer.close()
 
 
 def main():
     # Inter-process communication (IPC) objects used for communication between Client and AudioStream
     # processes
-    comm_queue = mp.Queue()
-    comm_array = mp.Array('f',4)
-    comm_val = mp.Value('i',0)
+    comm_ring = AudioRingBuffer(RING_CAPACITY)
+    # PyAudio stream parameters, its scheduled start, which needs double precision, the frame of the
+    # stream the queue starts at and the frame it is heard from (-1 while muted on standby)
+    comm_array = mp.Array('d', 7)
+    comm_val = SharedMsg()
 
     # start Client process
-    p2 = mp.Process(target=client_process, args=(comm_queue, comm_array, comm_val))
+    p2 = mp.Process(target=client_process, args=(comm_ring, comm_array, comm_val))
     p2.start()
 
-    audio_stream_process(comm_queue, comm_array, comm_val)
+    audio_stream_process(comm_ring, comm_array, comm_val)
     print("AudioStream process completed.")
     p2.join()
+    comm_ring.close()
+    comm_ring.unlink()
 
 if __name__ == '__main__':
-    main()
+    if '--single-process' in sys.argv:
+        # play in this process only, without a separate Client process
+        asyncio.run(AsyncClient(host, port).run())
+    else:
+        main()
     py_audio.terminate()
\ No newline at end of file
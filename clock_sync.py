@@ -0,0 +1,202 @@
+import math
+import time
+from collections import deque
+
+# number of recent TIME_REQ/TIME_RSP exchanges the offset is picked from
+CLOCK_SYNC_WINDOW = 8
+# TIME_REQs sent right after connecting, and seconds between TIME_REQs after that
+CLOCK_SYNC_BURST = 4
+CLOCK_SYNC_INTERVAL = 5.
+# seconds playback may be off the Server's timeline before it is corrected
+SYNC_TOLERANCE = .003
+# errors larger than this many tolerances are corrected right away instead of being smoothed first,
+# e.g. when playback starts late
+SYNC_JUMP_TOLERANCES = 10
+# gain of the smoothed playback error, which evens out the jitter of the audio callbacks
+SYNC_GAIN = 1 / 8
+
+
+class ClockSync:
+    def __init__(self, window=CLOCK_SYNC_WINDOW):
+        """
+        ClockSync: estimates the offset of the Server's clock from this one like NTP. Each exchange
+        records the time the TIME_REQ was sent (t0), received by the Server (t1), answered by the Server
+        (t2) and the TIME_RSP received (t3). The exchange with the smallest round trip of the last few is
+        trusted the most, since it was delayed the least by queueing.
+        :param window: number of recent exchanges to pick the offset from
+        """
+        # (round trip delay, offset) of the recent exchanges
+        self.samples = deque(maxlen=window)
+        # seconds to add to a time of this clock to get the Server's time
+        self.offset = 0.
+        self.delay = float('nan')
+        self.last_request = float('-inf')
+        self.num_requests = 0
+
+    @property
+    def synced(self):
+        """whether at least one exchange completed"""
+        return bool(self.samples)
+
+    def request_due(self, now=None):
+        """
+        :param now: time.time(), defaults to now
+        :return bool: whether it's time to send another TIME_REQ
+        """
+        now = time.time() if now is None else now
+        if self.num_requests < CLOCK_SYNC_BURST:
+            # a burst right away, one at a time
+            return len(self.samples) >= self.num_requests
+        return now - self.last_request >= CLOCK_SYNC_INTERVAL
+
+    def on_request(self, now=None):
+        """
+        Records that a TIME_REQ is being sent.
+        :param now: time.time() put in the TIME_REQ, defaults to now
+        :return float: now
+        """
+        now = time.time() if now is None else now
+        self.last_request = now
+        self.num_requests += 1
+        return now
+
+    def on_response(self, t0, t1, t2, t3=None):
+        """
+        Updates the offset with a completed exchange.
+        :param t0: time.time() the TIME_REQ was sent at
+        :param t1: Server time the TIME_REQ was received at
+        :param t2: Server time the TIME_RSP was sent at
+        :param t3: time.time() the TIME_RSP was received at, defaults to now
+        :return float: the offset
+        """
+        t3 = time.time() if t3 is None else t3
+        self.samples.append(((t3 - t0) - (t2 - t1), ((t1 - t0) + (t2 - t3)) / 2))
+        self.delay, self.offset = min(self.samples)
+        return self.offset
+
+    def to_local(self, server_time):
+        """:return float: time.time() at which the Server's clock reads server_time"""
+        return server_time - self.offset
+
+
+class PlaybackAligner:
+    def __init__(self, tolerance=SYNC_TOLERANCE):
+        """
+        PlaybackAligner: keeps a PyAudio stream on the Server's timeline so every speaker playing the
+        stream is heard in step. The audio callback compares how many frames of the stream it has handed
+        out with how many should have been heard by the time the next one is, and skips frames when it is
+        behind or plays silence when it is ahead. That covers starting late or early, underruns and the
+        sound card's clock drifting from the system clock.
+        :param tolerance: seconds playback may be off before it is corrected
+        """
+        self.tolerance = tolerance
+        # time.time() the first frame of the stream should be heard at, None while not aligning
+        self.local_start = None
+        self.rate = 0
+        # frames of the stream handed out or skipped so far
+        self.position = 0
+        # smoothed number of frames playback is behind the timeline, negative when ahead
+        self.error = float('nan')
+        # total frames skipped and silence frames played to stay aligned
+        self.skipped = 0
+        self.inserted = 0
+
+    def start(self, local_start, rate, position=0):
+        """
+        Starts aligning a new stream.
+        :param local_start: time.time() its first frame should be heard at, None to play as it comes
+        :param rate: frames per second of the stream
+        :param position: frame of the stream the first frame handed out is, when joining it late
+        """
+        self.local_start = local_start
+        self.rate = rate
+        self.position = position
+        self.error = float('nan')
+
+    def consumed(self, num_frames):
+        """Records that num_frames more frames of the stream were handed out or skipped"""
+        self.position += num_frames
+
+    def correction(self, play_time):
+        """
+        :param play_time: time.time() at which the next frame handed out will be heard
+        :return int: frames to skip if positive, frames of silence to play first if negative
+        """
+        if self.local_start is None:
+            return 0
+        error = (play_time - self.local_start) * self.rate - self.position
+        tolerance = self.tolerance * self.rate
+        if math.isnan(self.error) or abs(error - self.error) > SYNC_JUMP_TOLERANCES * tolerance:
+            self.error = error
+        else:
+            self.error += SYNC_GAIN * (error - self.error)
+        if abs(self.error) <= tolerance:
+            return 0
+        frames = int(self.error)
+        # the correction is applied, so the estimate moves along with it
+        self.error -= frames
+        if frames > 0:
+            self.skipped += frames
+        else:
+            self.inserted -= frames
+        return frames
+
+    def unapplied(self, num_frames):
+        """
+        Records that part of the last correction couldn't be applied yet, e.g. more silence than fits in
+        one buffer or a skip past the queued audio, so the rest follows with the next buffers.
+        :param num_frames: the part of the correction not applied, with its sign
+        """
+        self.error += num_frames
+        if num_frames > 0:
+            self.skipped -= num_frames
+        else:
+            self.inserted += num_frames
+
+    def played_seconds(self):
+        """:return float: seconds of the stream handed out or skipped so far"""
+        return self.position / self.rate if self.rate else 0.
+
+
+class StreamTimeline:
+    def __init__(self):
+        """
+        StreamTimeline: follows the presentation timestamps of the chunks written to the ring buffer, so
+        every byte in the ring stays at its place on the Server's timeline. A chunk starting later than
+        the previous one ended leaves a gap to be filled with silence, one starting earlier overlaps audio
+        already queued and its start is dropped.
+        """
+        # Server time the byte written next plays at, None before the first chunk of a stream
+        self.next_pts = None
+        # Server time the first byte written plays at, None before the first chunk of a stream
+        self.start_pts = None
+        self.rate = 0
+        self.frame_size = 0
+
+    def start(self, rate, frame_size):
+        """
+        Starts following a new stream.
+        :param rate: frames per second of the stream
+        :param frame_size: bytes per frame of the stream
+        """
+        self.next_pts = None
+        self.start_pts = None
+        self.rate = rate
+        self.frame_size = frame_size
+
+    def place(self, pts, num_bytes):
+        """
+        Places a chunk on the timeline.
+        :param pts: Server time the chunk's first frame plays at
+        :param num_bytes: length of the chunk's samples in bytes
+        :return: (gap, overlap), bytes of silence to write before the chunk and bytes to drop from its start
+        """
+        if self.start_pts is None:
+            self.start_pts = pts
+        offset = 0 if self.next_pts is None else round((pts - self.next_pts) * self.rate)
+        end_pts = pts + num_bytes / self.frame_size / self.rate
+        if self.next_pts is None or end_pts > self.next_pts:
+            self.next_pts = end_pts
+        if offset >= 0:
+            return offset * self.frame_size, 0
+        return 0, min(-offset * self.frame_size, num_bytes)
@@ -0,0 +1,210 @@
+import socket
+from collections import deque
+from audio_transform import conceal_loss
+from protocol import DATAGRAM_HEADER
+
+# every datagram starts with the id of its stream (announced in NEW_STREAM), its sequence number and the
+# server time its first frame is to be heard at, see protocol.DATAGRAM_HEADER, followed by the audio
+# encoded with the stream's codec
+DATAGRAM_HEADER_LEN = DATAGRAM_HEADER.size
+# most bytes of samples in one datagram before encoding, so datagrams fit in a Wi-Fi frame
+DATAGRAM_SAMPLES_LEN = 1200
+# size of the receiving sockets' buffers, several seconds of CD audio
+DATAGRAM_RCVBUF = 1 << 20
+# losses up to this many seconds are concealed by fading out the audio before them, longer ones are
+# silent
+CONCEAL_SECONDS = .05
+# time to live of multicast datagrams, 1 keeps them on the local network segment
+MULTICAST_TTL = 1
+# most datagrams of a stream kept until its NEW_STREAM is handled. The Server starts sending right after
+# the NEW_STREAM, so the first datagrams tend to arrive before the Client is ready for them
+DATAGRAM_BACKLOG = 256
+
+
+def frames_per_datagram(frame_size):
+    """:return int: frames of audio sent in each datagram of a stream with frame_size bytes per frame"""
+    return max(1, DATAGRAM_SAMPLES_LEN // frame_size)
+
+
+def encode_datagram(stream_id, seq, pts, payload):
+    """
+    :param stream_id: id of the stream from its NEW_STREAM
+    :param seq: sequence number of the datagram within the stream
+    :param pts: server time the datagram's first frame is to be heard at
+    :param payload: bytes-like audio encoded with the stream's codec
+    :return bytes: the datagram
+    """
+    return DATAGRAM_HEADER.pack(stream_id, seq, pts) + payload
+
+
+def open_multicast_sender(interface='0.0.0.0'):
+    """
+    Opens the Server's socket for sending datagrams to rooms.
+    :param interface: address of the interface multicast datagrams are sent from
+    :return socket.socket: non-blocking UDP socket
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+    sock.bind((interface, 0))
+    sock.setblocking(False)
+    return sock
+
+
+class DatagramReceiver:
+    def __init__(self, ring, port=0):
+        """
+        DatagramReceiver: Client side of the datagram transport. Reads the audio datagrams of the current
+        stream from a unicast socket and, once the Server names a multicast group, from a socket joined to
+        it, and writes them to the ring buffer at their presentation timestamps. Datagrams of other
+        streams and ones arriving after their place was passed are dropped. Audio lost in between is
+        concealed by repeating the audio before the loss while fading it out. Datagrams of a stream that
+        isn't being received are held back in case it is started next.
+        :param ring: AudioRingBuffer the audio is written to
+        :param port: UDP port to receive unicast datagrams on, 0 for any free port
+        """
+        self.ring = ring
+        self.sock = self.open_socket(port)
+        # socket joined to the stream's multicast group, and (group, port) it is joined to
+        self.group_sock = None
+        self.group = None
+        # id of the stream being received, None while not receiving
+        self.stream_id = None
+        self.codec = None
+        self.timeline = None
+        self.sample_width = 0
+        self.channels = 0
+        # sequence number expected next
+        self.next_seq = None
+        # the audio of the last datagram written, repeated to conceal a loss
+        self.last_pcm = b''
+        # recent datagrams of streams other than the current one
+        self.backlog = deque(maxlen=DATAGRAM_BACKLOG)
+        self.received = 0
+        self.lost = 0
+        self.late = 0
+        self.concealed_frames = 0
+
+    @staticmethod
+    def open_socket(port, group=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, DATAGRAM_RCVBUF)
+        if group is not None:
+            # every speaker on this host listening to the group gets its own copy
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', port))
+        if group is not None:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            socket.inet_aton(group) + socket.inet_aton('0.0.0.0'))
+        sock.setblocking(False)
+        return sock
+
+    @property
+    def port(self):
+        """UDP port unicast datagrams are received on, sent to the Server in the HELLO"""
+        return self.sock.getsockname()[1]
+
+    def sockets(self):
+        """:return list: the sockets datagrams arrive on"""
+        return [sock for sock in (self.sock, self.group_sock) if sock is not None]
+
+    def join(self, group, port):
+        """
+        Receives the datagrams sent to a multicast group from now on.
+        :param group: IPv4 address of the group
+        :param port: UDP port the group's datagrams are sent to
+        :return bool: whether a new socket was opened
+        """
+        if self.group == (group, port):
+            return False
+        self.leave()
+        self.group_sock = self.open_socket(port, group)
+        self.group = (group, port)
+        return True
+
+    def leave(self):
+        """Stops receiving the datagrams of the current multicast group"""
+        if self.group_sock is not None:
+            self.group_sock.close()
+        self.group_sock = None
+        self.group = None
+
+    def start(self, stream_id, codec, timeline, sample_width, channels):
+        """
+        Starts receiving a stream.
+        :param stream_id: id of the stream from its NEW_STREAM
+        :param codec: audio_codecs codec of the stream
+        :param timeline: clock_sync.StreamTimeline of the stream
+        :param sample_width: bytes per sample of the stream
+        :param channels: number of channels of the stream
+        """
+        self.stream_id = stream_id
+        self.codec = codec
+        self.timeline = timeline
+        self.sample_width = sample_width
+        self.channels = channels
+        self.next_seq = None
+        self.last_pcm = b''
+        backlog, self.backlog = self.backlog, deque(maxlen=DATAGRAM_BACKLOG)
+        for data in backlog:
+            self.receive(data)
+
+    def stop(self):
+        """Drops the datagrams of the current stream from now on"""
+        self.stream_id = None
+
+    def poll(self):
+        """
+        Handles every datagram waiting on the sockets without blocking.
+        :return int: number of datagrams read
+        """
+        num_read = 0
+        for sock in self.sockets():
+            while True:
+                try:
+                    data = sock.recv(65536)
+                except (BlockingIOError, InterruptedError):
+                    break
+                self.receive(data)
+                num_read += 1
+        return num_read
+
+    def receive(self, data):
+        """
+        Writes the audio of a datagram to the ring buffer, concealing any audio lost before it.
+        :param data: bytes of the datagram
+        """
+        if len(data) < DATAGRAM_HEADER_LEN:
+            return
+        stream_id, seq, pts = DATAGRAM_HEADER.unpack_from(data, 0)
+        if stream_id != self.stream_id:
+            self.backlog.append(data)
+            return
+        if self.next_seq is not None and seq < self.next_seq:
+            # its place in the ring was filled in already
+            self.late += 1
+            return
+        if self.next_seq is not None:
+            self.lost += seq - self.next_seq
+        self.next_seq = seq + 1
+        self.received += 1
+        pcm = self.codec.decode(memoryview(data)[DATAGRAM_HEADER_LEN:])
+        gap, overlap = self.timeline.place(pts, len(pcm))
+        if gap:
+            frame_size = self.sample_width * self.channels
+            num_frames = max(0, min(gap, self.ring.free() - len(pcm))) // frame_size
+            fade_frames = max(1, int(CONCEAL_SECONDS * self.timeline.rate))
+            self.ring.write(conceal_loss(self.last_pcm, num_frames, self.sample_width, self.channels,
+                                         fade_frames))
+            self.concealed_frames += num_frames
+        self.ring.write(pcm[overlap:])
+        self.last_pcm = pcm
+
+    def report(self):
+        """:return str: a line describing the datagrams received"""
+        return (f'datagrams received {self.received}, lost {self.lost}, late {self.late}, '
+                f'concealed {self.concealed_frames} frames')
+
+    def close(self):
+        self.leave()
+        self.sock.close()
@@ -0,0 +1,150 @@
+import math
+import time
+from collections import deque
+
+# bounds of the target buffer depth, in chunks (STREAM_RSPs) of audio
+MIN_TARGET_CHUNKS = 2
+MAX_TARGET_CHUNKS = 30
+# target depth before anything has been measured
+INITIAL_TARGET_CHUNKS = 3
+# gain of the delay and jitter estimates, 1/16 like the RTP interarrival jitter of RFC 3550
+ESTIMATE_GAIN = 1 / 16
+# number of jitter estimates of headroom kept above the mean delay
+JITTER_HEADROOM = 4
+# chunks added to the target after an underrun, and chunks received without an underrun before one of
+# them is taken back
+UNDERRUN_STEP = 2
+UNDERRUN_DECAY_CHUNKS = 100
+
+
+class JitterBuffer:
+    def __init__(self, min_chunks=MIN_TARGET_CHUNKS, max_chunks=MAX_TARGET_CHUNKS,
+                 initial_chunks=INITIAL_TARGET_CHUNKS):
+        """
+        JitterBuffer: sizes the client's buffer from how long chunks take to arrive. Every chunk granted
+        in a STREAM_REQ is timed until its STREAM_RSP arrives. The buffer has to keep playing for that
+        long after asking for more, so the target depth covers the mean delay plus JITTER_HEADROOM times
+        its jitter. Underruns push the target up by UNDERRUN_STEP chunks, which decays again while the
+        link behaves.
+        :param min_chunks: smallest target depth in chunks
+        :param max_chunks: largest target depth in chunks
+        :param initial_chunks: target depth until the first chunk arrives
+        """
+        self.min_chunks = min_chunks
+        self.max_chunks = max_chunks
+        # seconds of audio in a chunk, set for each stream
+        self.chunk_seconds = 0.
+        # time.time() each outstanding granted chunk was requested at, oldest first
+        self.requested_at = deque()
+        # estimates in seconds of the delay between requesting and receiving a chunk, and of its jitter
+        self.delay = float('nan')
+        self.jitter = 0.
+        self.last_delay = float('nan')
+        # estimate of the time between consecutive STREAM_RSPs
+        self.interarrival = float('nan')
+        self.last_arrival = float('nan')
+        self.underruns = 0
+        self.underrun_boost = 0
+        self.chunks_since_underrun = 0
+        self.initial_chunks = initial_chunks
+        self.target_chunks = max(min_chunks, min(initial_chunks, max_chunks))
+
+    def start_stream(self, frames_per_buffer, rate):
+        """
+        Sets the length of the chunks of a new stream.
+        :param frames_per_buffer: frames in each chunk
+        :param rate: frames per second
+        """
+        self.set_chunk_length(frames_per_buffer, rate)
+        self.reset()
+
+    def set_chunk_length(self, frames_per_buffer, rate):
+        """
+        Sets the length of the chunks without forgetting the outstanding requests, e.g. when the stream
+        continues with another track.
+        :param frames_per_buffer: frames in each chunk
+        :param rate: frames per second
+        """
+        self.chunk_seconds = frames_per_buffer / rate
+
+    def reset(self):
+        """Forgets the outstanding requests, e.g. when the Server drops the credit on a HALT"""
+        self.requested_at.clear()
+        self.last_arrival = float('nan')
+
+    def on_request(self, num_chunks, now=None):
+        """
+        Records that num_chunks more chunks were granted.
+        :param num_chunks: chunks granted in the STREAM_REQ
+        :param now: time.time() of the request, defaults to now
+        """
+        now = time.time() if now is None else now
+        self.requested_at.extend([now] * num_chunks)
+
+    def on_arrival(self, now=None):
+        """
+        Records that a STREAM_RSP arrived and updates the target depth.
+        :param now: time.time() of the arrival, defaults to now
+        :return int: the target depth in chunks
+        """
+        now = time.time() if now is None else now
+        if not math.isnan(self.last_arrival):
+            gap = now - self.last_arrival
+            self.interarrival = gap if math.isnan(self.interarrival) \
+                else self.interarrival + ESTIMATE_GAIN * (gap - self.interarrival)
+        self.last_arrival = now
+        if not self.requested_at:
+            return self.target_chunks
+        delay = now - self.requested_at.popleft()
+        if math.isnan(self.delay):
+            self.delay = delay
+        else:
+            self.delay += ESTIMATE_GAIN * (delay - self.delay)
+            self.jitter += ESTIMATE_GAIN * (abs(delay - self.last_delay) - self.jitter)
+        self.last_delay = delay
+
+        self.chunks_since_underrun += 1
+        if self.underrun_boost > 0 and self.chunks_since_underrun >= UNDERRUN_DECAY_CHUNKS:
+            self.underrun_boost -= 1
+            self.chunks_since_underrun = 0
+        return self.update_target()
+
+    def on_underruns(self, underruns):
+        """
+        Updates the number of underruns the player has had, growing the target for each new one.
+        :param underruns: total number of underruns so far
+        :return bool: whether there were new underruns
+        """
+        if underruns <= self.underruns:
+            return False
+        self.underrun_boost += UNDERRUN_STEP * (underruns - self.underruns)
+        self.underruns = underruns
+        self.chunks_since_underrun = 0
+        self.update_target()
+        return True
+
+    def skip_underruns(self, underruns):
+        """
+        Counts underruns that say nothing about the link, like the silence played after the stream ended,
+        without growing the target.
+        :param underruns: total number of underruns so far
+        """
+        self.underruns = max(self.underruns, underruns)
+
+    def update_target(self):
+        """:return int: the target depth in chunks, recomputed from the current estimates"""
+        needed = self.initial_chunks
+        if self.chunk_seconds > 0 and not math.isnan(self.delay):
+            # the chunk being played plus enough to cover fetching the next one
+            needed = 1 + math.ceil((self.delay + JITTER_HEADROOM * self.jitter) / self.chunk_seconds)
+        self.target_chunks = max(self.min_chunks, min(needed + self.underrun_boost, self.max_chunks))
+        return self.target_chunks
+
+    def report(self, depth):
+        """
+        :param depth: number of chunks currently buffered
+        :return str: a line describing the buffer
+        """
+        return (f'depth {depth}/{self.target_chunks} chunks, delay {self.delay * 1000:.1f} ms, '
+                f'jitter {self.jitter * 1000:.1f} ms, interarrival {self.interarrival * 1000:.1f} ms, '
+                f'underruns {self.underruns}')
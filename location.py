@@ -0,0 +1,577 @@
+import csv
+import queue
+import threading
+import time
+from collections import deque
+import numpy as np
+
+# weight of each new RSSI reading in the exponentially weighted moving average
+EWMA_ALPHA = .3
+# Kalman filter variances (dB^2): how much the true RSSI drifts between readings, and how noisy a
+# single reading is (raw readings jitter by about +-10 dB)
+RSSI_PROCESS_VAR = .5
+RSSI_MEASUREMENT_VAR = 25.
+# number of raw readings kept per beacon
+RSSI_HISTORY_LEN = 32
+# confidence the classifier has to keep in a new room for the listener to be moved there. Readings near
+# the edge of a room score low, so the listener has to walk a little into the room: the hysteresis that
+# keeps a listener standing on a boundary in one room
+SWITCH_MIN_CONFIDENCE = .25
+# seconds a new room has to be kept before switching to it, and before switching to no room at all.
+# Leaving every room silences the speakers, so brief dropouts shouldn't do that
+SWITCH_DWELL_SECONDS = 1.5
+LEAVE_DWELL_SECONDS = 5.
+# least seconds between two switches, and most switches in any minute
+SWITCH_MIN_INTERVAL = 3.
+SWITCH_MAX_PER_MINUTE = 6
+# seconds between the repeated on_candidate calls while a candidate room lasts, so whatever the call
+# prepares can expire once the listener stops being headed there
+CANDIDATE_REPEAT_SECONDS = 4.
+# fingerprints voting on the room of a reading, and root mean square distance per beacon (dB) to the
+# nearest fingerprint beyond which a reading is outside every room
+FINGERPRINT_NEIGHBOURS = 5
+FINGERPRINT_MAX_DISTANCE = 12.
+# fingerprints in each cell of the FingerprintClassifier's index, about, and the cells nearest to a
+# reading whose fingerprints it is compared with. The more fingerprints a cell holds the fewer centroids
+# there are to compare a reading with first, the more probes the less likely a nearest fingerprint lies
+# in a cell not searched
+FINGERPRINT_CELL_SIZE = 64
+FINGERPRINT_PROBES = 4
+# rounds of k-means clustering the fingerprints into cells
+KMEANS_ITERATIONS = 8
+# readings classified at a time, bounding the memory of the distances to their candidate fingerprints
+CLASSIFY_BATCH = 256
+
+
+class RssiFilter:
+    def __init__(self, mode='ewma', alpha=EWMA_ALPHA, process_var=RSSI_PROCESS_VAR,
+                 measurement_var=RSSI_MEASUREMENT_VAR, history_len=RSSI_HISTORY_LEN):
+        """
+        RssiFilter: smooths the RSSI readings of one beacon online with constant memory. Also keeps the
+        running mean and variance of every reading and the last history_len raw readings.
+        :param mode: 'ewma' for an exponentially weighted moving average or 'kalman' for a 1-D Kalman
+            filter
+        :param alpha: weight of each new reading in 'ewma' mode
+        :param process_var: variance the true RSSI drifts by between readings in 'kalman' mode
+        :param measurement_var: variance of a single reading in 'kalman' mode
+        :param history_len: number of raw readings kept in the ring buffer
+        """
+        if mode not in ('ewma', 'kalman'):
+            raise ValueError(f"unknown RSSI filter mode {mode}")
+        self.mode = mode
+        self.alpha = alpha
+        self.process_var = process_var
+        self.measurement_var = measurement_var
+        # smoothed RSSI, NaN until the first reading
+        self.value = float('nan')
+        # Kalman estimate variance
+        self.estimate_var = measurement_var
+        # ring buffer of raw readings, self.history_pos is where the next one is written
+        self.history = np.full(history_len, np.nan)
+        self.history_pos = 0
+        # running statistics of every reading (Welford's algorithm)
+        self.num_samples = 0
+        self.mean = float('nan')
+        self._sum_sq_diff = 0.
+
+    def update(self, rssi):
+        """
+        Adds a raw reading.
+        :param rssi: RSSI in dBm
+        :return float: the smoothed RSSI
+        """
+        self.history[self.history_pos] = rssi
+        self.history_pos = (self.history_pos + 1) % len(self.history)
+        self.num_samples += 1
+        if self.num_samples == 1:
+            self.mean = float(rssi)
+            self.value = float(rssi)
+            return self.value
+
+        diff = rssi - self.mean
+        self.mean += diff / self.num_samples
+        self._sum_sq_diff += diff * (rssi - self.mean)
+        if self.mode == 'ewma':
+            self.value += self.alpha * (rssi - self.value)
+        else:
+            self.estimate_var += self.process_var
+            gain = self.estimate_var / (self.estimate_var + self.measurement_var)
+            self.value += gain * (rssi - self.value)
+            self.estimate_var *= 1 - gain
+        return self.value
+
+    @property
+    def variance(self):
+        """Sample variance of every reading so far, NaN with fewer than 2 readings"""
+        if self.num_samples < 2:
+            return float('nan')
+        return self._sum_sq_diff / (self.num_samples - 1)
+
+    def recent(self):
+        """:return np.ndarray: the raw readings in the ring buffer, oldest first"""
+        if self.num_samples < len(self.history):
+            return self.history[:self.num_samples].copy()
+        return np.roll(self.history, -self.history_pos)
+
+
+class RoomClassifier:
+    def __init__(self, beacons, rooms_dict):
+        """
+        RoomClassifier: decides which room a vector of beacon RSSI readings was taken in. The regions of
+        rooms_dict are stored as arrays of RSSI ranges so any number of readings can be checked against
+        every region of every room in one vectorized call.
+        :param beacons: MAC addresses of the beacons, in the order their ranges appear in rooms_dict
+        :param rooms_dict: dict of room number -> list of regions. Each region is a list with one
+            [upper, lower] RSSI range (dBm, inclusive) per beacon. A range of None leaves that beacon
+            unconstrained, and regions may list fewer ranges than there are beacons
+        """
+        self.beacons = list(beacons)
+        # MAC address -> column of that beacon's readings
+        self.beacon_index = {addr: i for i, addr in enumerate(self.beacons)}
+        regions = [(room, region) for room in rooms_dict for region in rooms_dict[room]]
+        # room number of each region
+        self.region_rooms = np.array([room for room, region in regions], dtype=int)
+        upper = np.full((len(regions), len(self.beacons)), np.inf)
+        lower = np.full((len(regions), len(self.beacons)), -np.inf)
+        for i, (room, region) in enumerate(regions):
+            for j, rssi_range in enumerate(region):
+                if rssi_range is not None:
+                    upper[i, j], lower[i, j] = rssi_range
+        self.upper = upper
+        self.lower = lower
+        # beacons whose readings a region constrains
+        self.constrained = np.isfinite(upper) & np.isfinite(lower)
+        self.center = np.where(self.constrained, (upper + lower) / 2, 0.)
+        # half the width of each range. Ranges of a single value are treated as half a dB wide
+        self.half_width = np.where(self.constrained, np.maximum((upper - lower) / 2, .5), 1.)
+
+    def rssi_vector(self, readings):
+        """
+        Converts readings keyed by MAC address to a vector ordered like self.beacons. Readings of
+        unknown devices are ignored and beacons without a reading are NaN.
+        :param readings: dict of MAC address -> RSSI
+        :return np.ndarray: RSSI vector of shape (num_beacons,)
+        """
+        rssi = np.full(len(self.beacons), np.nan)
+        for addr, value in readings.items():
+            i = self.beacon_index.get(addr)
+            if i is not None:
+                rssi[i] = value
+        return rssi
+
+    def classify(self, rssi):
+        """
+        Finds the room each RSSI vector lies in. Each reading scores 1 at the center of a region's range
+        and 0 at its edges, and a region scores the lowest of its readings' scores. The best scoring
+        region wins if its score isn't negative, i.e. every constrained reading lies inside its range.
+        A missing (NaN) reading never lies inside a range.
+        :param rssi: RSSI vector of shape (num_beacons,) or batch of them of shape (n, num_beacons)
+        :return: (rooms, confidence) arrays of shape (n,). rooms holds the room number of each vector,
+            0 if it isn't in any room. confidence is the score of the winning region clipped to [0, 1]
+        """
+        rssi = np.atleast_2d(np.asarray(rssi, dtype=float))
+        if len(self.region_rooms) == 0:
+            return np.zeros(len(rssi), dtype=int), np.zeros(len(rssi))
+        # (n, regions, beacons)
+        with np.errstate(invalid='ignore'):
+            score = 1 - np.abs(rssi[:, None, :] - self.center) / self.half_width
+        score[np.isnan(score)] = -np.inf
+        score = np.where(self.constrained, score, np.inf)
+        region_score = score.min(axis=2)
+        best = region_score.argmax(axis=1)
+        best_score = region_score[np.arange(len(rssi)), best]
+        rooms = np.where(best_score >= 0, self.region_rooms[best], 0)
+        confidence = np.clip(best_score, 0., 1.)
+        return rooms, confidence
+
+
+def kmeans(points, num_clusters, iterations=KMEANS_ITERATIONS):
+    """
+    Clusters points with Lloyd's k-means, starting from points spread evenly through them so the result
+    is the same every time.
+    :param points: np.ndarray of shape (n, dimensions)
+    :param num_clusters: number of clusters, at most n
+    :param iterations: rounds of reassigning the points and moving the centroids
+    :return: (centroids of shape (num_clusters, dimensions), cluster of each point)
+    """
+    centroids = points[np.linspace(0, len(points) - 1, num_clusters).astype(np.intp)].copy()
+    for _ in range(iterations):
+        distances = (points ** 2).sum(axis=1)[:, None] + (centroids ** 2).sum(axis=1) - 2 * points @ centroids.T
+        assignment = distances.argmin(axis=1)
+        counts = np.bincount(assignment, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, points)
+        # clusters left empty keep their centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids, assignment
+
+
+class FingerprintClassifier:
+    def __init__(self, beacons, vectors, rooms, confidence, rssi_floor, filter_mode='ewma',
+                 k=FINGERPRINT_NEIGHBOURS, max_distance=FINGERPRINT_MAX_DISTANCE):
+        """
+        FingerprintClassifier: decides rooms from the fingerprints of calibration recordings (see
+        calibration.py), each labeled offline with the room and confidence the fitted model gives it. A
+        reading gets the room of its k nearest fingerprints, their votes weighted by confidence. The
+        fingerprints of each room are clustered into cells of about FINGERPRINT_CELL_SIZE when the
+        classifier is built, and a reading is only compared with the fingerprints of the
+        FINGERPRINT_PROBES cells whose centroids are nearest to it, so classifying costs about the same
+        however many fingerprints were recorded. Readings farther than max_distance from every fingerprint
+        compared are outside all rooms. Readings below rssi_floor, and missing ones, count as rssi_floor
+        like in the fingerprints.
+        :param beacons: MAC addresses of the beacons, in the order of the vectors' columns
+        :param vectors: np.ndarray of fingerprints of shape (n, num_beacons)
+        :param rooms: np.ndarray of the room number of each fingerprint, 0 outside every room
+        :param confidence: np.ndarray of the confidence of each fingerprint in [0, 1]
+        :param rssi_floor: RSSI (dBm) of beacons that weren't heard
+        :param filter_mode: RssiFilter mode the readings were smoothed with when the model was fitted,
+            which the LocationTracker should use too
+        :param k: number of fingerprints voting
+        :param max_distance: root mean square distance per beacon (dB) to the nearest fingerprint
+            beyond which a reading is outside all rooms
+        """
+        self.beacons = list(beacons)
+        self.beacon_index = {addr: i for i, addr in enumerate(self.beacons)}
+        self.vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, len(self.beacons))
+        self.room_numbers, self.labels = np.unique(rooms, return_inverse=True)
+        self.rooms = np.asarray(rooms)
+        self.confidence = np.asarray(confidence, dtype=np.float32)
+        self.rssi_floor = rssi_floor
+        self.filter_mode = filter_mode
+        self.k = k
+        self.max_sq_distance = max_distance ** 2 * len(self.beacons)
+        self.build_index()
+
+    def build_index(self):
+        """
+        Clusters the fingerprints of every room into cells. self.centroids holds the centroid of every
+        cell, and each row of self.cell_members the fingerprints in it, padded with -1.
+        """
+        centroids, members = [], []
+        for label in range(len(self.room_numbers)):
+            indices = np.flatnonzero(self.labels == label)
+            num_cells = -(-len(indices) // FINGERPRINT_CELL_SIZE)
+            room_centroids, assignment = kmeans(self.vectors[indices], num_cells)
+            for cell in range(num_cells):
+                cell_members = indices[assignment == cell]
+                if len(cell_members):
+                    centroids.append(room_centroids[cell])
+                    members.append(cell_members)
+        self.centroids = np.array(centroids, dtype=np.float32).reshape(-1, len(self.beacons))
+        self.cell_members = np.full((len(members), max(map(len, members), default=0)), -1, dtype=np.intp)
+        for cell, cell_members in enumerate(members):
+            self.cell_members[cell, :len(cell_members)] = cell_members
+        self.probes = min(FINGERPRINT_PROBES, len(self.centroids))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a model file written by calibration.save_model().
+        :param path: path of the .npz model file
+        :return FingerprintClassifier: the model
+        """
+        with np.load(path) as model:
+            return cls([str(addr) for addr in model['beacons']], model['vectors'], model['rooms'],
+                       model['confidence'] / np.float32(255), float(model['rssi_floor']),
+                       str(model['filter_mode']))
+
+    def candidates(self, points):
+        """
+        :param points: RSSI vectors of shape (n, num_beacons)
+        :return np.ndarray: indices of the fingerprints each point is compared with, shape (n, candidates)
+            padded with -1
+        """
+        distances = (points ** 2).sum(axis=1)[:, None] + (self.centroids ** 2).sum(axis=1) \
+            - 2 * points @ self.centroids.T
+        cells = np.argpartition(distances, self.probes - 1, axis=1)[:, :self.probes]
+        return self.cell_members[cells].reshape(len(points), -1)
+
+    def classify(self, rssi):
+        """
+        Finds the room of each RSSI vector, like RoomClassifier.classify().
+        :param rssi: RSSI vector of shape (num_beacons,) or batch of them of shape (n, num_beacons)
+        :return: (rooms, confidence) arrays of shape (n,)
+        """
+        rssi = np.atleast_2d(np.asarray(rssi, dtype=np.float32))
+        rssi = np.maximum(np.nan_to_num(rssi, nan=self.rssi_floor), self.rssi_floor)
+        rooms = np.zeros(len(rssi), dtype=int)
+        confidence = np.zeros(len(rssi))
+        if len(self.vectors) == 0:
+            return rooms, confidence
+        for start in range(0, len(rssi), CLASSIFY_BATCH):
+            points = rssi[start:start + CLASSIFY_BATCH]
+            candidates = self.candidates(points)
+            distances = ((self.vectors[candidates] - points[:, None, :]) ** 2).sum(axis=2)
+            distances[candidates < 0] = np.inf
+            k = min(self.k, candidates.shape[1])
+            rows = np.arange(len(points))[:, None]
+            nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            nearest_distances = distances[rows, nearest]
+            nearest = candidates[rows, nearest]
+            # padding that made it among the nearest doesn't vote
+            weights = np.where(np.isfinite(nearest_distances), self.confidence[nearest], 0.)
+            votes = np.zeros((len(points), len(self.room_numbers)))
+            np.add.at(votes, (rows, self.labels[nearest]), weights)
+            best = votes.argmax(axis=1)
+            outside = nearest_distances.min(axis=1) > self.max_sq_distance
+            batch = slice(start, start + len(points))
+            rooms[batch] = np.where(outside, 0, self.room_numbers[best])
+            confidence[batch] = np.where(outside, 0., votes[rows[:, 0], best] / self.k)
+        return rooms, confidence
+
+
+class LocationTracker:
+    def __init__(self, beacons, rooms_dict, filter_mode='ewma', on_room_change=None, classifier=None):
+        """
+        LocationTracker: smooths each beacon reading as it arrives and reclassifies the listener's room
+        right away, so room changes are noticed within one advertisement.
+        :param beacons: MAC addresses of the beacons, in the order their ranges appear in rooms_dict
+        :param rooms_dict: room regions, see RoomClassifier
+        :param filter_mode: RssiFilter mode smoothing each beacon's readings
+        :param on_room_change: optional function called with (room, confidence, received_at) whenever
+            the room changes
+        :param classifier: optional classifier with the interface of RoomClassifier, such as a
+            FingerprintClassifier, used instead of beacons and rooms_dict
+        """
+        self.classifier = RoomClassifier(beacons, rooms_dict) if classifier is None else classifier
+        beacons = self.classifier.beacons
+        self.filters = {addr: RssiFilter(filter_mode) for addr in beacons}
+        # smoothed RSSI of each beacon, NaN until its first reading
+        self.rssi = np.full(len(beacons), np.nan)
+        self.room = 0
+        self.confidence = 0.
+        self.on_room_change = on_room_change
+
+    def update(self, addr, rssi, received_at=None):
+        """
+        Adds a reading. Readings of devices that aren't beacons are ignored.
+        :param addr: MAC address of the device
+        :param rssi: RSSI in dBm
+        :param received_at: time.time() the reading was received, defaults to now
+        :return int: the room the listener is in, 0 if they aren't in any room
+        """
+        i = self.classifier.beacon_index.get(addr)
+        if i is None:
+            return self.room
+        self.rssi[i] = self.filters[addr].update(rssi)
+        rooms, confidence = self.classifier.classify(self.rssi)
+        self.confidence = float(confidence[0])
+        if rooms[0] != self.room:
+            self.room = int(rooms[0])
+            if self.on_room_change is not None:
+                self.on_room_change(self.room, self.confidence,
+                                    time.time() if received_at is None else received_at)
+        return self.room
+
+
+class RoomSwitchScheduler:
+    def __init__(self, on_switch, min_confidence=SWITCH_MIN_CONFIDENCE, dwell=SWITCH_DWELL_SECONDS,
+                 leave_dwell=LEAVE_DWELL_SECONDS, min_interval=SWITCH_MIN_INTERVAL,
+                 max_per_minute=SWITCH_MAX_PER_MINUTE, on_candidate=None,
+                 candidate_interval=CANDIDATE_REPEAT_SECONDS):
+        """
+        RoomSwitchScheduler: sits between the LocationTracker and the StreamServer and decides when the
+        listener really moved. Every switch halts one room and restarts and preloads the next, so a
+        room the classifier reports becomes a candidate that only wins once it was reported with enough
+        confidence for the whole dwell time and the switch rate limits allow it. Candidates dropped
+        before that are counted as suppressed switches.
+        :param on_switch: function called with (room, confidence, decided_at) for every switch
+        :param min_confidence: confidence a candidate room has to keep, see SWITCH_MIN_CONFIDENCE. Not
+            needed for room 0
+        :param dwell: seconds a candidate room has to last
+        :param leave_dwell: seconds a candidate of room 0 has to last
+        :param min_interval: least seconds between two switches
+        :param max_per_minute: most switches in any 60 seconds
+        :param on_candidate: optional function called with (room, confidence, now) whenever a room other
+            than 0 becomes the candidate, the room the listener is likely to walk into next, and again
+            every candidate_interval seconds while it stays the candidate
+        :param candidate_interval: seconds between the repeated on_candidate calls
+        """
+        self.on_switch = on_switch
+        self.on_candidate = on_candidate
+        self.candidate_interval = candidate_interval
+        self.min_confidence = min_confidence
+        self.dwell = dwell
+        self.leave_dwell = leave_dwell
+        self.min_interval = min_interval
+        self.max_per_minute = max_per_minute
+        # room the listener was switched to
+        self.room = 0
+        # room the classifier reports instead, None if it agrees with self.room
+        self.candidate = None
+        # time.time() since which the candidate has been reported confidently, None if it isn't now
+        self.confident_since = None
+        self.confidence = 0.
+        # time.time() on_candidate was last called for the candidate
+        self.candidate_announced = None
+        # whether the candidate lasted long enough but was held back by the rate limits
+        self.rate_limited = False
+        # times of the switches in the last minute
+        self.switch_times = deque()
+        self.num_switches = 0
+        # switches suppressed because the candidate wasn't confident enough, didn't last the dwell time
+        # or was held back by the rate limits until it went away
+        self.suppressed = {'confidence': 0, 'dwell': 0, 'rate': 0}
+
+    @property
+    def num_suppressed(self):
+        return sum(self.suppressed.values())
+
+    def drop_candidate(self):
+        """Forgets the candidate room, counting it as a suppressed switch"""
+        if self.candidate is None:
+            return
+        if self.rate_limited:
+            self.suppressed['rate'] += 1
+        elif self.confident_since is not None:
+            self.suppressed['dwell'] += 1
+        else:
+            self.suppressed['confidence'] += 1
+        self.candidate = None
+        self.confident_since = None
+        self.rate_limited = False
+
+    def announce_candidate(self, now):
+        """Calls on_candidate for the candidate room, unless there's no room to walk into"""
+        self.candidate_announced = now
+        if self.candidate != 0 and self.on_candidate is not None:
+            self.on_candidate(self.candidate, self.confidence, now)
+
+    def update(self, room, confidence, now=None):
+        """
+        Adds a decision of the classifier, made for every reading.
+        :param room: room the classifier puts the listener in, 0 if none
+        :param confidence: the classifier's confidence in it
+        :param now: time.time() of the reading, defaults to now
+        :return int: the room the listener is switched to
+        """
+        now = time.time() if now is None else now
+        if room == self.room:
+            self.drop_candidate()
+            return self.room
+        self.confidence = confidence
+        if room != self.candidate:
+            self.drop_candidate()
+            self.candidate = room
+            self.announce_candidate(now)
+        if room == 0 or confidence >= self.min_confidence:
+            if self.confident_since is None:
+                self.confident_since = now
+        else:
+            # the dwell time starts over
+            self.confident_since = None
+        return self.poll(now)
+
+    def poll(self, now=None):
+        """
+        Switches to the candidate room once it is due. Called for every reading by update(), and should
+        be called now and then while no readings arrive so switches aren't delayed until the next one.
+        :param now: time.time(), defaults to now
+        :return int: the room the listener is switched to
+        """
+        now = time.time() if now is None else now
+        if self.candidate is not None and now - self.candidate_announced >= self.candidate_interval:
+            self.announce_candidate(now)
+        if self.candidate is None or self.confident_since is None:
+            return self.room
+        if now - self.confident_since < (self.leave_dwell if self.candidate == 0 else self.dwell):
+            return self.room
+        while self.switch_times and now - self.switch_times[0] >= 60.:
+            self.switch_times.popleft()
+        if (self.switch_times and now - self.switch_times[-1] < self.min_interval) \
+                or len(self.switch_times) >= self.max_per_minute:
+            self.rate_limited = True
+            return self.room
+        self.room = self.candidate
+        self.candidate = None
+        self.confident_since = None
+        self.rate_limited = False
+        self.switch_times.append(now)
+        self.num_switches += 1
+        self.on_switch(self.room, self.confidence, now)
+        return self.room
+
+    def report(self):
+        """:return str: a line describing the switches made and suppressed"""
+        reasons = ', '.join(f'{count} {reason}' for reason, count in self.suppressed.items())
+        return f'{self.num_switches} room switches, {self.num_suppressed} suppressed ({reasons})'
+
+
+def load_recording(path):
+    """
+    Reads advertisements recorded as CSV lines of seconds,addr,rssi where seconds counts from the start
+    of the recording.
+    :param path: path of the recording
+    :return list: (seconds, addr, rssi) tuples ordered by time
+    """
+    with open(path, newline='') as f:
+        recording = [(float(seconds), addr, float(rssi)) for seconds, addr, rssi in csv.reader(f)]
+    recording.sort(key=lambda adv: adv[0])
+    return recording
+
+
+class ReplayScanSource:
+    def __init__(self, recording, speed=1., repeat=False):
+        """
+        ReplayScanSource: stands in for BLE hardware by replaying recorded advertisements with their
+        original timing.
+        :param recording: list of (seconds, addr, rssi) tuples, see load_recording()
+        :param speed: playback speed, 2 replays twice as fast
+        :param repeat: start over once the recording ends instead of stopping
+        """
+        self.recording = recording
+        self.speed = speed
+        self.repeat = repeat
+
+    def run(self, push, stop_event):
+        """
+        Replays the recording until it ends or stop_event is set.
+        :param push: function taking (addr, rssi)
+        :param stop_event: threading.Event
+        """
+        while True:
+            start = time.time()
+            for seconds, addr, rssi in self.recording:
+                # waiting on the event lets stop() interrupt long gaps in the recording
+                if stop_event.wait(max(0., start + seconds / self.speed - time.time())):
+                    return
+                push(addr, rssi)
+            if not self.repeat or not self.recording:
+                return
+
+
+class BackgroundScanner:
+    def __init__(self, source):
+        """
+        BackgroundScanner: runs a scan source on a background thread and puts each advertisement it
+        reports on self.readings as (addr, rssi, received_at) the moment it arrives.
+        :param source: object with a run(push, stop_event) method such as ble_scanner.BluepyScanSource or
+            ReplayScanSource
+        """
+        self.source = source
+        # unbounded queue.SimpleQueue, put and get never block on each other
+        self.readings = queue.SimpleQueue()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.source.run, args=(self.push, self.stop_event),
+                                       name='ble_scanner', daemon=True)
+
+    def push(self, addr, rssi):
+        self.readings.put((addr, rssi, time.time()))
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def get(self, timeout=None):
+        """
+        :param timeout: seconds to wait for a reading, None waits forever
+        :return: the next (addr, rssi, received_at) reading, None if timeout expired first
+        """
+        try:
+            return self.readings.get(timeout=timeout)
+        except queue.Empty:
+            return None
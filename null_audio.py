@@ -0,0 +1,113 @@
+import threading
+import time
+
+# Stands in for PyAudio where there is no sound card, e.g. in benchmark.py. Only the part of PyAudio's
+# interface client.py and Final_Server.py use is implemented. Streams play nothing but consume audio
+# from their callback at the real-time rate, like a sound card would.
+
+paContinue = 0
+paComplete = 1
+
+# sample formats, numbered like PyAudio's
+paFloat32 = 1
+paInt32 = 2
+paInt24 = 4
+paInt16 = 8
+paInt8 = 16
+paUInt8 = 32
+
+SAMPLE_SIZES = {paFloat32: 4, paInt32: 4, paInt24: 3, paInt16: 2, paInt8: 1, paUInt8: 1}
+
+
+def get_sample_size(format):
+    """:return int: bytes per sample of a sample format"""
+    return SAMPLE_SIZES[format]
+
+
+def get_format_from_width(width, unsigned=True):
+    """:return int: sample format of samples width bytes wide, picked the way PyAudio picks it"""
+    if width == 1:
+        return paUInt8 if unsigned else paInt8
+    return {2: paInt16, 3: paInt24, 4: paFloat32}[width]
+
+
+class NullStream:
+    def __init__(self, format, channels, rate, frames_per_buffer, stream_callback, on_play=None, start=True,
+                 **kwargs):
+        """
+        NullStream: a callback stream that calls stream_callback for frames_per_buffer frames every
+        frames_per_buffer / rate seconds on a thread of its own and throws the audio away. Each buffer is
+        due at a fixed time from the start of the stream, so a slow callback doesn't slow playback down.
+        :param on_play: optional function taking (stream, data, played_at), called with every buffer the
+            callback returns and the time.time() it is heard from
+        :param start: start playing right away
+        """
+        self.format = format
+        self.channels = channels
+        self.rate = rate
+        self.frames_per_buffer = frames_per_buffer
+        self.frame_size = get_sample_size(format) * channels
+        self.stream_callback = stream_callback
+        self.on_play = on_play
+        self.active = False
+        self.stopping = threading.Event()
+        self.thread = None
+        if start:
+            self.start_stream()
+
+    def start_stream(self):
+        self.stopping.clear()
+        self.active = True
+        self.thread = threading.Thread(target=self.play, name='null_audio', daemon=True)
+        self.thread.start()
+
+    def play(self):
+        start = time.time()
+        frames_played = 0
+        while not self.stopping.is_set():
+            due = start + frames_played / self.rate
+            # wait for the sound card to need the buffer, or stop
+            if self.stopping.wait(max(0., due - time.time())):
+                break
+            now = time.time()
+            time_info = {'input_buffer_adc_time': 0., 'current_time': now, 'output_buffer_dac_time': now}
+            data, return_code = self.stream_callback(None, self.frames_per_buffer, time_info, 0)
+            if self.on_play is not None:
+                self.on_play(self, data, now)
+            frames_played += self.frames_per_buffer
+            if return_code != paContinue:
+                break
+        self.active = False
+
+    def is_active(self):
+        return self.active
+
+    def get_output_latency(self):
+        return 0.
+
+    def stop_stream(self):
+        self.stopping.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.active = False
+
+    def close(self):
+        self.stop_stream()
+
+
+class PyAudio:
+    def __init__(self, on_play=None):
+        """
+        PyAudio: opens NullStreams instead of sound card streams.
+        :param on_play: optional function every stream opened calls with each buffer, see NullStream
+        """
+        self.on_play = on_play
+
+    def get_format_from_width(self, width, unsigned=True):
+        return get_format_from_width(width, unsigned)
+
+    def open(self, format, channels, rate, frames_per_buffer, stream_callback, start=True, **kwargs):
+        return NullStream(format, channels, rate, frames_per_buffer, stream_callback, self.on_play, start)
+
+    def terminate(self):
+        pass
@@ -0,0 +1,151 @@
+import struct
+from enum import IntEnum, auto
+
+# Wire format shared by client.py, Final_Server.py and server_demo.py, see mesages.txt. Every field is
+# little endian without padding, so it's the same whatever machine either end runs on, and every format
+# is compiled once here instead of being parsed again for each message.
+
+# bumped whenever the wire format changes. Both ends exchange it in the HELLO and HELLO_RSP and hang up
+# on a mismatch instead of garbling each other's messages
+PROTOCOL_VERSION = 1
+# first bytes of the HELLO and HELLO_RSP, so a peer that doesn't speak the protocol at all is recognized
+PROTOCOL_MAGIC = b'RMAU'
+
+# capabilities a Client advertises in its HELLO. The Server answers with the ones it uses, those both
+# ends have
+CAP_DATAGRAMS = 1 << 0  # receives audio in datagrams, see datagram_transport
+CAP_STANDBY = 1 << 1  # plays a stream muted until a START, see NEW_STREAM's flags
+CAPABILITIES = CAP_DATAGRAMS | CAP_STANDBY
+
+
+# Message subject sent between the Client and Server through sockets
+class ClientServerMsg(IntEnum):
+    # Server sends
+    HALT = auto()
+    NEW_STREAM = auto()
+    STREAM_RSP = auto()
+
+    # Client sends
+    HALT_RSP = auto()
+    STREAM_REQ = auto()
+    HELLO = auto()
+    TIME_REQ = auto()
+
+    # Server sends, answering a TIME_REQ
+    TIME_RSP = auto()
+
+    # Server sends, unmuting a stream prepared on standby
+    START = auto()
+
+    # Server sends, answering a HELLO
+    HELLO_RSP = auto()
+
+
+class ProtocolError(Exception):
+    """The peer speaks another version of the protocol, or something else entirely"""
+
+
+# message length including the header (uint32), then its ClientServerMsg (uint16)
+HEADER = struct.Struct('<IH')
+MSG_HEADER_LEN = HEADER.size
+# seconds a stream played for (HALT_RSP), and STREAM_RSP chunks a STREAM_REQ grants the Server
+DURATION = struct.Struct('<f')
+CREDIT = struct.Struct('<H')
+# times in seconds since the epoch by the Server's clock: scheduled starts, presentation timestamps and
+# the clock exchange
+TIMESTAMP = struct.Struct('<d')
+TIMESTAMP_LEN = TIMESTAMP.size
+# header of a STREAM_RSP followed by its presentation timestamp, packed in one go
+RSP_HEADER = struct.Struct('<IHd')
+# the Client's send time, the Server's receive time and its send time
+TIME_RSP = struct.Struct('<ddd')
+# frame of the stream a START unmutes at
+START_FRAME = struct.Struct('<I')
+# magic, version, capabilities, preferred frames per buffer, most frames per buffer, most bytes in a
+# STREAM_RSP, bitmask of codecs decoded, rate, channels and sample width played (0 for any), UDP port
+# datagrams are received on
+HELLO = struct.Struct('<4sHIIIIIIHHH')
+# magic, version, capabilities used
+HELLO_RSP = struct.Struct('<4sHI')
+# PyAudio format, channels, rate, frames per buffer, bytes per buffer, bytes of samples in each STREAM_RSP
+# once decoded, audio_codecs.Codec, start time, datagram stream id, multicast group (4 bytes as
+# socket.inet_aton packs it), group port, flags
+NEW_STREAM = struct.Struct('<IHIIIIHdI4sHH')
+# bits of NEW_STREAM's flags
+STREAM_STANDBY = 1  # muted until a START
+# stream id, sequence number and presentation timestamp of every audio datagram
+DATAGRAM_HEADER = struct.Struct('<IId')
+
+
+def encode_header(msg_code, len_body):
+    """Header of a message with a body of len_body bytes, for sending the body from its own buffer"""
+    return HEADER.pack(len_body + MSG_HEADER_LEN, msg_code)
+
+
+def encode_message(msg_code, msg_bytes=b''):
+    """
+    :param msg_code: ClientServerMsg of the message
+    :param msg_bytes: bytes-like body of the message
+    :return bytes: the message with its header
+    """
+    return HEADER.pack(len(msg_bytes) + MSG_HEADER_LEN, msg_code) + msg_bytes
+
+
+class MessageBuffer:
+    def __init__(self, msg_code, body):
+        """
+        MessageBuffer: a preallocated buffer for sending one kind of message with a fixed size body over
+        and over. The header is packed once and every message packs its fields into the same buffer, so
+        nothing is allocated per message. The buffer is only valid until the next pack(), so it suits
+        blocking writes like socket.sendall(). asyncio transports may keep a reference to what they're
+        given until it's sent.
+        :param msg_code: ClientServerMsg of the messages
+        :param body: struct.Struct of their body
+        """
+        self.body = body
+        self.buffer = bytearray(MSG_HEADER_LEN + body.size)
+        HEADER.pack_into(self.buffer, 0, len(self.buffer), msg_code)
+
+    def pack(self, *values):
+        """:return bytearray: the message carrying values"""
+        self.body.pack_into(self.buffer, MSG_HEADER_LEN, *values)
+        return self.buffer
+
+
+def check_handshake(magic, version):
+    """Raises ProtocolError unless the magic and version of a HELLO or HELLO_RSP match this end's"""
+    if magic != PROTOCOL_MAGIC:
+        raise ProtocolError("the peer doesn't speak the protocol, or an unversioned one")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"the peer speaks protocol version {version}, this end {PROTOCOL_VERSION}")
+
+
+def decode_hello(msg_body):
+    """
+    :param msg_body: bytes-like body of a HELLO
+    :return: (capabilities, preferred frames per buffer, most frames per buffer, most bytes in a
+        STREAM_RSP, codecs, rate, channels, sample width, datagram port)
+    """
+    if len(msg_body) < HELLO.size:
+        raise ProtocolError("the HELLO is too short for this version of the protocol")
+    magic, version, *fields = HELLO.unpack_from(msg_body, 0)
+    check_handshake(magic, version)
+    return fields
+
+
+def encode_hello_rsp(capabilities):
+    """:param capabilities: capabilities of the Client the Server uses"""
+    return encode_message(ClientServerMsg.HELLO_RSP,
+                          HELLO_RSP.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, capabilities))
+
+
+def decode_hello_rsp(msg_body):
+    """
+    :param msg_body: bytes-like body of a HELLO_RSP
+    :return int: capabilities the Server uses
+    """
+    if len(msg_body) < HELLO_RSP.size:
+        raise ProtocolError("the HELLO_RSP is too short for this version of the protocol")
+    magic, version, capabilities = HELLO_RSP.unpack_from(msg_body, 0)
+    check_handshake(magic, version)
+    return capabilities
@@ -0,0 +1,138 @@
+import time
+from multiprocessing import shared_memory
+
+# default size in bytes of the audio ring buffer. Must be a power of 2
+RING_CAPACITY = 1 << 23
+
+# seconds the producer waits between checks for free space when the ring is full
+RING_FULL_SLEEP = .01
+
+# the header holds two uint32 counters, the total number of bytes ever written and ever read. They
+# wrap around at 2**32 which is a multiple of the capacity, so counter % capacity stays a valid position.
+# A third counts the underruns the consumer has reported
+_WRITE_COUNT = 0
+_READ_COUNT = 1
+_UNDERRUN_COUNT = 2
+_HEADER_LEN = 12
+_COUNTER_MOD = 1 << 32
+
+
+class AudioRingBuffer:
+    def __init__(self, capacity=RING_CAPACITY, name=None, shared=True):
+        """
+        AudioRingBuffer: single producer, single consumer byte ring buffer in shared memory for passing
+        audio between processes without pickling. The producer only ever moves the write counter and
+        the consumer only the read counter, so neither side needs a lock.
+        :param capacity: size of the ring in bytes, a power of 2. Ignored when attaching
+        :param name: name of an existing ring to attach to. A new ring is created if None
+        :param shared: if False the ring lives in ordinary memory and can only pass data between threads
+            of one process
+        """
+        if name is None:
+            if capacity <= 0 or capacity & (capacity - 1):
+                raise ValueError(f"ring capacity must be a power of 2, got {capacity}")
+        if not shared:
+            self.shm = None
+            self._attach(memoryview(bytearray(_HEADER_LEN + capacity)))
+            return
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=_HEADER_LEN + capacity)
+            self.shm.buf[:_HEADER_LEN] = bytes(_HEADER_LEN)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self._attach(self.shm.buf)
+
+    def _attach(self, buf):
+        self.counters = buf[:_HEADER_LEN].cast('I')
+        self.data = buf[_HEADER_LEN:]
+        self.capacity = len(self.data)
+        # consumer side buffer for reads that wrap around the end of the ring
+        self.scratch = bytearray()
+
+    def __getstate__(self):
+        # processes started with the ring attach to the same shared memory by name
+        return self.shm.name
+
+    def __setstate__(self, name):
+        self.shm = shared_memory.SharedMemory(name=name)
+        self._attach(self.shm.buf)
+
+    def fill(self):
+        """:return int: number of bytes written but not yet read"""
+        return (self.counters[_WRITE_COUNT] - self.counters[_READ_COUNT]) % _COUNTER_MOD
+
+    def free(self):
+        """:return int: number of bytes that can be written without waiting"""
+        return self.capacity - self.fill()
+
+    def write(self, data):
+        """
+        Producer side: copies data into the ring, waiting for the consumer to free space if needed.
+        :param data: bytes-like object, at most self.capacity bytes
+        """
+        num_bytes = len(data)
+        if num_bytes > self.capacity:
+            raise ValueError(f"can't write {num_bytes} bytes to a ring of {self.capacity}")
+        while self.free() < num_bytes:
+            time.sleep(RING_FULL_SLEEP)
+        write_count = self.counters[_WRITE_COUNT]
+        pos = write_count % self.capacity
+        first = min(num_bytes, self.capacity - pos)
+        self.data[pos:pos + first] = data[:first]
+        self.data[:num_bytes - first] = data[first:]
+        # publish the bytes only once they have been copied
+        self.counters[_WRITE_COUNT] = (write_count + num_bytes) % _COUNTER_MOD
+
+    def peek(self, num_bytes):
+        """
+        Consumer side: returns up to num_bytes of the oldest unread bytes without consuming them. The
+        bytes are returned as a read-only memoryview into the ring when they're contiguous and copied to
+        a reused scratch buffer when they wrap around its end, so no new buffer is allocated. The view
+        is valid until advance() is called.
+        :param num_bytes: maximum number of bytes to return
+        :return memoryview: min(num_bytes, self.fill()) bytes
+        """
+        num_bytes = min(num_bytes, self.fill())
+        pos = self.counters[_READ_COUNT] % self.capacity
+        first = min(num_bytes, self.capacity - pos)
+        if first == num_bytes:
+            return self.data[pos:pos + num_bytes].toreadonly()
+        if len(self.scratch) < num_bytes:
+            self.scratch = bytearray(num_bytes)
+        self.scratch[:first] = self.data[pos:pos + first]
+        self.scratch[first:num_bytes] = self.data[:num_bytes - first]
+        return memoryview(self.scratch)[:num_bytes].toreadonly()
+
+    def advance(self, num_bytes):
+        """
+        Consumer side: marks num_bytes returned by peek() as read, allowing the producer to overwrite them.
+        :param num_bytes: number of bytes consumed
+        """
+        self.counters[_READ_COUNT] = (self.counters[_READ_COUNT] + num_bytes) % _COUNTER_MOD
+
+    def record_underrun(self):
+        """Consumer side: reports that the consumer needed data while the ring was empty"""
+        self.counters[_UNDERRUN_COUNT] = (self.counters[_UNDERRUN_COUNT] + 1) % _COUNTER_MOD
+
+    def underruns(self):
+        """:return int: number of underruns the consumer has reported"""
+        return self.counters[_UNDERRUN_COUNT]
+
+    def written(self):
+        """:return int: number of bytes the producer has written, modulo 2 ** 32"""
+        return self.counters[_WRITE_COUNT]
+
+    def clear(self):
+        """Drops every unread byte. Only call while the consumer isn't reading"""
+        self.counters[_READ_COUNT] = self.counters[_WRITE_COUNT]
+
+    def close(self):
+        self.counters.release()
+        self.data.release()
+        if self.shm is not None:
+            self.shm.close()
+
+    def unlink(self):
+        """Frees the shared memory. Call once, from the process that created the ring"""
+        if self.shm is not None:
+            self.shm.unlink()
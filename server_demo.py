@@ -2,112 +2,154 @@ import socket
 import wave
 import pyaudio
 import time
-from struct import *
-from enum import IntEnum, auto
+from protocol import (ClientServerMsg, ProtocolError, MSG_HEADER_LEN, HEADER, CREDIT, TIMESTAMP, TIME_RSP, RSP_HEADER,
+                      NEW_STREAM, encode_message, decode_hello, encode_hello_rsp)
 
 host = '127.0.0.1'
 port = 8000
 NUM_BYTES_TO_RECV = 65536  # max number of bytes to recv from socket
 
-MSG_HEADER_LEN = 6  # 4 bytes (msg length) + 2 bytes (ClientServer.Msg)
-MSG_LEN_PACKING_FORMAT = 'I'  # uint32
-MSG_CODE_PACKING_FORMAT = 'H'  # uint16, packing format of ClientServerMsg
+# the demo always streams uncompressed PCM, audio_codecs.Codec.PCM
+CODEC_PCM = 0
 
-"""TODO: Add format for frame size and check header still works"""
-# Packing format of duration (seconds) song has been played for
-DURATION_FORMAT = 'f'  # float32
-
-# Packing format of PyAudio stream initialization parameters
-AUDIO_FORMAT = 'I'  # uint32
-CHANNEL_FORMAT = 'H'  # uint16
-FPB_FORMAT = 'H'  # uint16
-FRAMERATE_FORMAT = 'H'  # uint16
-FRAME_LEN_FORMAT = 'I' #uint32
-
-# frames per buffer for PyAudio
+# frames per buffer for PyAudio, unless the client's HELLO asks for fewer
 FRAMES_PER_BUFFER = 16384
+# number of buffers sent in each STREAM_RSP
+BUFFERS_PER_RSP = 10
+# seconds from the NEW_STREAM to the time the stream is scheduled to be heard
+START_DELAY = .5
 
 # sleep time in seconds
 SLEEP_INTERVAL = .05
 SLEEP_INT_LARGE = .1
 
 
-# Message subject sent between the Client and server through sockets
-class ClientServerMsg(IntEnum):
-    """TODO: Add termination command from Server to terminate processes"""
-    # Server sends
-    HALT = auto()
-    NEW_STREAM = auto()
-    STREAM_RSP = auto()
-
-    # Client sends
-    HALT_RSP = auto()
-    STREAM_REQ = auto()
-
-
-wf = wave.open('wave_files/a_boogie.wav', 'rb')
+# wave file streamed, opened when the demo runs
+WAVE_PATH = 'wave_files/a_boogie.wav'
+wf = None
 py_audio = pyaudio.PyAudio()
 
-def get_data():
-    data = wf.readframes(FRAMES_PER_BUFFER)
+def get_data(num_buffers=1, frames_per_buffer=FRAMES_PER_BUFFER):
+    data = wf.readframes(num_buffers * frames_per_buffer)
     return data
 
-def get_stream_params():
+def get_stream_params(frames_per_buffer=FRAMES_PER_BUFFER):
     """Stream parameters for current stream"""
     stream_format = py_audio.get_format_from_width(wf.getsampwidth())
     num_channels = wf.getnchannels()
     stream_rate = wf.getframerate()
-    stream_frame_len = len(wf.readframes(FRAMES_PER_BUFFER))
-    wf.rewind()
+    stream_frame_len = frames_per_buffer * wf.getsampwidth() * num_channels
     return stream_format, num_channels, stream_rate, stream_frame_len
 
 def seconds_to_frame(seconds):
     """return the number of frames a duration in seconds represents"""
     # https://stackoverflow.com/questions/18721780/play-a-part-of-a-wav-file-in-python
     n_frames = int(seconds * wf.getframerate())
-
-def encode_message(msg_code, msg_bytes=b''):
-    len_msg = 0 if msg_bytes is None else len(msg_bytes)
-    len_msg += MSG_HEADER_LEN
-    encoded_message = pack(MSG_LEN_PACKING_FORMAT, len_msg) \
-                      + pack(MSG_CODE_PACKING_FORMAT, msg_code) + msg_bytes
-    return encoded_message
-
-# audio, channel, framerate, FPB, frame_len
-
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-    sock.bind((host,port))
-    print("server listening")
-    sock.listen()
-    conn, addr = sock.accept()
+    return n_frames
+
+def handle_messages(conn, data):
+    """
+    Handles the whole messages in data, a bytearray of the bytes received and not handled yet, and
+    removes them from it. A message split across recv() calls stays in data until the rest of it arrives.
+    TIME_REQs are answered right away
+    :return: (credit granted by the STREAM_REQs handled, body of the HELLO handled or None)
+    """
+    credit = 0
+    hello = None
+    pos = 0
+    while pos + MSG_HEADER_LEN <= len(data):
+        received_at = time.time()
+        len_msg, code = HEADER.unpack_from(data, pos)
+        if len_msg < MSG_HEADER_LEN:
+            raise ProtocolError(f"message {code} is shorter than its header")
+        if pos + len_msg > len(data):
+            break
+        body = bytes(data[pos+MSG_HEADER_LEN:pos+len_msg])
+        if code == ClientServerMsg.STREAM_REQ:
+            credit += CREDIT.unpack_from(body, 0)[0] if body else 1
+        elif code == ClientServerMsg.HELLO:
+            hello = body
+        elif code == ClientServerMsg.TIME_REQ:
+            sent_at = TIMESTAMP.unpack_from(body, 0)[0]
+            conn.sendall(encode_message(ClientServerMsg.TIME_RSP, TIME_RSP.pack(sent_at, received_at, time.time())))
+        pos += len_msg
+    del data[:pos]
+    return credit, hello
+
+def receive(conn, data):
+    """Appends the next bytes received from conn to data"""
+    received = conn.recv(1024)
+    if not received:
+        raise ConnectionError("the client closed the connection")
+    data += received
+
+def serve_client(conn):
+    """
+    Streams wf to a connected client until the client disconnects. Once wf ends the client is sent an
+    empty STREAM_RSP, like Final_Server does at the end of its playlist, and nothing more.
+    :param conn: socket of the client connection
+    """
+    # bytes received but not handled yet, the start of a message the rest of which didn't arrive yet
+    data = bytearray()
+    # the client opens with a HELLO carrying its protocol version, its preferred and maximum frames per
+    # buffer and the largest STREAM_RSP it accepts. The demo uses none of its capabilities
+    hello = None
+    while hello is None:
+        receive(conn, data)
+        credit, hello = handle_messages(conn, data)
+    try:
+        _, preferred_fpb, max_fpb, max_rsp_len, *_ = decode_hello(hello)
+    except ProtocolError:
+        conn.sendall(encode_hello_rsp(0))
+        raise
+    conn.sendall(encode_hello_rsp(0))
+    frames_per_buffer = min(preferred_fpb, max_fpb, FRAMES_PER_BUFFER)
 
     # get params of new stream
-    form, channels, rate, frame_len = get_stream_params()
-    msg_bytes = pack(AUDIO_FORMAT, form) + pack(CHANNEL_FORMAT, channels) + pack(FRAMERATE_FORMAT, rate) \
-       + pack(FPB_FORMAT, FRAMES_PER_BUFFER) + pack(FRAME_LEN_FORMAT, frame_len)
+    form, channels, rate, frame_len = get_stream_params(frames_per_buffer)
+    buffers_per_rsp = max(1, min(BUFFERS_PER_RSP, max_rsp_len // frame_len))
+    # the stream is scheduled to be heard START_DELAY from now, over the TCP connection and without standby
+    start_time = time.time() + START_DELAY
+    msg_bytes = NEW_STREAM.pack(form, channels, rate, frames_per_buffer, frame_len, buffers_per_rsp * frame_len,
+                                CODEC_PCM, start_time, 0, bytes(4), 0, 0)
     msg_code = ClientServerMsg.NEW_STREAM
     msg = encode_message(msg_code, msg_bytes)
     conn.sendall(msg)
+    frames_sent = 0
+    ended = False
 
-    data = conn.recv(1024)
-    code = unpack(MSG_CODE_PACKING_FORMAT, data[4:6])[0]
-    assert code == ClientServerMsg.STREAM_REQ
-    print ("got req code")
+    receive(conn, data)
     time.sleep(.2)
     while True:
         print("waiting...")
 
         print('Server: got rsp')
-        code = unpack(MSG_CODE_PACKING_FORMAT, data[4:6])[0]
-        print(code)
-        assert code == ClientServerMsg.STREAM_REQ
-        frames = b''
-        for i in range(10):
-            frames += get_data()
-        code = ClientServerMsg.STREAM_RSP
-        print("Server: sending data")
-        conn.sendall(encode_message(code, frames))
-        data = conn.recv(1024)
-
+        # data may hold several STREAM_REQs, each granting credit for a number of STREAM_RSPs
+        credit, _ = handle_messages(conn, data)
+        for i in range(0 if ended else credit):
+            # read all the buffers at once and send them after the header instead of concatenating
+            frames = get_data(buffers_per_rsp, frames_per_buffer)
+            code = ClientServerMsg.STREAM_RSP
+            if not frames:
+                # end of the file. A STREAM_RSP without a body tells the client no more chunks are coming
+                conn.sendall(encode_message(code))
+                ended = True
+                break
+            print("Server: sending data")
+            # each chunk starts with the time its first frame is to be heard
+            pts = start_time + frames_sent / rate
+            frames_sent += len(frames) * frames_per_buffer // frame_len
+            conn.sendall(RSP_HEADER.pack(RSP_HEADER.size + len(frames), code, pts))
+            conn.sendall(frames)
+        receive(conn, data)
 
+# audio, channel, framerate, FPB, frame_len
 
+if __name__ == "__main__":
+    wf = wave.open(WAVE_PATH, 'rb')
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host,port))
+        print("server listening")
+        sock.listen()
+        conn, addr = sock.accept()
+        serve_client(conn)
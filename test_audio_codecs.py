@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from audio_codecs import BLOCK_LEN, MULAW_MU, Codec, DeltaCodec, MulawCodec, make_codec
+
+
+def pcm(samples):
+    return np.asarray(samples, dtype='<i2').tobytes()
+
+
+def random_pcm(rng, num_frames, channels=2):
+    return pcm(rng.integers(-32768, 32768, (num_frames, channels)))
+
+
+@pytest.mark.parametrize('num_frames', [1, 3, BLOCK_LEN // 2 - 1, BLOCK_LEN + 1, 4097])
+def test_delta_round_trip_random(num_frames):
+    rng = np.random.default_rng(num_frames)
+    codec = DeltaCodec(2)
+    data = random_pcm(rng, num_frames)
+    assert bytes(codec.decode(codec.encode(data))) == data
+
+
+@pytest.mark.parametrize('samples', [
+    np.zeros((1001, 2)),
+    # full scale, the largest residuals there are
+    np.tile([[32767, -32768], [-32768, 32767]], (501, 1))[:1001],
+    np.full((333, 2), -32768),
+    np.full((333, 2), 32767),
+], ids=['silence', 'alternating full scale', 'negative full scale', 'positive full scale'])
+def test_delta_round_trip_extremes(samples):
+    codec = DeltaCodec(2)
+    data = pcm(samples)
+    encoded = codec.encode(data)
+    assert bytes(codec.decode(encoded)) == data
+
+
+def test_delta_compresses_smooth_audio():
+    codec = DeltaCodec(2)
+    t = np.arange(44101) / 44100
+    tone = np.rint(10000 * np.sin(2 * np.pi * 220 * t))
+    data = pcm(np.stack([tone, tone // 2], axis=1))
+    encoded = codec.encode(data)
+    assert bytes(codec.decode(encoded)) == data
+    assert len(encoded) < len(data) / 2
+    # silence packs into the header alone
+    assert len(codec.encode(pcm(np.zeros((1024, 2))))) == 4 + 2 * 1024 // BLOCK_LEN
+
+
+def test_delta_mono():
+    rng = np.random.default_rng(1)
+    codec = make_codec(Codec.DELTA, 1, 2)
+    data = random_pcm(rng, 999, channels=1)
+    assert bytes(codec.decode(codec.encode(data))) == data
+
+
+def mulaw_error_bound(samples):
+    """
+    :return np.ndarray: most error of each 16 bit sample after mu-law: the expansion of half a step of the
+        8 bit companded value above the sample's, the wider side of the curve, plus rounding
+    """
+    x = np.abs(samples) / 32768.
+    companded = np.log1p(MULAW_MU * x) / np.log1p(MULAW_MU)
+    expanded = np.expm1((companded + 1 / 254) * np.log1p(MULAW_MU)) / MULAW_MU
+    return 32768 * (expanded - x) + 1
+
+
+def test_mulaw_error_bound():
+    rng = np.random.default_rng(2)
+    codec = MulawCodec(2)
+    samples = np.concatenate([rng.integers(-32768, 32768, 20000), np.arange(-32768, 32768, 7),
+                              [0, 1, -1, 32767, -32768]])
+    if len(samples) % 2:
+        samples = samples[:-1]
+    encoded = codec.encode(pcm(samples))
+    # one byte per sample
+    assert len(encoded) == len(samples)
+    decoded = np.frombuffer(codec.decode(encoded), dtype='<i2').astype(np.int64)
+    error = np.abs(decoded - samples)
+    assert (error <= mulaw_error_bound(samples)).all()
+    # quiet samples are off by half the smallest step at most, loud ones by under 2.5 %
+    smallest_step = 32768 * np.expm1(np.log1p(MULAW_MU) / 127) / MULAW_MU
+    quiet = np.abs(samples) < 20
+    assert error[quiet].max() <= smallest_step / 2 + 1
+    loud = np.abs(samples) > 1000
+    assert (error[loud] / np.abs(samples[loud])).max() < .025
+    # no sample changes its sign
+    assert (np.sign(decoded) * np.sign(samples) >= 0).all()
+
+
+def test_mulaw_silence_is_exact():
+    codec = MulawCodec(2)
+    data = pcm(np.zeros((512, 2)))
+    assert bytes(codec.decode(codec.encode(data))) == data
+
+
+@pytest.mark.parametrize('codec_class', [DeltaCodec, MulawCodec])
+def test_only_16_bit(codec_class):
+    with pytest.raises(ValueError):
+        codec_class(2, 3)
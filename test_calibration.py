@@ -0,0 +1,101 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+from calibration import CalibrationSession, RSSI_FLOOR, fit_model, save_model
+from location import FingerprintClassifier, FINGERPRINT_NEIGHBOURS
+
+NUM_BEACONS = 20
+NUM_ROOMS = 4
+TAKE_SECONDS = 30.
+READING_INTERVAL = .1
+NOISE_DB = 4.
+# fingerprints of a whole floor: every room recorded at 20 locations for a minute, a fingerprint every
+# FINGERPRINT_INTERVAL
+FLOOR_LOCATIONS = 20
+FLOOR_FINGERPRINTS_PER_LOCATION = 240
+
+
+def room_means(rng):
+    """:return np.ndarray: mean RSSI of every beacon in every room, shape (NUM_ROOMS, NUM_BEACONS)"""
+    return rng.uniform(-95., -45., (NUM_ROOMS, NUM_BEACONS))
+
+
+def record_session(rng, means):
+    """:return CalibrationSession: one take of every room, each beacon advertising every READING_INTERVAL"""
+    session = CalibrationSession([f'00:00:00:00:00:{i:02x}' for i in range(NUM_BEACONS)])
+    for room, mean in enumerate(means, start=1):
+        take = len(session.takes)
+        session.takes.append(session.location(f'room {room}', room))
+        for seconds in np.arange(0., TAKE_SECONDS, READING_INTERVAL):
+            for beacon in range(NUM_BEACONS):
+                rssi = int(round(mean[beacon] + rng.normal(0., NOISE_DB)))
+                session.samples.append((take, seconds + beacon * READING_INTERVAL / NUM_BEACONS, beacon, rssi))
+    return session
+
+
+@pytest.mark.parametrize('method', ['gaussian', 'knn'])
+def test_rooms_told_apart_with_many_beacons(method):
+    rng = np.random.default_rng(0)
+    means = room_means(rng)
+    classifier, vectors, rooms = fit_model([record_session(rng, means)], method)
+    assert len(classifier.beacons) == NUM_BEACONS
+    # fresh readings, smoothed about as much as the tracker smooths them
+    for room, mean in enumerate(means, start=1):
+        readings = mean + rng.normal(0., NOISE_DB / 2, (200, NUM_BEACONS))
+        predicted, confidence = classifier.classify(readings)
+        assert (predicted == room).mean() > .95, room
+        assert confidence[predicted == room].mean() > .5
+    # and every fingerprint it was fitted to
+    assert (classifier.classify(vectors)[0] == rooms).mean() > .95
+
+
+def test_far_readings_are_outside_every_room():
+    rng = np.random.default_rng(1)
+    means = room_means(rng)
+    classifier = fit_model([record_session(rng, means)])[0]
+    # nothing heard is far from every room, which all hear some beacons well
+    rooms, confidence = classifier.classify(np.full(NUM_BEACONS, np.nan))
+    assert rooms.tolist() == [0] and confidence.tolist() == [0.]
+
+
+def test_model_file_round_trip():
+    rng = np.random.default_rng(2)
+    means = room_means(rng)
+    classifier, vectors, rooms = fit_model([record_session(rng, means)])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'location_model.npz')
+        save_model(classifier, path)
+        loaded = FingerprintClassifier.load(path)
+    assert loaded.beacons == classifier.beacons
+    assert loaded.rssi_floor == RSSI_FLOOR
+    np.testing.assert_array_equal(loaded.classify(means)[0], classifier.classify(means)[0])
+    np.testing.assert_array_equal(loaded.classify(means)[0], np.arange(1, NUM_ROOMS + 1))
+
+
+def floor_fingerprints(rng):
+    """:return: (vectors, rooms) of a floor's fingerprints, each location of a room a little apart"""
+    vectors, rooms = [], []
+    for room, mean in enumerate(room_means(rng), start=1):
+        for location in rng.normal(mean, 3., (FLOOR_LOCATIONS, NUM_BEACONS)):
+            vectors.append(rng.normal(location, NOISE_DB / 2, (FLOOR_FINGERPRINTS_PER_LOCATION, NUM_BEACONS)))
+            rooms.append(np.full(FLOOR_FINGERPRINTS_PER_LOCATION, room))
+    return np.concatenate(vectors), np.concatenate(rooms)
+
+
+def test_index_searches_a_bounded_share_of_the_fingerprints():
+    rng = np.random.default_rng(3)
+    vectors, rooms = floor_fingerprints(rng)
+    classifier = FingerprintClassifier([f'b{i}' for i in range(NUM_BEACONS)], vectors, rooms,
+                                       np.ones(len(vectors)), RSSI_FLOOR)
+    readings = vectors[rng.choice(len(vectors), 500, replace=False)] + rng.normal(0., 1., (500, NUM_BEACONS))
+    # what a reading costs: the centroids it is compared with, then the fingerprints of the nearest cells
+    candidates = classifier.candidates(readings.astype(np.float32))
+    compared = len(classifier.centroids) + (candidates >= 0).sum(axis=1)
+    assert len(vectors) == 19200
+    assert compared.max() < len(vectors) / 10
+    # and it finds the room a search of every fingerprint finds
+    distances = ((readings[:, None, :] - vectors) ** 2).sum(axis=2)
+    nearest = np.argpartition(distances, FINGERPRINT_NEIGHBOURS - 1, axis=1)[:, :FINGERPRINT_NEIGHBOURS]
+    exact = np.array([np.bincount(votes).argmax() for votes in rooms[nearest]])
+    assert (classifier.classify(readings)[0] == exact).mean() > .98
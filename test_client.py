@@ -0,0 +1,71 @@
+import asyncio
+import sys
+import time
+import null_audio
+
+# client imports pyaudio, which only plays anything on a Pi
+try:
+    import pyaudio
+except ImportError:
+    sys.modules['pyaudio'] = null_audio
+
+import client
+from audio_codecs import Codec
+from protocol import ClientServerMsg, NEW_STREAM, TIMESTAMP, encode_hello_rsp, encode_message
+
+CHANNELS = 2
+SAMPLE_SIZE = 2
+FRAMES_PER_BUFFER = 1024
+BUFFERS_PER_RSP = 8
+# chunks sent for the first stream, several seconds of audio left to play out when it changes
+NUM_CHUNKS = 30
+
+
+def new_stream(rate):
+    frame_len = FRAMES_PER_BUFFER * CHANNELS * SAMPLE_SIZE
+    return encode_message(ClientServerMsg.NEW_STREAM, NEW_STREAM.pack(
+        null_audio.paInt16, CHANNELS, rate, FRAMES_PER_BUFFER, frame_len, BUFFERS_PER_RSP * frame_len,
+        Codec.PCM, 0., 0, bytes(4), 0, 0))
+
+
+async def halt_while_the_stream_changes():
+    """
+    Streams to an AsyncClient, changes the stream's rate with plenty of audio still queued and halts it
+    right away.
+    :return: (seconds from the HALT to the HALT_RSP, stream parameters of the client by then)
+    """
+    connected = asyncio.get_event_loop().create_future()
+    server = await asyncio.start_server(lambda reader, writer: connected.set_result((reader, writer)),
+                                        '127.0.0.1', 0)
+    speaker = client.AsyncClient('127.0.0.1', server.sockets[0].getsockname()[1])
+    client_task = asyncio.ensure_future(speaker.run())
+    try:
+        reader, writer = await asyncio.wait_for(connected, 5.)
+        await client.read_message(reader)
+        writer.write(encode_hello_rsp(0))
+        writer.write(new_stream(44100))
+        chunk = bytes(BUFFERS_PER_RSP * FRAMES_PER_BUFFER * CHANNELS * SAMPLE_SIZE)
+        for pts in range(NUM_CHUNKS):
+            writer.write(encode_message(ClientServerMsg.STREAM_RSP, TIMESTAMP.pack(pts) + chunk))
+        await asyncio.sleep(.5)
+        writer.write(new_stream(22050))
+        await asyncio.sleep(.1)
+        halted_at = time.time()
+        writer.write(encode_message(ClientServerMsg.HALT))
+        while True:
+            msg_code, msg_body = await asyncio.wait_for(client.read_message(reader), 10.)
+            if msg_code == ClientServerMsg.HALT_RSP:
+                return time.time() - halted_at, speaker.stream_params
+            assert msg_code in (ClientServerMsg.STREAM_REQ, ClientServerMsg.TIME_REQ)
+    finally:
+        client_task.cancel()
+        await asyncio.gather(client_task, return_exceptions=True)
+        server.close()
+
+
+def test_halt_interrupts_playing_out_the_previous_stream():
+    answered_after, stream_params = asyncio.run(halt_while_the_stream_changes())
+    # the first stream had seconds left to play out, the HALT didn't wait for them
+    assert answered_after < .5
+    # and the stream it interrupted was never set up
+    assert stream_params == (null_audio.paInt16, CHANNELS, 44100, FRAMES_PER_BUFFER)
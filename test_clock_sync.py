@@ -0,0 +1,199 @@
+import pytest
+from clock_sync import CLOCK_SYNC_BURST, CLOCK_SYNC_INTERVAL, CLOCK_SYNC_WINDOW, SYNC_TOLERANCE, ClockSync, \
+    PlaybackAligner, StreamTimeline
+
+# seconds the Server's clock is ahead of the Client's
+SERVER_OFFSET = 100.
+RATE = 44100
+FRAMES_PER_BUFFER = 1024
+FRAME_SIZE = 4
+
+
+def exchange(clock, t0, request_delay, response_delay, processing=.001):
+    """
+    Completes a TIME_REQ/TIME_RSP exchange with a Server SERVER_OFFSET ahead, with the given one way delays
+    :return float: the offset the clock estimates afterwards
+    """
+    t1 = t0 + request_delay + SERVER_OFFSET
+    t2 = t1 + processing
+    return clock.on_response(t0, t1, t2, t2 - SERVER_OFFSET + response_delay)
+
+
+def test_offset_and_delay_of_symmetric_exchanges():
+    clock = ClockSync()
+    assert not clock.synced
+    assert exchange(clock, 1000., .02, .02) == pytest.approx(SERVER_OFFSET)
+    assert clock.synced
+    # the Server's processing time isn't part of the round trip
+    assert clock.delay == pytest.approx(.04)
+    assert clock.to_local(1050.) == pytest.approx(950.)
+
+
+def test_least_delayed_exchange_is_trusted():
+    clock = ClockSync()
+    # queueing on the way to the Server makes it look further ahead by half the extra delay
+    assert exchange(clock, 1000., .1, .01) == pytest.approx(SERVER_OFFSET + .045)
+    assert exchange(clock, 1001., .01, .01) == pytest.approx(SERVER_OFFSET)
+    assert exchange(clock, 1002., .01, .07) == pytest.approx(SERVER_OFFSET)
+    assert clock.delay == pytest.approx(.02)
+
+
+def test_best_exchange_leaves_the_window():
+    clock = ClockSync()
+    exchange(clock, 1000., .005, .005)
+    for i in range(1, CLOCK_SYNC_WINDOW):
+        assert exchange(clock, 1000. + i, .03, .01) == pytest.approx(SERVER_OFFSET)
+    # the window only holds exchanges with the asymmetric delay now
+    assert exchange(clock, 1000. + CLOCK_SYNC_WINDOW, .03, .01) == pytest.approx(SERVER_OFFSET + .01)
+    assert clock.delay == pytest.approx(.04)
+
+
+def test_request_burst_then_interval():
+    clock = ClockSync()
+    now = 1000.
+    for i in range(CLOCK_SYNC_BURST):
+        assert clock.request_due(now)
+        assert clock.on_request(now) == now
+        # one exchange at a time
+        assert not clock.request_due(now)
+        exchange(clock, now, .01, .01)
+        now += .1
+    assert not clock.request_due(now)
+    assert clock.request_due(now - .1 + CLOCK_SYNC_INTERVAL)
+
+
+def play(aligner, start, seconds, device_rate=RATE, queued=None):
+    """
+    Calls the aligner like the audio callback of client.py does, every buffer the sound card plays
+    :param start: time.time() the first buffer is heard at
+    :param device_rate: frames per second the sound card really plays
+    :param queued: frames of the stream queued, unlimited if None
+    :return list: seconds the stream's audio in every buffer was off the timeline
+    """
+    play_time, read_len, errors = start, 0, []
+    queued = float('inf') if queued is None else queued
+    while play_time < start + seconds:
+        aligner.consumed(read_len)
+        queued -= read_len
+        correction = aligner.correction(play_time)
+        lead = 0
+        if correction > 0:
+            skip = min(correction, queued)
+            queued -= skip
+            aligner.consumed(skip)
+            aligner.unapplied(correction - skip)
+        elif correction < 0:
+            lead = min(-correction, FRAMES_PER_BUFFER)
+            aligner.unapplied(correction + lead)
+        read_len = min(FRAMES_PER_BUFFER - lead, queued)
+        if read_len:
+            errors.append((play_time + lead / RATE - aligner.local_start) - aligner.position / RATE)
+        play_time += FRAMES_PER_BUFFER / device_rate
+    return errors
+
+
+def test_aligned_playback_needs_no_correction():
+    aligner = PlaybackAligner()
+    aligner.start(1000., RATE)
+    errors = play(aligner, 1000., 5.)
+    assert max(map(abs, errors)) < 1e-9
+    assert (aligner.skipped, aligner.inserted) == (0, 0)
+    assert aligner.played_seconds() == pytest.approx(5., abs=FRAMES_PER_BUFFER / RATE)
+
+
+def test_late_start_skips_to_the_timeline():
+    aligner = PlaybackAligner()
+    aligner.start(1000., RATE)
+    errors = play(aligner, 1000.25, 1.)
+    # the first buffer is already heard in step
+    assert abs(errors[0]) < 1 / RATE
+    assert aligner.skipped == RATE // 4
+    assert aligner.inserted == 0
+
+
+def test_early_start_plays_silence_first():
+    aligner = PlaybackAligner()
+    aligner.start(1000., RATE)
+    errors = play(aligner, 999.9, 1.)
+    # the silence spans several buffers, the stream starts right on time
+    assert aligner.inserted == RATE // 10
+    assert max(map(abs, errors)) < 1 / RATE
+    assert aligner.skipped == 0
+
+
+@pytest.mark.parametrize('drift', [-.001, .001])
+def test_sound_card_drift_is_corrected(drift):
+    aligner = PlaybackAligner()
+    aligner.start(1000., RATE)
+    errors = play(aligner, 1000., 60., device_rate=RATE * (1 + drift))
+    assert max(map(abs, errors)) < 2 * SYNC_TOLERANCE
+    # about drift of every frame played is corrected
+    corrected = aligner.inserted if drift > 0 else aligner.skipped
+    assert corrected == pytest.approx(abs(drift) * 60 * RATE, rel=.1)
+
+
+def test_skip_past_the_queued_audio_follows_later():
+    aligner = PlaybackAligner()
+    aligner.start(1000., RATE)
+    # only a few buffers queued when the first buffer is heard half a second late
+    assert play(aligner, 1000.5, .01, queued=4 * FRAMES_PER_BUFFER) == []
+    assert aligner.skipped == 4 * FRAMES_PER_BUFFER
+    # the rest of the skip is still owed, and made up by the next correction
+    assert aligner.error == pytest.approx(RATE / 2 - 4 * FRAMES_PER_BUFFER)
+    assert aligner.correction(1000.5) == RATE / 2 - 4 * FRAMES_PER_BUFFER
+
+
+def test_joining_a_stream_late():
+    aligner = PlaybackAligner()
+    # the first frame queued is 2 s into a stream that started at 1000
+    aligner.start(1000., RATE, 2 * RATE)
+    errors = play(aligner, 1002., 1.)
+    assert max(map(abs, errors)) < 1e-9
+    assert aligner.played_seconds() == pytest.approx(3., abs=FRAMES_PER_BUFFER / RATE)
+
+
+def test_not_aligning_without_a_start():
+    aligner = PlaybackAligner()
+    aligner.start(None, RATE)
+    assert aligner.correction(1e9) == 0
+
+
+def chunk(frames):
+    return frames * FRAME_SIZE
+
+
+def test_timeline_maps_pts_to_frames():
+    timeline = StreamTimeline()
+    timeline.start(RATE, FRAME_SIZE)
+    assert timeline.place(1000., chunk(4410)) == (0, 0)
+    assert timeline.start_pts == 1000.
+    assert timeline.next_pts == pytest.approx(1000.1)
+    # the next chunk starts right where the last ended
+    assert timeline.place(1000.1, chunk(4410)) == (0, 0)
+    # one that starts 10 ms late leaves that much silence, in whole frames
+    assert timeline.place(1000.21, chunk(4410)) == (chunk(441), 0)
+    # one 10 ms early has its first 10 ms dropped
+    assert timeline.place(1000.3, chunk(4410)) == (0, chunk(441))
+    assert timeline.next_pts == pytest.approx(1000.4)
+    assert timeline.start_pts == 1000.
+
+
+def test_timeline_chunk_entirely_in_the_past():
+    timeline = StreamTimeline()
+    timeline.start(RATE, FRAME_SIZE)
+    timeline.place(1000., chunk(44100))
+    # a late retransmission of audio queued already is dropped whole and doesn't move the timeline back
+    assert timeline.place(1000.5, chunk(4410)) == (0, chunk(4410))
+    assert timeline.next_pts == pytest.approx(1001.)
+    assert timeline.place(1001., chunk(4410)) == (0, 0)
+
+
+def test_timeline_restarts_with_a_new_stream():
+    timeline = StreamTimeline()
+    timeline.start(RATE, FRAME_SIZE)
+    timeline.place(1000., chunk(4410))
+    timeline.start(22050, 2)
+    assert (timeline.start_pts, timeline.next_pts) == (None, None)
+    # the first chunk of a stream never has a gap
+    assert timeline.place(2000., 2 * 2205) == (0, 0)
+    assert timeline.next_pts == pytest.approx(2000.1)
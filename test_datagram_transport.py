@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+from audio_codecs import Codec, make_codec
+from clock_sync import StreamTimeline
+from datagram_transport import CONCEAL_SECONDS, DatagramReceiver, encode_datagram, frames_per_datagram
+from ring_buffer import AudioRingBuffer
+
+RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+FRAME_SIZE = CHANNELS * SAMPLE_WIDTH
+FRAMES = frames_per_datagram(FRAME_SIZE)
+NUM_DATAGRAMS = 20
+STREAM_ID = 7
+START_PTS = 1000.
+
+
+def stream_audio():
+    """:return np.ndarray: a 440 Hz tone as int16 frames, NUM_DATAGRAMS datagrams long"""
+    t = np.arange(NUM_DATAGRAMS * FRAMES) / RATE
+    tone = np.rint(8000 * np.sin(2 * np.pi * 440 * t)).astype('<i2')
+    return np.stack([tone, -tone], axis=1)
+
+
+def datagrams(audio, stream_id=STREAM_ID):
+    return [encode_datagram(stream_id, seq, START_PTS + seq * FRAMES / RATE,
+                            audio[seq * FRAMES:(seq + 1) * FRAMES].tobytes())
+            for seq in range(NUM_DATAGRAMS)]
+
+
+@pytest.fixture
+def receiver():
+    receiver = DatagramReceiver(AudioRingBuffer(1 << 20, shared=False))
+    yield receiver
+    receiver.close()
+
+
+def start(receiver):
+    timeline = StreamTimeline()
+    timeline.start(RATE, FRAME_SIZE)
+    receiver.start(STREAM_ID, make_codec(Codec.PCM, CHANNELS, SAMPLE_WIDTH), timeline, SAMPLE_WIDTH, CHANNELS)
+
+
+def received_audio(receiver):
+    """:return np.ndarray: the frames written to the receiver's ring"""
+    with receiver.ring.peek(receiver.ring.fill()) as view:
+        return np.frombuffer(view, dtype='<i2').reshape(-1, CHANNELS).copy()
+
+
+def frames_of(seq):
+    return slice(seq * FRAMES, (seq + 1) * FRAMES)
+
+
+def check_concealed(concealed, previous):
+    """Checks that concealed repeats the audio of the previous datagram, fading out from its first frame"""
+    fade = 1 - np.arange(len(concealed)) / (CONCEAL_SECONDS * RATE)
+    expected = np.resize(previous, concealed.shape) * fade[:, None]
+    np.testing.assert_allclose(concealed, expected, atol=1.)
+
+
+def test_every_datagram_received(receiver):
+    audio = stream_audio()
+    start(receiver)
+    for data in datagrams(audio):
+        receiver.receive(data)
+    np.testing.assert_array_equal(received_audio(receiver), audio)
+    assert (receiver.received, receiver.lost, receiver.late, receiver.concealed_frames) == (NUM_DATAGRAMS, 0, 0, 0)
+
+
+def test_dropped_datagrams_are_concealed_in_place(receiver):
+    audio = stream_audio()
+    start(receiver)
+    for seq, data in enumerate(datagrams(audio)):
+        if seq not in (3, 4, 11):
+            receiver.receive(data)
+    received = received_audio(receiver)
+    # the concealed audio takes exactly the place of the lost, so what follows plays at its time
+    assert received.shape == audio.shape
+    for seq in set(range(NUM_DATAGRAMS)) - {3, 4, 11}:
+        np.testing.assert_array_equal(received[frames_of(seq)], audio[frames_of(seq)])
+    check_concealed(received[3 * FRAMES:5 * FRAMES], audio[frames_of(2)])
+    check_concealed(received[frames_of(11)], audio[frames_of(10)])
+    assert (receiver.lost, receiver.concealed_frames) == (3, 3 * FRAMES)
+    assert receiver.report() == (f'datagrams received {NUM_DATAGRAMS - 3}, lost 3, late 0, '
+                                 f'concealed {3 * FRAMES} frames')
+
+
+def test_reordered_datagram_is_dropped_as_late(receiver):
+    audio = stream_audio()
+    start(receiver)
+    sent = datagrams(audio)
+    sent[5], sent[6] = sent[6], sent[5]
+    for data in sent:
+        receiver.receive(data)
+    received = received_audio(receiver)
+    assert received.shape == audio.shape
+    # datagram 5 arrived after its place was concealed, it doesn't shift the audio after it
+    check_concealed(received[frames_of(5)], audio[frames_of(4)])
+    np.testing.assert_array_equal(received[6 * FRAMES:], audio[6 * FRAMES:])
+    np.testing.assert_array_equal(received[:5 * FRAMES], audio[:5 * FRAMES])
+    assert (receiver.lost, receiver.late, receiver.concealed_frames) == (1, 1, FRAMES)
+
+
+def test_long_loss_fades_to_silence(receiver):
+    audio = stream_audio()
+    start(receiver)
+    sent = datagrams(audio)
+    receiver.receive(sent[0])
+    receiver.receive(sent[-1])
+    received = received_audio(receiver)
+    assert received.shape == audio.shape
+    concealed = received[FRAMES:-FRAMES]
+    fade_frames = int(CONCEAL_SECONDS * RATE)
+    assert len(concealed) > fade_frames
+    check_concealed(concealed[:fade_frames], audio[frames_of(0)])
+    assert not concealed[fade_frames:].any()
+    np.testing.assert_array_equal(received[-FRAMES:], audio[-FRAMES:])
+
+
+def test_datagrams_before_the_stream_starts_are_kept(receiver):
+    audio = stream_audio()
+    # the Server sends right after the NEW_STREAM, before the Client handles it. Datagrams of another
+    # stream stay held back when this one starts
+    for data in datagrams(audio, STREAM_ID + 1)[:2] + datagrams(audio)[:10]:
+        receiver.receive(data)
+    assert receiver.ring.fill() == 0
+    start(receiver)
+    for data in datagrams(audio)[10:]:
+        receiver.receive(data)
+    np.testing.assert_array_equal(received_audio(receiver), audio)
+    assert len(receiver.backlog) == 2
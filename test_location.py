@@ -0,0 +1,32 @@
+from location import RoomSwitchScheduler
+
+
+def test_lingering_candidate_is_announced_again():
+    switches, candidates = [], []
+    scheduler = RoomSwitchScheduler(lambda *args: switches.append(args),
+                                    on_candidate=lambda room, confidence, now: candidates.append((room, now)),
+                                    candidate_interval=4.)
+    # too unsure of room 2 to switch, for longer than a standby lasts
+    for second in range(25):
+        scheduler.update(2, .1, 1000. + second)
+    assert switches == []
+    assert candidates == [(2, 1000. + second) for second in (0, 4, 8, 12, 16, 20, 24)]
+    # polls without readings keep announcing it too
+    scheduler.poll(1028.)
+    assert candidates[-1] == (2, 1028.)
+    # back in room 0 the candidate is gone and isn't announced anymore
+    scheduler.update(0, 1., 1029.)
+    scheduler.poll(1040.)
+    assert candidates[-1] == (2, 1028.)
+
+
+def test_switch_ends_the_announcements():
+    candidates = []
+    scheduler = RoomSwitchScheduler(lambda *args: None, on_candidate=lambda *args: candidates.append(args),
+                                    dwell=1.5, candidate_interval=1.)
+    for tenth in range(30):
+        scheduler.update(3, .9, 1000. + tenth / 10)
+    assert scheduler.room == 3
+    num_announced = len(candidates)
+    scheduler.poll(1010.)
+    assert len(candidates) == num_announced
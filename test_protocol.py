@@ -0,0 +1,153 @@
+import socket
+import struct
+import sys
+import numpy as np
+import null_audio
+import pytest
+
+# client imports pyaudio, which only plays anything on a Pi
+try:
+    import pyaudio
+except ImportError:
+    sys.modules['pyaudio'] = null_audio
+
+import protocol
+from client import MessageDecoder, check_hello_rsp
+from protocol import ClientServerMsg, ProtocolError, MessageBuffer, HEADER, MSG_HEADER_LEN, RSP_HEADER, HELLO, \
+    HELLO_RSP, PROTOCOL_MAGIC, PROTOCOL_VERSION, decode_hello, decode_hello_rsp, encode_hello_rsp, encode_message
+
+# values packed into each message body format of protocol.py, exactly representable in their fields
+BODIES = {
+    'DURATION': (1.5,),
+    'CREDIT': (65535,),
+    'TIMESTAMP': (1700000000.125,),
+    'TIME_RSP': (1700000000.25, 1700000000.5, 1700000000.75),
+    'START_FRAME': (4294967295,),
+    'HELLO': (PROTOCOL_MAGIC, PROTOCOL_VERSION, 3, 4096, 16384, 1 << 20, 7, 44100, 2, 2, 50000),
+    'HELLO_RSP': (PROTOCOL_MAGIC, PROTOCOL_VERSION, 2),
+    'NEW_STREAM': (8, 2, 44100, 4096, 16384, 131072, 1, 1700000000.5, 12, socket.inet_aton('239.0.0.1'), 5004,
+                   1),
+    'DATAGRAM_HEADER': (12, 4294967295, 1700000000.5),
+}
+# formats of whole messages rather than bodies, see test_stream_rsp_header
+HEADERS = {'HEADER', 'RSP_HEADER'}
+
+
+def messages():
+    """:return list: (struct name, msg_code, encoded message) of a message of every body format"""
+    encoded = []
+    for msg_code, (name, values) in enumerate(sorted(BODIES.items()), start=1):
+        body = getattr(protocol, name)
+        if msg_code % 2:
+            encoded.append((name, msg_code, encode_message(msg_code, body.pack(*values))))
+        else:
+            # preallocated messages are packed in place, their bytes are the same
+            encoded.append((name, msg_code, bytes(MessageBuffer(msg_code, body).pack(*values))))
+    return encoded
+
+
+def decode_all(decoder):
+    decoded = []
+    while (message := decoder.next_message()) is not None:
+        msg_code, msg_body = message
+        decoded.append((msg_code, bytes(msg_body)))
+    return decoded
+
+
+def check_decoded(decoded, encoded):
+    assert [msg_code for msg_code, body in decoded] == [msg_code for name, msg_code, message in encoded]
+    for (msg_code, body), (name, _, message) in zip(decoded, encoded):
+        assert getattr(protocol, name).unpack(body) == BODIES[name]
+
+
+def test_every_format_is_covered():
+    formats = {name for name, value in vars(protocol).items() if isinstance(value, struct.Struct)}
+    assert formats == set(BODIES) | HEADERS
+
+
+def test_several_messages_in_one_read():
+    encoded = messages()
+    decoder = MessageDecoder()
+    decoder.feed(b''.join(message for name, msg_code, message in encoded))
+    check_decoded(decode_all(decoder), encoded)
+    assert not decoder.has_pending_bytes()
+
+
+@pytest.mark.parametrize('read_len', [1, 2, 5, 7, 64])
+def test_messages_split_across_reads(read_len):
+    encoded = messages()
+    stream = b''.join(message for name, msg_code, message in encoded)
+    # small buffer, so it has to move and grow the partial messages it holds
+    decoder = MessageDecoder(capacity=16)
+    decoded = []
+    for start in range(0, len(stream), read_len):
+        decoder.feed(stream[start:start + read_len])
+        decoded += decode_all(decoder)
+    check_decoded(decoded, encoded)
+    assert not decoder.has_pending_bytes()
+
+
+def test_messages_received_from_a_socket():
+    encoded = messages()
+    stream = b''.join(message for name, msg_code, message in encoded) * 200
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        sender.sendall(stream[:len(stream) // 3])
+        decoder = MessageDecoder(capacity=64)
+        decoded = []
+        received = decoder.recv_from(receiver)
+        sender.sendall(stream[len(stream) // 3:])
+        sender.close()
+        while received < len(stream):
+            decoded += decode_all(decoder)
+            received += decoder.recv_from(receiver)
+        decoded += decode_all(decoder)
+    check_decoded(decoded, encoded * 200)
+
+
+def test_stream_rsp_header():
+    audio = np.arange(300, dtype='<i2').tobytes()
+    message = RSP_HEADER.pack(RSP_HEADER.size + len(audio), ClientServerMsg.STREAM_RSP, 1700000000.5) + audio
+    assert HEADER.unpack_from(message, 0) == (len(message), ClientServerMsg.STREAM_RSP)
+    decoder = MessageDecoder()
+    decoder.feed(message[:10])
+    assert decoder.next_message() is None
+    decoder.feed(message[10:] + encode_message(ClientServerMsg.HALT))
+    msg_code, msg_body = decoder.next_message()
+    assert msg_code == ClientServerMsg.STREAM_RSP
+    assert protocol.TIMESTAMP.unpack_from(msg_body, 0) == (1700000000.5,)
+    assert bytes(msg_body[protocol.TIMESTAMP_LEN:]) == audio
+    # a message without a body is just its header
+    msg_code, msg_body = decoder.next_message()
+    assert (msg_code, len(msg_body)) == (ClientServerMsg.HALT, 0)
+    assert len(encode_message(ClientServerMsg.HALT)) == MSG_HEADER_LEN
+
+
+def hello(magic=PROTOCOL_MAGIC, version=PROTOCOL_VERSION):
+    return HELLO.pack(magic, version, 3, 4096, 16384, 1 << 20, 7, 44100, 2, 2, 0)
+
+
+def test_handshake():
+    assert decode_hello(hello()) == [3, 4096, 16384, 1 << 20, 7, 44100, 2, 2, 0]
+    decoder = MessageDecoder()
+    decoder.feed(encode_hello_rsp(2))
+    assert check_hello_rsp(*decoder.next_message()) == 2
+
+
+@pytest.mark.parametrize('decode, encode', [
+    (decode_hello, hello),
+    (decode_hello_rsp, lambda magic=PROTOCOL_MAGIC, version=PROTOCOL_VERSION: HELLO_RSP.pack(magic, version, 0)),
+])
+def test_handshake_refuses_another_protocol(decode, encode):
+    with pytest.raises(ProtocolError, match="doesn't speak"):
+        decode(encode(magic=b'RIFF'))
+    with pytest.raises(ProtocolError, match=f"version {PROTOCOL_VERSION + 1}"):
+        decode(encode(version=PROTOCOL_VERSION + 1))
+    with pytest.raises(ProtocolError, match="too short"):
+        decode(encode()[:-1])
+
+
+def test_unanswered_hello():
+    # a Server of the protocol before the handshake answers with something else
+    with pytest.raises(ProtocolError):
+        check_hello_rsp(ClientServerMsg.NEW_STREAM, bytes(protocol.NEW_STREAM.size))
@@ -0,0 +1,128 @@
+import multiprocessing
+import numpy as np
+import pytest
+from ring_buffer import AudioRingBuffer
+
+CAPACITY = 64
+# bytes the producer process passes through a ring much smaller than them
+STREAM_LEN = 1 << 20
+STREAM_CAPACITY = 1 << 12
+
+
+def test_empty_ring():
+    ring = AudioRingBuffer(CAPACITY, shared=False)
+    assert (ring.fill(), ring.free()) == (0, CAPACITY)
+    assert len(ring.peek(16)) == 0
+    ring.record_underrun()
+    assert ring.underruns() == 1
+
+
+def test_full_ring():
+    ring = AudioRingBuffer(CAPACITY, shared=False)
+    data = bytes(range(CAPACITY))
+    ring.write(data)
+    assert (ring.fill(), ring.free()) == (CAPACITY, 0)
+    # peek can't return more than was written, and doesn't consume it
+    assert bytes(ring.peek(2 * CAPACITY)) == data
+    assert ring.fill() == CAPACITY
+    ring.advance(CAPACITY)
+    assert (ring.fill(), ring.free()) == (0, CAPACITY)
+    assert ring.written() == CAPACITY
+    with pytest.raises(ValueError):
+        ring.write(bytes(CAPACITY + 1))
+
+
+@pytest.mark.parametrize('chunk_len', [1, 7, 24, 63])
+def test_wrap_around(chunk_len):
+    ring = AudioRingBuffer(CAPACITY, shared=False)
+    stream = bytes(np.random.default_rng(chunk_len).integers(0, 256, 40 * CAPACITY, dtype=np.uint8))
+    # keeps the ring partly filled so writes and reads both cross its end
+    ring.write(stream[:CAPACITY - chunk_len])
+    written, read = CAPACITY - chunk_len, bytearray()
+    while len(read) < len(stream):
+        if written < len(stream):
+            ring.write(stream[written:written + chunk_len])
+            written += len(stream[written:written + chunk_len])
+        view = ring.peek(chunk_len + 3)
+        read += view
+        ring.advance(len(view))
+    assert read == stream
+    assert ring.fill() == 0
+
+
+def test_counters_wrap_around():
+    ring = AudioRingBuffer(CAPACITY, shared=False)
+    # just short of where the uint32 counters wrap to 0
+    ring.counters[0] = ring.counters[1] = (1 << 32) - 10
+    ring.write(bytes(range(30)))
+    assert ring.written() == 20
+    assert (ring.fill(), ring.free()) == (30, CAPACITY - 30)
+    assert bytes(ring.peek(30)) == bytes(range(30))
+    ring.advance(30)
+    assert ring.fill() == 0
+
+
+def test_clear():
+    ring = AudioRingBuffer(CAPACITY, shared=False)
+    ring.write(bytes(40))
+    ring.advance(10)
+    ring.clear()
+    assert (ring.fill(), ring.written()) == (0, 40)
+
+
+def test_capacity_must_be_a_power_of_2():
+    for capacity in (0, 48, -64):
+        with pytest.raises(ValueError):
+            AudioRingBuffer(capacity, shared=False)
+
+
+def produce(ring, seed):
+    """Writes STREAM_LEN pseudo-random bytes to ring in chunks of varying length"""
+    rng = np.random.default_rng(seed)
+    stream = rng.integers(0, 256, STREAM_LEN, dtype=np.uint8).tobytes()
+    written = 0
+    while written < STREAM_LEN:
+        chunk_len = int(rng.integers(1, STREAM_CAPACITY))
+        ring.write(stream[written:written + chunk_len])
+        written += chunk_len
+    ring.close()
+
+
+def test_producer_and_consumer_processes():
+    ring = AudioRingBuffer(STREAM_CAPACITY)
+    producer = multiprocessing.Process(target=produce, args=(ring, 4))
+    producer.start()
+    try:
+        read = bytearray()
+        while len(read) < STREAM_LEN:
+            assert producer.is_alive() or ring.fill(), 'producer died before writing everything'
+            # views into the ring have to be released before it's closed
+            with ring.peek(1000) as view:
+                read += view
+                ring.advance(len(view))
+        producer.join(10.)
+        assert producer.exitcode == 0
+        assert read == np.random.default_rng(4).integers(0, 256, STREAM_LEN, dtype=np.uint8).tobytes()
+        assert ring.written() == STREAM_LEN
+    finally:
+        if producer.is_alive():
+            producer.terminate()
+        ring.close()
+        ring.unlink()
+
+
+def test_attach_by_name():
+    ring = AudioRingBuffer(CAPACITY)
+    try:
+        attached = AudioRingBuffer(name=ring.shm.name)
+        assert attached.capacity == CAPACITY
+        ring.write(b'audio')
+        with attached.peek(5) as view:
+            assert bytes(view) == b'audio'
+        attached.advance(5)
+        attached.record_underrun()
+        assert (ring.fill(), ring.underruns()) == (0, 1)
+        attached.close()
+    finally:
+        ring.close()
+        ring.unlink()
@@ -0,0 +1,60 @@
+import os
+import socket
+import sys
+import threading
+import wave
+import null_audio
+
+# client and server_demo import pyaudio, which only plays anything on a Pi
+try:
+    import pyaudio
+except ImportError:
+    sys.modules['pyaudio'] = null_audio
+
+import client
+import server_demo
+from protocol import ClientServerMsg, CREDIT, TIMESTAMP_LEN, encode_message
+
+WAVE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wave_files',
+                         'Ensoniq-ZR-76-Uprite-Bass-C2.wav')
+
+
+def test_demo_ends_the_stream_like_the_server():
+    server_demo.wf = wave.open(WAVE_PATH, 'rb')
+    wf = server_demo.wf
+    num_audio_bytes = wf.getnframes() * wf.getsampwidth() * wf.getnchannels()
+    server_sock, client_sock = socket.socketpair()
+
+    def serve():
+        try:
+            server_demo.serve_client(server_sock)
+        except ConnectionError:
+            pass
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    client_sock.settimeout(10.)
+    decoder = client.MessageDecoder()
+    client_sock.sendall(client.encode_hello())
+    messages = []
+    try:
+        while not messages or messages[-1] != (ClientServerMsg.STREAM_RSP, 0):
+            decoder.recv_from(client_sock)
+            while (message := decoder.next_message()) is not None:
+                msg_code, msg_body = message
+                messages.append((msg_code, len(msg_body)))
+                if msg_code == ClientServerMsg.NEW_STREAM:
+                    # more credit than the file has chunks
+                    client_sock.sendall(encode_message(ClientServerMsg.STREAM_REQ, CREDIT.pack(1000)))
+    finally:
+        client_sock.close()
+        thread.join(5.)
+        server_sock.close()
+        server_demo.wf.close()
+    codes = [msg_code for msg_code, body_len in messages]
+    assert codes[:2] == [ClientServerMsg.HELLO_RSP, ClientServerMsg.NEW_STREAM]
+    chunks = messages[2:-1]
+    assert all(msg_code == ClientServerMsg.STREAM_RSP and body_len > TIMESTAMP_LEN for msg_code, body_len in chunks)
+    # every chunk carries audio after its timestamp, then a STREAM_RSP without a body ends the stream
+    assert sum(body_len - TIMESTAMP_LEN for msg_code, body_len in chunks) == num_audio_bytes
+    assert messages[-1] == (ClientServerMsg.STREAM_RSP, 0)
@@ -0,0 +1,151 @@
+import asyncio
+import contextlib
+import os
+import socket
+import sys
+import time
+import null_audio
+
+# Final_Server imports pyaudio, which only plays anything on a Pi
+try:
+    import pyaudio
+except ImportError:
+    sys.modules['pyaudio'] = null_audio
+
+import Final_Server
+from audio_codecs import ALL_CODECS
+from protocol import ClientServerMsg, CAP_STANDBY, DURATION, CREDIT, HEADER, HELLO, MSG_HEADER_LEN, NEW_STREAM, \
+    PROTOCOL_MAGIC, PROTOCOL_VERSION, STREAM_STANDBY, encode_message
+
+PLAYLIST = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wave_files',
+                         'Ensoniq-ZR-76-Uprite-Bass-C2.wav')]
+# seconds to wait for a message the server is expected to send
+MESSAGE_TIMEOUT = 5.
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class RecordingClient:
+    def __init__(self, port):
+        """
+        RecordingClient: a speaker that plays nothing and records the messages the server sends it
+        besides the STREAM_RSPs. It can play streams muted on standby.
+        """
+        self.port = port
+        # (ClientServerMsg, body) of every message other than STREAM_RSPs
+        self.messages = []
+        self.received = asyncio.Event()
+        self.started_at = None
+
+    async def run(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        try:
+            writer.write(encode_message(ClientServerMsg.HELLO, HELLO.pack(
+                PROTOCOL_MAGIC, PROTOCOL_VERSION, CAP_STANDBY, 4096, 4096, 1 << 20, ALL_CODECS, 0, 0, 0, 0)))
+            while True:
+                msg_len, msg_code = HEADER.unpack(await reader.readexactly(MSG_HEADER_LEN))
+                body = await reader.readexactly(msg_len - MSG_HEADER_LEN)
+                if msg_code == ClientServerMsg.STREAM_RSP:
+                    continue
+                self.messages.append((msg_code, body))
+                self.received.set()
+                if msg_code == ClientServerMsg.NEW_STREAM:
+                    self.started_at = time.time()
+                    writer.write(encode_message(ClientServerMsg.STREAM_REQ, CREDIT.pack(2)))
+                elif msg_code == ClientServerMsg.HALT:
+                    writer.write(encode_message(ClientServerMsg.HALT_RSP,
+                                                DURATION.pack(time.time() - self.started_at)))
+        finally:
+            writer.close()
+
+    def codes(self):
+        return [msg_code for msg_code, body in self.messages if msg_code != ClientServerMsg.HELLO_RSP]
+
+    async def wait_for(self, msg_code):
+        """:return: body of the first message of msg_code, waiting for it if it didn't arrive yet"""
+        deadline = time.time() + MESSAGE_TIMEOUT
+        while True:
+            for code, body in self.messages:
+                if code == msg_code:
+                    return body
+            self.received.clear()
+            await asyncio.wait_for(self.received.wait(), deadline - time.time())
+
+
+def is_standby(new_stream_body):
+    return bool(NEW_STREAM.unpack_from(new_stream_body, 0)[-1] & STREAM_STANDBY)
+
+
+@contextlib.asynccontextmanager
+async def serve_rooms(rooms):
+    """Serves rooms over loopback with a RecordingClient in each, yields (StreamServer, {room: client})"""
+    ports = {room: free_port() for room in rooms}
+    server = Final_Server.StreamServer(ports, PLAYLIST, repeat=True, transport='tcp')
+    serve_task = asyncio.ensure_future(server.serve('127.0.0.1'))
+    await asyncio.sleep(.1)
+    clients = {room: RecordingClient(port) for room, port in ports.items()}
+    client_tasks = [asyncio.ensure_future(speaker.run()) for speaker in clients.values()]
+    try:
+        await asyncio.sleep(.1)
+        yield server, clients
+    finally:
+        for task in client_tasks:
+            task.cancel()
+        await asyncio.gather(*client_tasks, return_exceptions=True)
+        # let the sessions see their clients disconnect before the server goes
+        await asyncio.sleep(.1)
+        serve_task.cancel()
+        await asyncio.gather(serve_task, return_exceptions=True)
+
+
+async def walk_through_standby_rooms():
+    async with serve_rooms((1, 2, 3)) as (server, clients):
+        server.set_active_room(1)
+        await clients[1].wait_for(ClientServerMsg.NEW_STREAM)
+        server.set_standby_room(2)
+        assert is_standby(await clients[2].wait_for(ClientServerMsg.NEW_STREAM))
+        server.set_active_room(2)
+        await clients[2].wait_for(ClientServerMsg.START)
+        await clients[1].wait_for(ClientServerMsg.HALT)
+        # room 3 has to follow the timeline room 2 carried on
+        server.set_standby_room(3)
+        assert is_standby(await clients[3].wait_for(ClientServerMsg.NEW_STREAM))
+        server.set_active_room(3)
+        await clients[3].wait_for(ClientServerMsg.START)
+        await clients[2].wait_for(ClientServerMsg.HALT)
+        await asyncio.sleep(.2)
+        return {room: speaker.codes() for room, speaker in clients.items()}
+
+
+async def walk_out_and_into_another_room():
+    async with serve_rooms((1, 2)) as (server, clients):
+        server.set_active_room(1)
+        await clients[1].wait_for(ClientServerMsg.NEW_STREAM)
+        await asyncio.sleep(1.5)
+        # no room is on standby, leaving every room halts room 1 like any other switch
+        server.set_active_room(0)
+        await clients[1].wait_for(ClientServerMsg.HALT)
+        await asyncio.sleep(.2)
+        listener_time = server.listener_time
+        server.set_active_room(2)
+        assert not is_standby(await clients[2].wait_for(ClientServerMsg.NEW_STREAM))
+        return listener_time, {room: speaker.codes() for room, speaker in clients.items()}
+
+
+def test_second_standby_room_starts_with_only_a_start():
+    codes = asyncio.run(walk_through_standby_rooms())
+    assert codes[1] == [ClientServerMsg.NEW_STREAM, ClientServerMsg.HALT]
+    assert codes[2] == [ClientServerMsg.NEW_STREAM, ClientServerMsg.START, ClientServerMsg.HALT]
+    assert codes[3] == [ClientServerMsg.NEW_STREAM, ClientServerMsg.START]
+
+
+def test_leaving_every_room_keeps_the_listeners_position():
+    listener_time, codes = asyncio.run(walk_out_and_into_another_room())
+    # room 2 picks up where room 1 stopped instead of replaying it from the start
+    assert listener_time > 1.
+    assert codes[1] == [ClientServerMsg.NEW_STREAM, ClientServerMsg.HALT]
+    assert codes[2] == [ClientServerMsg.NEW_STREAM]
@@ -0,0 +1,206 @@
+import mmap
+import struct
+import wave
+from collections import OrderedDict
+from audio_transform import convert_pcm
+
+# default number of bytes of audio the TrackCache keeps mapped
+TRACK_CACHE_BYTES = 256 * 1024 * 1024
+
+# id and length of a RIFF chunk
+CHUNK_HEADER = struct.Struct('<4sI')
+
+
+def find_pcm_region(f):
+    """
+    Finds where the PCM samples are stored in a RIFF/WAVE file so they can be sent straight from the file.
+    :param f: wave file opened in binary mode
+    :return: (offset, length) in bytes of the samples in the file
+    """
+    f.seek(0, 2)
+    file_len = f.tell()
+    f.seek(12)  # skip the 'RIFF' <size> 'WAVE' header
+    while True:
+        chunk_header = f.read(CHUNK_HEADER.size)
+        if len(chunk_header) < CHUNK_HEADER.size:
+            raise wave.Error(f'{f.name} has no data chunk')
+        chunk_id, chunk_len = CHUNK_HEADER.unpack(chunk_header)
+        if chunk_id == b'data':
+            offset = f.tell()
+            # files written while recording may not have a valid data chunk length
+            return offset, min(chunk_len, file_len - offset)
+        # chunks are padded to an even length
+        f.seek(chunk_len + (chunk_len & 1), 1)
+
+
+class Track:
+    def __init__(self, path, get_stream_params):
+        """
+        Track: the PCM samples of a wave file, memory-mapped once and shared by every connection playing
+        it. Connections keep their own position into self.pcm, the track has no cursor.
+        :param path: path of the wave file
+        :param get_stream_params: function taking (sample_width, channels, framerate) and returning the
+            stream parameters sent in NEW_STREAM. Computed once when the track is loaded
+        """
+        self.path = path
+        with wave.open(path, 'rb') as wf:
+            self.sample_width = wf.getsampwidth()
+            self.channels = wf.getnchannels()
+            self.framerate = wf.getframerate()
+        self.stream_params = get_stream_params(self.sample_width, self.channels, self.framerate)
+        # bytes per frame across all channels
+        self.frame_size = self.sample_width * self.channels
+        self.file = open(path, 'rb')
+        self.pcm_offset, self.pcm_len = find_pcm_region(self.file)
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pcm = memoryview(self.mmap)[self.pcm_offset:self.pcm_offset + self.pcm_len]
+        # number of connections currently using the track, it can't be evicted while in use
+        self.users = 0
+
+    def prefetch(self):
+        """Asks the kernel to start reading the samples into the page cache, e.g. before the track plays"""
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            self.mmap.madvise(mmap.MADV_WILLNEED)
+
+    def close(self):
+        """
+        Unmaps the samples, unless slices of them are still in use, e.g. queued in a transport's buffer.
+        :return bool: whether the track was closed. If not, call again once the slices are gone
+        """
+        self.pcm.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            return False
+        self.file.close()
+        return True
+
+    @property
+    def sample_format(self):
+        """(sample_width, channels, framerate) of the track"""
+        return self.sample_width, self.channels, self.framerate
+
+
+class ConvertedTrack:
+    def __init__(self, source, sample_format, get_stream_params):
+        """
+        ConvertedTrack: the samples of a Track converted to another sample width, channel count and
+        sample rate for clients that can't play the original. Has the same attributes as Track but its
+        samples are held in memory, so file is None and they can't be sent with sendfile.
+        :param source: Track to convert
+        :param sample_format: (sample_width, channels, framerate) to convert to
+        :param get_stream_params: see Track
+        """
+        self.path = source.path
+        self.sample_width, self.channels, self.framerate = sample_format
+        self.stream_params = get_stream_params(*sample_format)
+        self.frame_size = self.sample_width * self.channels
+        self.file = None
+        self.pcm_offset = 0
+        self.samples = convert_pcm(source.pcm, source.sample_width, source.channels, source.framerate,
+                                   *sample_format)
+        self.pcm_len = len(self.samples)
+        self.pcm = memoryview(self.samples)
+        self.users = 0
+
+    def prefetch(self):
+        """The samples are already in memory"""
+
+    def close(self):
+        """The samples are freed once the last slice of them is gone"""
+        self.pcm.release()
+        return True
+
+    @property
+    def sample_format(self):
+        """(sample_width, channels, framerate) of the track"""
+        return self.sample_width, self.channels, self.framerate
+
+
+class TrackCache:
+    def __init__(self, max_bytes=TRACK_CACHE_BYTES, get_stream_params=None):
+        """
+        TrackCache: tracks keyed by file path and sample format, evicted least recently used first once
+        the audio mapped or converted exceeds max_bytes. Tracks in use are never evicted, so the budget
+        can be exceeded while every cached track is playing.
+        :param max_bytes: budget in bytes of PCM kept mapped or converted
+        :param get_stream_params: passed to every Track loaded
+        """
+        self.max_bytes = max_bytes
+        self.get_stream_params = get_stream_params
+        # (path, sample_format) -> Track or ConvertedTrack, least recently used first. The sample_format
+        # of original tracks is None
+        self.tracks = OrderedDict()
+        self.num_bytes = 0
+        # tracks evicted while slices of their samples were still in use, closed as soon as they aren't
+        self.closing = []
+
+    def acquire(self, path, sample_format=None):
+        """
+        Returns the track of the given file, loading or converting it if it isn't cached. Every call must
+        be matched by a call to release() once the caller is done with the track.
+        :param path: path of the wave file
+        :param sample_format: optional (sample_width, channels, framerate) to convert the track to
+        :return: Track, or ConvertedTrack if the track had to be converted
+        """
+        track = self.lookup(path, sample_format)
+        if track is not None:
+            return track
+        if sample_format is None:
+            track = Track(path, self.get_stream_params)
+            self.add(path, None, track)
+            return track
+        source = self.acquire(path)
+        if sample_format == source.sample_format:
+            return source
+        try:
+            track = ConvertedTrack(source, sample_format, self.get_stream_params)
+        finally:
+            self.release(source)
+        self.add(path, sample_format, track)
+        return track
+
+    def lookup(self, path, sample_format=None):
+        """
+        Like acquire() but only returns tracks already cached.
+        :return: the cached track or None
+        """
+        track = self.tracks.get((path, sample_format))
+        if track is None:
+            return None
+        self.tracks.move_to_end((path, sample_format))
+        track.users += 1
+        return track
+
+    def add(self, path, sample_format, track):
+        """
+        Caches a track loaded or converted outside the cache, e.g. on another thread, and acquires it.
+        :param path: path of the wave file
+        :param sample_format: (sample_width, channels, framerate) it was converted to, None if it wasn't
+        :param track: Track or ConvertedTrack
+        """
+        self.tracks[(path, sample_format)] = track
+        self.num_bytes += track.pcm_len
+        track.users += 1
+        self.evict()
+
+    def release(self, track):
+        """
+        Marks that a caller of acquire() is done with the track so it may be evicted.
+        :param track: Track returned by acquire()
+        """
+        track.users -= 1
+        self.evict()
+
+    def evict(self):
+        """Closes least recently used tracks that aren't in use until the cache is within budget"""
+        self.closing = [track for track in self.closing if not track.close()]
+        for key in list(self.tracks):
+            if self.num_bytes <= self.max_bytes:
+                break
+            track = self.tracks[key]
+            if track.users == 0:
+                del self.tracks[key]
+                self.num_bytes -= track.pcm_len
+                if not track.close():
+                    self.closing.append(track)